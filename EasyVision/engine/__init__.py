@@ -5,7 +5,9 @@ from .objectrecognition import ObjectRecognitionEngine
 from .visualodometry_2d import VisualOdometry2DEngine
 from .visualodometry_3d2d import VisualOdometry3D2DEngine
 from .visualodometry_stereo import VisualOdometryStereoEngine
-from .occupancygridmap import OccupancyGridMap
+from .occupancygridmap import OccupancyGridMap, TiledGrid, GridPlanner, DStarLitePlanner
+from .posegraph import PoseGraphOptimizer
+from .bundleadjustment import BundleAdjuster, BundleAdjustmentMixin
 from .pyromap import PyroMap
 
 try:
@@ -14,6 +16,6 @@ except:
     pass
 
 try:
-    from .bowvocabulary import BOWVocabularyBuilderEngine, BOWMatchingMixin
+    from .bowvocabulary import BOWVocabularyBuilderEngine, BOWMatchingMixin, KeyframeDatabase, StreamingVocabularyTrainer, VocabularyTree
 except:
     pass
@@ -1,13 +1,14 @@
 # -*- coding: utf-8 -*-
 """Implements Bag Of Words algorithm and matching.
 
-If pyDBoW3 is available, will use that instead of openCV kmeans bow algorithm
+If pyDBoW3 is available, will use that instead of openCV kmeans bow algorithm.
+Otherwise keyframes are stored in ``KeyframeDatabase``, which is an inverted file of TF-IDF weighted visual words.
 """
 
 from EasyVision.engine.base import EngineBase, EngineCapability
 from EasyVision.models import ObjectModel, ModelView
 from EasyVision.processors.base import *
-from EasyVision.processors import FeatureExtraction
+from EasyVision.processors import FeatureExtraction, FeatureMatchingMixin
 import cv2
 import numpy as np
 
@@ -23,13 +24,405 @@ except:
         pass
 
 
+class StreamingVocabularyTrainer(object):
+    """Vocabulary trainer with bounded memory. Mirrors ``cv2.BOWKMeansTrainer`` interface.
+
+    Descriptors are clustered incrementally in mini batches of ``batch_size`` descriptors:
+        float descriptors
+            mini-batch k-means, where every center moves towards the mean of its assigned descriptors with a
+            learning rate of 1 / number of descriptors assigned so far
+        binary descriptors
+            k-majority, where every center bit is the majority bit of its assigned descriptors
+
+    A uniform sample of at most ``reservoir_size`` descriptors is kept using reservoir sampling. The sample is used to
+    initialize centers with k-means++ and to refine them with a few full iterations when ``cluster`` is called.
+    Thus memory does not depend on the number of added descriptors.
+    """
+
+    def __init__(self, clusters, binary=False, batch_size=1000, reservoir_size=100000, iterations=3, seed=None):
+        """Instance initialization
+
+        :param clusters: number of clusters
+        :param binary: indicates whether descriptors are binary(uint8 packed bits)
+        :param batch_size: number of descriptors in a mini batch
+        :param reservoir_size: maximum number of sampled descriptors
+        :param iterations: number of refinement iterations over the sample in ``cluster``
+        :param seed: random seed
+        """
+        if reservoir_size < clusters:
+            raise ValueError("Reservoir size must be at least the number of clusters")
+        self._clusters = clusters
+        self._binary = binary
+        self._batch_size = batch_size
+        self._reservoir_size = reservoir_size
+        self._iterations = iterations
+        self._random = np.random.RandomState(seed)
+        self.clear()
+
+    def clear(self):
+        """Clears all collected statistics"""
+        self._reservoir = None
+        self._reservoir_count = 0
+        self._pending = []
+        self._pending_count = 0
+        self._centers = None
+        self._counts = None
+        self._sums = None
+        self._seen = 0
+
+    def descriptorsCount(self):
+        """Returns the total number of added descriptors"""
+        return self._seen
+
+    @property
+    def reservoir(self):
+        """Returns sampled descriptors"""
+        return self._reservoir[:self._reservoir_count] if self._reservoir is not None else None
+
+    def add(self, descriptors):
+        """Adds descriptors of an image
+
+        :param descriptors: NxD array of descriptors
+        """
+        if isinstance(descriptors, cv2.UMat):
+            descriptors = descriptors.get()
+        if descriptors is None or not len(descriptors):
+            return
+        data = np.unpackbits(descriptors, axis=1) if self._binary else np.float32(descriptors)
+        self._sample(data)
+        self._pending.append(data)
+        self._pending_count += len(data)
+        if self._pending_count >= self._batch_size:
+            self._update(np.concatenate(self._pending))
+            self._pending, self._pending_count = [], 0
+
+    def cluster(self):
+        """Finalizes clustering
+
+        :return: KxD array of centers. Binary centers are packed into uint8.
+        """
+        if self._pending:
+            self._update(np.concatenate(self._pending))
+            self._pending, self._pending_count = [], 0
+        if self._centers is None:
+            raise ValueError("Not enough descriptors to create %d clusters" % self._clusters)
+
+        sample = self.reservoir
+        for i in range(self._iterations):
+            labels = self._assign(sample, self._centers)
+            counts, sums = self._accumulate(sample, labels)
+            used = counts > 0
+            self._centers[used] = sums[used] / counts[used, None]
+            if self._binary:
+                self._centers = np.float32(self._centers > .5)
+
+        return self._vocabulary()
+
+    def predict(self, descriptors):
+        """Finds nearest cluster of each descriptor. Must be called after ``cluster``
+
+        :param descriptors: NxD array of descriptors
+        :return: array of N cluster indices
+        """
+        if isinstance(descriptors, cv2.UMat):
+            descriptors = descriptors.get()
+        labels = []
+        for start in range(0, len(descriptors), self._batch_size):
+            batch = descriptors[start:start + self._batch_size]
+            data = np.unpackbits(batch, axis=1) if self._binary else np.float32(batch)
+            labels.append(self._assign(data, self._centers))
+        return np.concatenate(labels) if labels else np.int64([])
+
+    def _vocabulary(self):
+        """Helper method to convert centers into vocabulary format"""
+        if self._binary:
+            return np.packbits(np.uint8(self._centers > .5), axis=1)
+        return self._centers.copy()
+
+    def _sample(self, data):
+        """Helper method to add descriptors to the reservoir sample using Algorithm R"""
+        if self._reservoir is None:
+            self._reservoir = np.empty((self._reservoir_size, data.shape[1]), data.dtype)
+        free = min(self._reservoir_size - self._reservoir_count, len(data))
+        if free:
+            self._reservoir[self._reservoir_count:self._reservoir_count + free] = data[:free]
+            self._reservoir_count += free
+        positions = self._seen + free + np.arange(len(data) - free)
+        slots = np.int64(self._random.random_sample(len(positions)) * (positions + 1))
+        replace = slots < self._reservoir_size
+        self._reservoir[slots[replace]] = data[free:][replace]
+        self._seen += len(data)
+
+    def _initialize(self):
+        """Helper method to initialize centers from the reservoir sample using greedy k-means++"""
+        sample = self.reservoir
+        trials = 2 + int(np.log(self._clusters))
+        centers = np.empty((self._clusters, sample.shape[1]), np.float32)
+        centers[0] = sample[self._random.randint(len(sample))]
+        distances = self._distances(sample, centers[:1])[:, 0]
+        for i in range(1, self._clusters):
+            # Hamming distance is not squared, thus square it to get D^2 weighting
+            weights = distances * distances if self._binary else distances
+            total = weights.sum()
+            if total > 0:
+                candidates = self._random.choice(len(sample), trials, p=weights / total)
+            else:
+                candidates = self._random.randint(len(sample), size=trials)
+            candidate_distances = np.minimum(distances[:, None], self._distances(sample, sample[candidates]))
+            potentials = candidate_distances * candidate_distances if self._binary else candidate_distances
+            best = np.argmin(potentials.sum(axis=0))
+            centers[i] = sample[candidates[best]]
+            distances = candidate_distances[:, best]
+        self._centers = centers
+        self._counts = np.zeros(self._clusters, np.int64)
+        self._sums = np.zeros_like(centers)
+
+    def _update(self, batch):
+        """Helper method to run a single mini batch step"""
+        if self._centers is None:
+            if self._reservoir_count < self._clusters:
+                return
+            self._initialize()
+        labels = self._assign(batch, self._centers)
+        counts, sums = self._accumulate(batch, labels)
+        used = counts > 0
+        self._counts += counts
+        if self._binary:
+            self._sums += sums
+            self._centers[used] = np.float32(self._sums[used] / self._counts[used, None] > .5)
+        else:
+            rate = (counts[used] / np.float32(self._counts[used]))[:, None]
+            self._centers[used] += rate * (sums[used] / counts[used, None] - self._centers[used])
+
+    def _accumulate(self, data, labels):
+        """Helper method to count and sum descriptors assigned to each center"""
+        counts = np.bincount(labels, minlength=self._clusters)
+        sums = np.zeros((self._clusters, data.shape[1]), np.float32)
+        order = np.argsort(labels, kind='stable')
+        labels = labels[order]
+        starts = np.flatnonzero(np.concatenate(([True], labels[1:] != labels[:-1])))
+        sums[labels[starts]] = np.add.reduceat(np.float32(data[order]), starts, axis=0)
+        return counts, sums
+
+    def _distances(self, data, centers):
+        """Helper method to compute squared L2 distances, which for unpacked bits are Hamming distances"""
+        data = np.float32(data)
+        distances = (data * data).sum(axis=1)[:, None] + (centers * centers).sum(axis=1)[None, :] - 2 * data.dot(centers.T)
+        return np.maximum(distances, 0)
+
+    def _assign(self, data, centers):
+        """Helper method to find nearest center for each descriptor"""
+        return np.argmin(self._distances(data, centers), axis=1)
+
+
+def _popcount(values):
+    """Helper function to count set bits of uint64 values. Input array is modified."""
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(values)
+    temp = values >> np.uint64(1)
+    temp &= np.uint64(0x5555555555555555)
+    values -= temp
+    temp = values >> np.uint64(2)
+    temp &= np.uint64(0x3333333333333333)
+    values &= np.uint64(0x3333333333333333)
+    values += temp
+    temp = values >> np.uint64(4)
+    values += temp
+    values &= np.uint64(0x0F0F0F0F0F0F0F0F)
+    values *= np.uint64(0x0101010101010101)
+    values >>= np.uint64(56)
+    return values
+
+
+class VocabularyTree(object):
+    """Hierarchical k-ary vocabulary tree, similar to DBoW3 vocabulary.
+
+    Tree is created using hierarchical k-means with branching factor ``k`` and depth ``L``. Leaves are visual words.
+    A descriptor is converted into a word by descending from the root and selecting the nearest child on each level,
+    using Hamming distance for binary descriptors and L2 distance for float descriptors.
+    Descent is vectorized over all descriptors of a frame, thus a lookup costs ``k * L`` distances per descriptor
+    instead of a flat search over all ``k^L`` words.
+
+    Word IDF weights are computed from training images.
+    """
+
+    def __init__(self, k=10, L=5, binary=False):
+        """Instance initialization
+
+        :param k: branching factor
+        :param L: depth of the tree
+        :param binary: indicates whether descriptors are binary(uint8 packed bits)
+        """
+        if k < 2 or L < 1:
+            raise ValueError("Branching factor must be at least 2 and depth at least 1")
+        self._k = k
+        self._L = L
+        self._binary = binary
+        self._centers = None
+        self._children = None
+        self._words = None
+        self._idf = None
+
+    @property
+    def k(self):
+        """Branching factor"""
+        return self._k
+
+    @property
+    def L(self):
+        """Depth of the tree"""
+        return self._L
+
+    @property
+    def binary(self):
+        """Indicates whether descriptors are binary"""
+        return self._binary
+
+    @property
+    def size(self):
+        """Number of words"""
+        return int(self._idf.size) if self._idf is not None else 0
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def idf(self):
+        """IDF weight of each word"""
+        return self._idf
+
+    def create(self, features, iterations=10, seed=None):
+        """Creates the tree using hierarchical k-means
+
+        :param features: a list of descriptor arrays, one per training image
+        :param iterations: number of k-means iterations per node
+        :param seed: random seed
+        """
+        features = [f.get() if isinstance(f, cv2.UMat) else f for f in features]
+        features = [f for f in features if f is not None and len(f)]
+        if not features:
+            raise ValueError("No descriptors to create vocabulary from")
+        descriptors = np.concatenate(features)
+        descriptors = descriptors.astype(np.uint8 if self._binary else np.float32, copy=False)
+        random = np.random.RandomState(seed)
+
+        centers, children = [np.zeros(descriptors.shape[1], descriptors.dtype)], [[]]
+        stack = [(0, np.arange(len(descriptors)), 0)]
+        while stack:
+            node, indices, level = stack.pop()
+            if level == self._L:
+                continue
+            data = descriptors[indices]
+            if len(data) <= self._k:
+                child_centers, labels = data, np.arange(len(data))
+            else:
+                trainer = StreamingVocabularyTrainer(self._k, self._binary, len(data), len(data), iterations,
+                                                     random.randint(2 ** 31))
+                trainer.add(data)
+                child_centers = trainer.cluster()
+                labels = trainer.predict(data)
+            for label, center in enumerate(child_centers):
+                members = indices[labels == label]
+                if not len(members):
+                    continue
+                children[node].append(len(centers))
+                stack.append((len(centers), members, level + 1))
+                centers.append(center)
+                children.append([])
+
+        self._centers = np.array(centers)
+        self._children = np.full((len(centers), self._k), -1, np.int32)
+        for node, items in enumerate(children):
+            self._children[node, :len(items)] = items
+        leaves = self._children[:, 0] < 0
+        self._words = np.full(len(centers), -1, np.int32)
+        self._words[leaves] = np.arange(np.count_nonzero(leaves))
+
+        images = np.repeat(np.arange(len(features)), [len(f) for f in features])
+        words = self.transform(descriptors)
+        pairs = np.unique(images * np.int64(np.count_nonzero(leaves)) + words)
+        df = np.bincount(pairs % np.count_nonzero(leaves), minlength=np.count_nonzero(leaves))
+        with np.errstate(divide='ignore'):
+            idf = np.log(len(features) / df.astype(np.float64))
+        idf[df == 0] = 0
+        self._idf = np.float32(idf)
+
+    def transform(self, descriptors):
+        """Converts descriptors into word ids
+
+        :param descriptors: NxD array of descriptors
+        :return: array of N word ids
+        """
+        if self._centers is None:
+            raise ValueError("Vocabulary is empty")
+        if isinstance(descriptors, cv2.UMat):
+            descriptors = descriptors.get()
+        descriptors = np.ascontiguousarray(descriptors, np.uint8 if self._binary else np.float32)
+        nodes = np.zeros(len(descriptors), np.int32)
+        for level in range(self._L):
+            children = self._children[nodes]
+            active = np.flatnonzero(children[:, 0] >= 0)
+            if not len(active):
+                break
+            children = children[active]
+            distances = self._distances(descriptors[active], self._centers[np.maximum(children, 0)])
+            distances = np.where(children >= 0, distances, np.inf)
+            nodes[active] = children[np.arange(len(active)), np.argmin(distances, axis=1)]
+        return self._words[nodes]
+
+    def histogram(self, descriptors):
+        """Computes a BOW histogram of word frequencies normalized by the number of descriptors
+
+        :param descriptors: NxD array of descriptors
+        :return: array of word frequencies
+        """
+        histogram = np.zeros(self.size, np.float32)
+        if descriptors is None or len(descriptors) == 0:
+            return histogram
+        words = self.transform(descriptors)
+        return np.float32(np.bincount(words, minlength=self.size)) / len(words)
+
+    def _distances(self, descriptors, centers):
+        """Helper method to compute distances between each descriptor and its candidate centers
+
+        :param descriptors: NxD array of descriptors
+        :param centers: NxKxD array of centers
+        :return: NxK array of distances
+        """
+        if self._binary:
+            if descriptors.shape[1] % 8 == 0:
+                descriptors = np.ascontiguousarray(descriptors).view(np.uint64)
+                centers = np.ascontiguousarray(centers).view(np.uint64)
+            values = (descriptors[:, None, :] ^ centers).astype(np.uint64, copy=False)
+            return np.float32(_popcount(values).sum(axis=2))
+        diff = centers - descriptors[:, None, :]
+        return np.einsum('nkd,nkd->nk', diff, diff)
+
+    def save(self, path):
+        """Saves the vocabulary to a file using numpy npz format"""
+        with open(path, 'wb') as f:
+            np.savez(f, k=self._k, L=self._L, binary=self._binary, centers=self._centers,
+                     children=self._children, words=self._words, idf=self._idf)
+
+    def load(self, path):
+        """Loads the vocabulary from a file saved with ``save``"""
+        with np.load(path, allow_pickle=False) as data:
+            self._k, self._L, self._binary = int(data['k']), int(data['L']), bool(data['binary'])
+            self._centers = data['centers']
+            self._children = data['children']
+            self._words = data['words']
+            self._idf = data['idf']
+
+
 class BOWVocabularyBuilderEngine(EngineBase):
     """Class implementing BOW dictionary
 
     """
 
     def __init__(self, vision, feature_type, clusters, dbow3_trainer=dbow_available,
-                 k=10, L=5, weighting=bow.WeightingType.TF_IDF, scoring=bow.ScoringType.L1_NORM,
+                 k=10, L=5, weighting=bow.WeightingType.TF_IDF if dbow_available else None,
+                 scoring=bow.ScoringType.L1_NORM if dbow_available else None,
+                 streaming=False, batch_size=1000, reservoir_size=100000, tree=False,
                  *args, **kwargs):
         """Instance initialization.
 
@@ -41,6 +434,12 @@ class BOWVocabularyBuilderEngine(EngineBase):
         :param L: DBoW3 parameter
         :param weighting: DBoW3 parameter
         :param scoring: DBoW3 parameter
+        :param streaming: True tells to use ``StreamingVocabularyTrainer``, which supports binary features and
+                          uses bounded memory
+        :param batch_size: streaming trainer mini batch size
+        :param reservoir_size: streaming trainer descriptor sample size
+        :param tree: True tells to use built-in ``VocabularyTree`` with ``k`` and ``L`` parameters,
+                     which supports binary features
         """
 
         if not isinstance(vision, ProcessorBase) and not isinstance(vision, VisionBase):
@@ -48,7 +447,9 @@ class BOWVocabularyBuilderEngine(EngineBase):
         if not isinstance(vision, ProcessorBase) and not feature_type:
             raise TypeError("Feature type must be provided")
 
-        if not dbow3_trainer and feature_type not in ['SIFT', 'SURF']:
+        if streaming or tree:
+            dbow3_trainer = False
+        elif not dbow3_trainer and feature_type not in ['SIFT', 'SURF']:
             raise NotImplementedError("OpenCV KMeans trainer only supports floating point features. Use DBoW3 instead.")
 
         if dbow3_trainer and not dbow_available:
@@ -61,6 +462,12 @@ class BOWVocabularyBuilderEngine(EngineBase):
         if dbow3_trainer:
             self._trainer = bow.Vocabulary(k, L, weighting, scoring)
             self._features = []
+        elif tree:
+            self._trainer = VocabularyTree(k, L, feature_type in FeatureMatchingMixin.BINARY_FEATURES)
+            self._features = []
+        elif streaming:
+            binary = feature_type in FeatureMatchingMixin.BINARY_FEATURES
+            self._trainer = StreamingVocabularyTrainer(clusters, binary, batch_size, reservoir_size)
         else:
             self._trainer = cv2.BOWKMeansTrainer(clusters)
 
@@ -68,6 +475,8 @@ class BOWVocabularyBuilderEngine(EngineBase):
 
     def compute(self):
         frame = self.vision.capture()
+        if not frame:
+            return None
         self._vocabulary_valid = False
         for image in frame.images:
             if hasattr(self, '_features'):
@@ -78,7 +487,9 @@ class BOWVocabularyBuilderEngine(EngineBase):
 
     def save(self, path):
         """Saves BOW dictionary to a file"""
-        if hasattr(self, '_features'):
+        if isinstance(self._trainer, VocabularyTree):
+            self._trainer.save(path)
+        elif hasattr(self, '_features'):
             self._trainer.save(path, True)
         else:
             raise NotImplementedError()
@@ -108,47 +519,215 @@ class BOWVocabularyBuilderEngine(EngineBase):
 
     @property
     def description(self):
-        return "Bag Of Visual Words engine using DBoW3 library or OpenCV KMeans trainer"
+        return "Bag Of Visual Words engine using DBoW3 library, vocabulary tree, OpenCV KMeans or streaming trainer"
 
     @property
     def capabilities(self):
         return EngineCapability(
                 (ProcessorBase, FeatureExtraction),
                 (Frame,),
-                {'dictionaries': ('kmeans', 'dbow3')}
+                {'dictionaries': ('kmeans', 'dbow3', 'streaming', 'tree')}
             )
 
 
+class KeyframeDatabase(object):
+    """Inverted file keyframe database.
+
+    For every visual word the database keeps a posting list of keyframe ids and weights of that word in the keyframe.
+    BOW vectors are weighted using TF-IDF, where IDF weights are supplied by the vocabulary(defaults to plain TF),
+    and normalized according to the scoring method:
+        L1
+            score is ``1 - 0.5 * |a - b|``, which for L1 normalized vectors is a sum of minimums of common words
+        L2
+            score is a dot product(cosine similarity) of L2 normalized vectors
+
+    Thus querying only touches posting lists of words present in the query.
+    Posting lists are numpy arrays with amortized growth, so adding a keyframe is O(number of words in the keyframe).
+    """
+
+    SCORING = ('L1', 'L2')
+
+    def __init__(self, num_words, idf=None, scoring='L1'):
+        """Instance initialization
+
+        :param num_words: size of the vocabulary
+        :param idf: IDF weight per word. If None, all words have equal weight
+        :param scoring: scoring method. One of L1, L2
+        """
+        if scoring not in KeyframeDatabase.SCORING:
+            raise ValueError("Scoring must be one of %s" % ", ".join(KeyframeDatabase.SCORING))
+        if idf is not None and len(idf) != num_words:
+            raise ValueError("IDF weights must be provided for every word")
+        self._num_words = num_words
+        self._idf = np.ones(num_words, np.float32) if idf is None else np.float32(idf).ravel()
+        self._scoring = scoring
+        self._postings = {}
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def num_words(self):
+        """Size of the vocabulary"""
+        return self._num_words
+
+    @property
+    def scoring(self):
+        """Scoring method"""
+        return self._scoring
+
+    @property
+    def idf(self):
+        """IDF weights of words"""
+        return self._idf
+
+    @staticmethod
+    def compute_idf(histograms):
+        """Computes IDF weights from a set of training BOW histograms
+
+        :param histograms: NxW array of word frequencies of N training images
+        :return: array of W IDF weights. Words never seen have zero weight.
+        """
+        histograms = np.asarray(histograms)
+        df = np.count_nonzero(histograms, axis=0)
+        with np.errstate(divide='ignore'):
+            idf = np.log(len(histograms) / df.astype(np.float64))
+        idf[df == 0] = 0
+        return np.float32(idf)
+
+    def transform(self, histogram):
+        """Converts a BOW histogram into a sparse normalized TF-IDF vector
+
+        :param histogram: array of W word frequencies
+        :return: a tuple of word ids and their weights
+        """
+        histogram = np.asarray(histogram, np.float32).ravel()
+        if len(histogram) != self._num_words:
+            raise ValueError("Histogram size does not match vocabulary size")
+        words = np.flatnonzero(histogram)
+        values = histogram[words] * self._idf[words]
+        nonzero = values > 0
+        words, values = words[nonzero], values[nonzero]
+        norm = values.sum() if self._scoring == 'L1' else np.sqrt(np.dot(values, values))
+        if norm > 0:
+            values /= norm
+        return words, values
+
+    def add(self, histogram):
+        """Adds a keyframe to the database
+
+        :param histogram: BOW histogram of the keyframe
+        :return: id of the added keyframe
+        """
+        words, values = self.transform(histogram)
+        keyframe_id = self._count
+        for word, value in zip(words.tolist(), values.tolist()):
+            posting = self._postings.get(word)
+            if posting is None:
+                posting = self._postings[word] = [np.empty(4, np.int32), np.empty(4, np.float32), 0]
+            ids, weights, size = posting
+            if size == len(ids):
+                posting[0] = ids = np.resize(ids, size * 2)
+                posting[1] = weights = np.resize(weights, size * 2)
+            ids[size] = keyframe_id
+            weights[size] = value
+            posting[2] = size + 1
+        self._count += 1
+        return keyframe_id
+
+    def query(self, histogram, max_results=10):
+        """Finds best matching keyframes
+
+        :param histogram: BOW histogram of the query frame
+        :param max_results: maximum number of results
+        :return: a list of (keyframe id, score) sorted by score in descending order
+        """
+        words, values = self.transform(histogram)
+        ids, scores = [], []
+        for word, value in zip(words.tolist(), values):
+            posting = self._postings.get(word)
+            if posting is None:
+                continue
+            _ids, weights, size = posting
+            ids.append(_ids[:size])
+            scores.append(np.minimum(weights[:size], value) if self._scoring == 'L1' else weights[:size] * value)
+        if not ids:
+            return []
+
+        scores = np.bincount(np.concatenate(ids), np.concatenate(scores), self._count)
+        candidates = np.flatnonzero(scores)
+        if len(candidates) > max_results:
+            candidates = candidates[np.argpartition(-scores[candidates], max_results - 1)[:max_results]]
+        candidates = candidates[np.argsort(-scores[candidates], kind='stable')]
+        return list(zip(candidates.tolist(), scores[candidates].tolist()))
+
+    def save(self, path):
+        """Saves the database to a file using numpy npz format"""
+        words = np.int32(sorted(self._postings))
+        sizes = np.int64([self._postings[word][2] for word in words.tolist()])
+        ids = [self._postings[word][0][:self._postings[word][2]] for word in words.tolist()]
+        weights = [self._postings[word][1][:self._postings[word][2]] for word in words.tolist()]
+        with open(path, 'wb') as f:
+            np.savez(f, num_words=self._num_words, idf=self._idf, scoring=self._scoring, count=self._count,
+                     words=words, sizes=sizes,
+                     ids=np.concatenate(ids) if ids else np.int32([]),
+                     weights=np.concatenate(weights) if weights else np.float32([]))
+
+    @staticmethod
+    def load(path):
+        """Loads the database from a file saved with ``save``"""
+        with np.load(path, allow_pickle=False) as data:
+            database = KeyframeDatabase(int(data['num_words']), data['idf'], str(data['scoring']))
+            database._count = int(data['count'])
+            offsets = np.concatenate(([0], np.cumsum(data['sizes'])))
+            ids, weights = data['ids'], data['weights']
+            for word, start, end in zip(data['words'].tolist(), offsets[:-1].tolist(), offsets[1:].tolist()):
+                database._postings[word] = [ids[start:end].copy(), weights[start:end].copy(), end - start]
+        return database
+
+
 class BOWMatchingMixin(object):
     """Mixin class implementing BOW matching.
 
     """
 
-    SLOTS = ('_bow_extractor', '_database')
+    SLOTS = ('_bow_extractor', '_bow_matcher', '_bow_tree', '_database', '_dbow3')
     __slots__ = SLOTS
 
     def __init__(self, *args, **kwargs):
         self._bow_extractor = None
+        self._bow_matcher = None
+        self._bow_tree = None
         super(BOWMatchingMixin, self).__init__(*args, **kwargs)
 
-    def initBOW(self, extractor, matcher, vocabulary, feature_type):
+    def initBOW(self, extractor, matcher, vocabulary, feature_type, idf=None, scoring='L1'):
         """Must be called for the mixin initialization. Usually being called from ``setup`` method.
 
         :param extractor: is used for openCV BOW algorithm
-        :param matcher: is used for openCV BOW algorithm
-        :param vocabulary: BOW vocabulary instance or a string. if a string is provided, will use dbow3 and will treat it as path to the database.
+        :param matcher: is used for openCV BOW algorithm to find words of descriptors. Defaults to brute force L2 matcher.
+        :param vocabulary: BOW vocabulary instance, ``VocabularyTree`` or a string. if a string is provided, will use dbow3 and will treat it as path to the database.
         :param feature_type: type of features used in the matching/bow calculation process
+        :param idf: IDF weights of vocabulary words for openCV BOW algorithm
+        :param scoring: scoring method for openCV BOW algorithm, see ``KeyframeDatabase``
         :return: None
         """
 
-        self._dbow3 = isinstance(vocabulary, bow.Vocabulary) or isinstance(vocabulary, str)
-        if self._dbow3 and feature_type not in ['SIFT', 'SURF']:
-            raise NotImplementedError("OpenCV KMeans trainer only supports floating point features. Use DBoW3 instead.")
+        self._dbow3 = dbow_available and (isinstance(vocabulary, bow.Vocabulary) or isinstance(vocabulary, str))
+        if isinstance(vocabulary, VocabularyTree):
+            self._bow_tree = vocabulary
+            self._database = KeyframeDatabase(vocabulary.size, vocabulary.idf if idf is None else idf, scoring)
+            return
+        if not self._dbow3 and feature_type not in ['SIFT', 'SURF']:
+            raise NotImplementedError("OpenCV KMeans trainer only supports floating point features. Use DBoW3 or VocabularyTree instead.")
 
         if not self._dbow3:
+            if matcher is None:
+                matcher = cv2.BFMatcher(cv2.NORM_L2)
             self._bow_extractor = cv2.BOWImgDescriptorExtractor(extractor, matcher)
             self._bow_extractor.setVocabulary(vocabulary)
-            self._database = []
+            self._bow_matcher = matcher
+            self._database = KeyframeDatabase(len(vocabulary), idf, scoring)
         else:
             self._database = bow.Database()
             if isinstance(vocabulary, str):
@@ -162,25 +741,36 @@ class BOWMatchingMixin(object):
         del self._database
 
     def _add_keyframe(self, descriptors):
-        """Adds a keyframe to the matching database"""
-        if isinstance(self._database, list):
-            self._database += [(self._compute_bow(descriptors), descriptors)]
+        """Adds a keyframe to the matching database
+
+        :return: keyframe id
+        """
+        if isinstance(self._database, KeyframeDatabase):
+            return self._database.add(self._compute_bow(descriptors))
         else:
-            self._database.add(descriptors)
+            return self._database.add(descriptors)
 
     def _query_frame(self, descriptors, max_results=10):
-        """Finds a list of matching keyframes using provided descriptors"""
-        if isinstance(self._database, list):
-            current_bow = self._compute_bow(descriptors)
-            matches = (self._match_bow(current_bow, bow) for bow, descriptor in self._database)
-            all_results = [(i, score) for i, score in enumerate(matches)].sorted(key=lambda x: x[1])
-        else:
-            all_results = [(result.Id, result.Score) for result in self._database.query(descriptors)].sorted(key=lambda x: x[1])
+        """Finds a list of matching keyframes using provided descriptors
+
+        :return: a list of (keyframe id, score) sorted by score in descending order
+        """
+        if isinstance(self._database, KeyframeDatabase):
+            return self._database.query(self._compute_bow(descriptors), max_results)
+        all_results = sorted(((result.Id, result.Score) for result in self._database.query(descriptors)),
+                             key=lambda x: x[1], reverse=True)
         return all_results[:max_results]
 
     def _compute_bow(self, descriptors):
-        """Helper method to compute BOW using feature descriptors"""
-        return self._bow_extractor.compute(descriptors)
+        """Helper method to compute BOW histogram using feature descriptors"""
+        if self._bow_tree is not None:
+            return self._bow_tree.histogram(descriptors)
+        vocabulary = self._bow_extractor.getVocabulary()
+        histogram = np.zeros(len(vocabulary), np.float32)
+        if descriptors is None or len(descriptors) == 0:
+            return histogram
+        words = np.int32([m.trainIdx for m in self._bow_matcher.match(np.float32(descriptors), vocabulary)])
+        return np.float32(np.bincount(words, minlength=len(vocabulary))) / len(descriptors)
 
     def _match_bow(self, bowA, bowB, method=cv2.HISTCMP_INTERSECT):
         """Compares two histograms"""
@@ -0,0 +1,533 @@
+# -*- coding: utf-8 -*-
+"""Implements sliding window bundle adjustment used to refine visual odometry poses.
+
+"""
+
+import threading as mt
+import cv2
+import numpy as np
+
+scipy_available = False
+try:
+    import scipy.sparse as sparse
+    from scipy.optimize import least_squares
+    scipy_available = True
+except ImportError:
+    pass
+
+
+def _rodrigues(rvecs):
+    """Helper function to convert Nx3 rotation vectors into Nx3x3 rotation matrices"""
+    theta = np.linalg.norm(rvecs, axis=1)[:, None, None]
+    with np.errstate(invalid='ignore'):
+        axis = np.nan_to_num(rvecs / theta[:, :, 0])
+    K = np.zeros((len(rvecs), 3, 3))
+    K[:, 0, 1], K[:, 0, 2], K[:, 1, 2] = -axis[:, 2], axis[:, 1], -axis[:, 0]
+    K[:, 1, 0], K[:, 2, 0], K[:, 2, 1] = axis[:, 2], -axis[:, 1], axis[:, 0]
+    return np.eye(3) + np.sin(theta) * K + (1 - np.cos(theta)) * np.matmul(K, K)
+
+
+class BundleAdjuster(object):
+    """Sliding window bundle adjustment.
+
+    Keyframes are camera poses as rotation and translation from world to camera coordinates, landmarks are 3d points
+    in world coordinates and observations are pixel coordinates of landmarks in keyframes.
+    On request the last ``window`` keyframes and all landmarks they observe are optimized by minimizing reprojection
+    errors with ``scipy.optimize.least_squares``. Jacobian sparsity is passed, so that finite differences are
+    computed for groups of independent columns. Older keyframes that observe optimized landmarks are fixed and
+    anchor the window, if there are none, the oldest keyframe of the window is fixed.
+
+    If ``background`` is set, ``request`` returns immediately and optimization runs on a separate thread on a
+    snapshot of the window. Results are published atomically. Keyframes and landmarks added during optimization are
+    moved together with the last keyframe of the snapshot.
+
+    Only the last ``history`` keyframes are kept. Older keyframes are forgotten together with their observations and
+    landmarks that are not observed by kept keyframes, thus storage does not grow with the length of the trajectory.
+    Ids stay valid until keyframes and landmarks are forgotten.
+    """
+
+    def __init__(self, matrix, window=5, iterations=20, threshold=2., tolerance=1e-4, background=True, history=None):
+        """Instance initialization
+
+        :param matrix: 3x3 camera matrix
+        :param window: number of keyframes to optimize
+        :param iterations: maximum number of function evaluations per optimization
+        :param threshold: reprojection error scale in pixels(``f_scale``) of soft L1 loss. Larger errors grow roughly linearly
+        :param tolerance: relative decrease of the error at which to stop iterating
+        :param background: indicates whether to run optimization on a separate thread
+        :param history: number of keyframes to keep, at least two windows, i.e. the window and keyframes anchoring it.
+                        Defaults to two windows
+        """
+        if not scipy_available:
+            raise NotImplementedError("SciPy library not imported")
+        if window < 2:
+            raise ValueError("Window must contain at least 2 keyframes")
+        if history is None:
+            history = 2 * window
+        if history < 2 * window:
+            raise ValueError("History must contain at least two windows of keyframes")
+        self._matrix = np.float64(matrix).reshape(3, 3)
+        self._window = window
+        self._iterations = iterations
+        self._threshold = threshold
+        self._tolerance = tolerance
+        self._background = background
+        self._history = history
+        self._first = 0
+        self._rotations = []
+        self._translations = []
+        self._observations = []
+        self._floors = []
+        self._points = np.zeros((0, 3))
+        self._ids = np.zeros(0, np.int64)
+        self._size = 0
+        self._point_count = 0
+        self._lock = mt.Condition(mt.Lock())
+        self._pending = False
+        self._busy = False
+        self._running = False
+        self._thread = None
+        self._version = 0
+        self._error = 0.0
+
+    def setup(self):
+        """Starts the background thread if required"""
+        if self._background and self._thread is None:
+            self._running = True
+            self._thread = mt.Thread(target=self.run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def release(self):
+        """Stops the background thread. Pending optimization is dropped"""
+        if self._thread is not None:
+            with self._lock:
+                self._running = False
+                self._lock.notify_all()
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        self.setup()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+    def __len__(self):
+        return self._first + len(self._rotations)
+
+    @property
+    def matrix(self):
+        """Camera matrix"""
+        return self._matrix
+
+    @property
+    def history(self):
+        """Number of kept keyframes"""
+        return self._history
+
+    @property
+    def landmark_count(self):
+        """Number of landmarks"""
+        return self._point_count
+
+    @property
+    def version(self):
+        """Number of published optimizations"""
+        return self._version
+
+    @property
+    def error(self):
+        """Robust reprojection error after the last optimization"""
+        return self._error
+
+    def add_keyframe(self, rotation, translation):
+        """Adds a keyframe with initial estimate
+
+        :param rotation: 3x3 rotation matrix from world to camera coordinates
+        :param translation: translation vector from world to camera coordinates
+        :return: keyframe id
+        """
+        with self._lock:
+            self._rotations.append(np.float64(rotation).reshape(3, 3))
+            self._translations.append(np.float64(translation).reshape(3))
+            self._observations.append([])
+            self._floors.append(self._point_count)
+            if len(self._rotations) > self._history:
+                self._forget(len(self._rotations) - self._history)
+            return len(self) - 1
+
+    def add_landmarks(self, points):
+        """Adds landmarks with initial estimates
+
+        :param points: Nx3 points in world coordinates
+        :return: array of landmark ids
+        """
+        points = np.float64(points).reshape(-1, 3)
+        with self._lock:
+            count, size = self._point_count, self._size
+            if size + len(points) > len(self._points):
+                capacity = max(2 * len(self._points), size + len(points))
+                self._points = np.concatenate((self._points[:size], np.zeros((capacity - size, 3))))
+                self._ids = np.concatenate((self._ids[:size], np.zeros(capacity - size, np.int64)))
+            self._points[size:size + len(points)] = points
+            self._ids[size:size + len(points)] = np.arange(count, count + len(points))
+            self._size += len(points)
+            self._point_count += len(points)
+        return np.arange(count, count + len(points))
+
+    def add_observations(self, keyframe, landmarks, points):
+        """Adds observations of landmarks in a keyframe
+
+        :param keyframe: keyframe id
+        :param landmarks: landmark ids
+        :param points: Nx2 pixel coordinates
+        """
+        landmarks = np.int64(landmarks).ravel()
+        points = np.float64(points).reshape(-1, 2)
+        if len(landmarks) != len(points):
+            raise ValueError("Number of landmarks and points must match")
+        with self._lock:
+            self._index(landmarks)
+            self._observations[self._keyframe_index(keyframe)].append((landmarks, points))
+
+    def keyframe(self, i):
+        """Returns the current estimate of a keyframe as a tuple of rotation and translation"""
+        with self._lock:
+            i = self._keyframe_index(i)
+            return self._rotations[i], self._translations[i]
+
+    def landmarks(self, ids):
+        """Returns current estimates of landmarks as Nx3 array"""
+        with self._lock:
+            return self._points[self._index(np.int64(ids))]
+
+    @staticmethod
+    def correction(rotation, translation, new_rotation, new_translation):
+        """Computes the transform C of world coordinates that moves a pose to its new estimate,
+        i.e. ``T_new = T * C`` for poses from world to camera coordinates.
+
+        :return: a tuple of rotation matrix and translation vector
+        """
+        return rotation.T.dot(new_rotation), rotation.T.dot(new_translation - translation)
+
+    def request(self):
+        """Requests optimization. Runs on the background thread if enabled, otherwise optimizes immediately"""
+        if self._thread is None:
+            self.optimize()
+            return
+        with self._lock:
+            self._pending = True
+            self._lock.notify_all()
+
+    def wait(self, timeout=None):
+        """Waits until requested optimization is published
+
+        :return: False if timed out
+        """
+        with self._lock:
+            return self._lock.wait_for(lambda: not self._pending and not self._busy, timeout)
+
+    def optimize(self, iterations=None):
+        """Optimizes the window on the calling thread and publishes the result
+
+        :param iterations: maximum number of function evaluations
+        :return: robust reprojection error
+        """
+        with self._lock:
+            snapshot = self._snapshot()
+
+        if snapshot is None:
+            return self._error
+
+        keyframes, fixed, rotations, translations, landmarks, points, observations, count = snapshot
+        rotations, translations, points, error = self._optimize(
+                self._matrix, len(fixed), rotations, translations, points, observations, self._threshold,
+                self._iterations if iterations is None else iterations, self._tolerance)
+
+        with self._lock:
+            self._publish(keyframes, rotations[len(fixed):], translations[len(fixed):], landmarks, points, count)
+            self._error = error
+        return error
+
+    def run(self):
+        """Background thread loop"""
+        while True:
+            with self._lock:
+                while self._running and not self._pending:
+                    self._lock.wait()
+                if not self._running:
+                    return
+                self._pending = False
+                self._busy = True
+            try:
+                self.optimize()
+            finally:
+                with self._lock:
+                    self._busy = False
+                    self._lock.notify_all()
+
+    def _keyframe_index(self, i):
+        """Helper method to get the storage index of a kept keyframe. Must be called with the lock held"""
+        if not self._first <= i < len(self):
+            raise ValueError("Keyframe does not exist")
+        return i - self._first
+
+    def _find(self, ids):
+        """Helper method to find storage indices of landmarks. Must be called with the lock held.
+
+        :return: a tuple of indices and a mask of landmarks that are kept
+        """
+        stored = self._ids[:self._size]
+        index = np.searchsorted(stored, ids)
+        if not len(stored):
+            return index, np.zeros(np.shape(ids), np.bool_)
+        return index, stored[np.minimum(index, len(stored) - 1)] == ids
+
+    def _index(self, ids):
+        """Helper method to get storage indices of landmarks. Must be called with the lock held"""
+        index, found = self._find(ids)
+        if not np.all(found):
+            raise ValueError("Landmark does not exist")
+        return index
+
+    def _forget(self, count):
+        """Helper method to drop the oldest keyframes with their observations and landmarks that are not observed
+        by the remaining keyframes. Must be called with the lock held.
+        """
+        del self._rotations[:count]
+        del self._translations[:count]
+        del self._observations[:count]
+        del self._floors[:count]
+        self._first += count
+
+        # landmarks added since the oldest keyframe may be observed later
+        ids = self._ids[:self._size]
+        keep = ids >= self._floors[0]
+        observed = [landmarks for chunks in self._observations for landmarks, _ in chunks]
+        if observed:
+            keep |= np.in1d(ids, np.concatenate(observed))
+        size = np.count_nonzero(keep)
+        self._points[:size] = self._points[:self._size][keep]
+        self._ids[:size] = ids[keep]
+        self._size = size
+
+    def _gather(self, keyframes):
+        """Helper method to concatenate observations of keyframes into keyframe ids, landmark ids and points"""
+        chunks = [(k, landmarks, points) for k in keyframes for landmarks, points in self._observations[k - self._first]]
+        if not chunks:
+            return np.zeros(0, np.int64), np.zeros(0, np.int64), np.zeros((0, 2))
+        return (np.concatenate([np.full(len(landmarks), k) for k, landmarks, _ in chunks]),
+                np.concatenate([landmarks for _, landmarks, _ in chunks]),
+                np.concatenate([points for _, _, points in chunks]))
+
+    def _snapshot(self):
+        """Helper method to copy the window. Must be called with the lock held.
+
+        :return: (keyframe ids, fixed keyframe ids, rotations, translations, landmark ids, points, observations,
+                 landmark count) where keyframe arrays start with fixed keyframes and observations index them.
+                 None if nothing to optimize
+        """
+        count = len(self)
+        first = max(self._first, count - self._window)
+        k, l, uv = self._gather(range(first, count))
+        landmarks = np.unique(l)
+
+        # older keyframes observing the same landmarks are fixed
+        _k, _l, _uv = self._gather(range(max(self._first, first - self._window), first))
+        older = np.in1d(_l, landmarks)
+        k, l, uv = np.concatenate((_k[older], k)), np.concatenate((_l[older], l)), np.concatenate((_uv[older], uv))
+
+        # landmarks observed only once do not constrain poses
+        landmarks, index, counts = np.unique(l, return_inverse=True, return_counts=True)
+        observed = counts[index] > 1
+        k, l, uv = k[observed], l[observed], uv[observed]
+        landmarks, l = np.unique(l, return_inverse=True)
+        if not len(landmarks):
+            return None
+
+        fixed = np.unique(k[k < first])
+        keyframes = np.unique(k[k >= first])
+        if not len(fixed):
+            fixed, keyframes = keyframes[:1], keyframes[1:]
+        if not len(keyframes):
+            return None
+
+        # fixed keyframes precede the window, thus ids are sorted
+        ids = np.concatenate((fixed, keyframes))
+        rotations = np.array([cv2.Rodrigues(self._rotations[i - self._first])[0].ravel() for i in ids])
+        translations = np.array([self._translations[i - self._first] for i in ids])
+        return (keyframes, fixed, rotations, translations, landmarks, self._points[self._index(landmarks)],
+                (np.searchsorted(ids, k), l, uv), self._point_count)
+
+    def _publish(self, keyframes, rotations, translations, landmarks, points, count):
+        """Helper method to replace estimates. Newer keyframes and landmarks are moved rigidly with the last keyframe.
+        Must be called with the lock held.
+        """
+        first = self._first
+        if keyframes[-1] < first:
+            # the window was forgotten while optimizing
+            return
+        last = keyframes[-1] - first
+        R = cv2.Rodrigues(rotations[-1])[0]
+        Rc, tc = BundleAdjuster.correction(self._rotations[last], self._translations[last], R, translations[-1])
+        for k in range(last + 1, len(self._rotations)):
+            self._translations[k] = self._rotations[k].dot(tc) + self._translations[k]
+            self._rotations[k] = self._rotations[k].dot(Rc)
+        newer = np.searchsorted(self._ids[:self._size], count)
+        self._points[newer:self._size] = (self._points[newer:self._size] - tc).dot(Rc)
+
+        for k, r, t in zip(keyframes, rotations, translations):
+            if k >= first:
+                self._rotations[k - first] = cv2.Rodrigues(r)[0]
+                self._translations[k - first] = t
+        index, found = self._find(landmarks)
+        self._points[index[found]] = points[found]
+        self._version += 1
+
+    @staticmethod
+    def _project(matrix, rotations, translations, points):
+        """Helper method to project Nx3 points with N camera poses given as rotation matrices and translations"""
+        points = np.einsum('nij,nj->ni', rotations, points) + translations
+        points = points.dot(matrix.T)
+        return points[:, :2] / np.maximum(points[:, 2:], 1e-9)
+
+    @staticmethod
+    def _optimize(matrix, fixed, rotations, translations, points, observations, threshold, iterations, tolerance):
+        """Helper method to run least squares over keyframes following the fixed ones and all points.
+        Returns optimized rotation vectors, translations, points and robust error.
+        """
+        k, l, uv = observations
+        n, m = len(rotations) - fixed, len(points)
+        free = k >= fixed
+
+        def residuals(x):
+            _rotations, _translations = rotations.copy(), translations.copy()
+            _rotations[fixed:] = x[:6 * n].reshape(n, 6)[:, :3]
+            _translations[fixed:] = x[:6 * n].reshape(n, 6)[:, 3:]
+            _points = x[6 * n:].reshape(m, 3)
+            return (BundleAdjuster._project(matrix, _rodrigues(_rotations)[k], _translations[k], _points[l]) - uv).ravel()
+
+        # every observation contributes two rows depending on its keyframe and point
+        rows = np.arange(2 * len(k))
+        sparsity = sparse.lil_matrix((2 * len(k), 6 * n + 3 * m), dtype=int)
+        for i in range(6):
+            sparsity[rows.reshape(-1, 2)[free].ravel(), np.repeat(6 * (k[free] - fixed) + i, 2)] = 1
+        for i in range(3):
+            sparsity[rows, np.repeat(6 * n + 3 * l + i, 2)] = 1
+
+        x0 = np.concatenate((np.hstack((rotations[fixed:], translations[fixed:])).ravel(), points.ravel()))
+        result = least_squares(residuals, x0, jac_sparsity=sparsity, method='trf', loss='soft_l1',
+                               f_scale=threshold, max_nfev=iterations, ftol=tolerance)
+        x = result.x
+        rotations, translations = rotations.copy(), translations.copy()
+        rotations[fixed:] = x[:6 * n].reshape(n, 6)[:, :3]
+        translations[fixed:] = x[:6 * n].reshape(n, 6)[:, 3:]
+        return rotations, translations, x[6 * n:].reshape(m, 3), float(result.cost)
+
+
+class BundleAdjustmentMixin(object):
+    """Mixin that feeds visual odometry keyframes into ``BundleAdjuster`` and applies published corrections.
+
+    Engines keep their own estimate of camera pose from world to camera coordinates, where the world is the camera
+    of the first keyframe. When a new optimization is published, ``_apply_adjustment`` moves the engine estimate and
+    the cumulative pose by the correction of the last keyframe added by the engine.
+    Engines that estimate relative poses between consecutive frames may use ``_chain_keyframe`` that keeps the
+    estimate itself.
+    """
+
+    SLOTS = ('_adjuster', '_adjuster_version', '_adjuster_keyframe', '_adjuster_origin', '_adjuster_pose',
+             '_adjuster_last')
+    __slots__ = ()
+
+    def __init__(self, *args, **kwargs):
+        self._adjuster = kwargs.pop('bundle_adjuster', None)
+        if not isinstance(self._adjuster, BundleAdjuster) and self._adjuster is not None:
+            raise TypeError("Bundle adjuster must be of type BundleAdjuster")
+        self._adjuster_version = 0
+        self._adjuster_keyframe = None
+        self._adjuster_origin = None
+        self._adjuster_pose = np.eye(3), np.zeros(3)
+        self._adjuster_last = None
+        super(BundleAdjustmentMixin, self).__init__(*args, **kwargs)
+
+    def setup(self):
+        if self._adjuster is not None:
+            self._adjuster.setup()
+        super(BundleAdjustmentMixin, self).setup()
+
+    def release(self):
+        if self._adjuster is not None:
+            self._adjuster.release()
+        super(BundleAdjustmentMixin, self).release()
+
+    @property
+    def bundle_adjuster(self):
+        """Bundle adjuster or None"""
+        return self._adjuster
+
+    def _add_keyframe(self, rotation, translation):
+        """Helper method to add a keyframe to the bundle adjuster
+
+        :param rotation: rotation from world to camera coordinates
+        :param translation: translation from world to camera coordinates
+        :return: keyframe id
+        """
+        if self._adjuster_origin is None:
+            self._adjuster_origin = np.eye(3) if self._pose is None else np.float64(self._pose.rotation)
+        i = self._adjuster.add_keyframe(rotation, translation)
+        self._adjuster_keyframe = i, np.float64(rotation), np.float64(translation).reshape(3)
+        return i
+
+    def _apply_adjustment(self, rotation, translation):
+        """Helper method to apply the latest published correction to the current camera pose and cumulative pose
+
+        :param rotation: current rotation from world to camera coordinates
+        :param translation: current translation from world to camera coordinates
+        :return: a tuple of corrected rotation and translation or None if nothing was published
+        """
+        if self._adjuster is None or self._adjuster_keyframe is None or self._adjuster.version == self._adjuster_version:
+            return None
+        self._adjuster_version = self._adjuster.version
+        i, R, t = self._adjuster_keyframe
+        _R, _t = self._adjuster.keyframe(i)
+        self._adjuster_keyframe = i, _R, _t
+
+        Rc, tc = BundleAdjuster.correction(R, t, _R, _t)
+        rotation, translation = np.float64(rotation), np.float64(translation).reshape(3)
+        _rotation, _translation = rotation.dot(Rc), rotation.dot(tc) + translation
+
+        if self._pose is not None:
+            # orientation and position of the camera are changed the same way in cumulative pose coordinates
+            origin = self._adjuster_origin
+            center = _rotation.T.dot(_translation) - rotation.T.dot(translation)
+            self._pose = self._pose._replace(
+                rotation=origin.dot(Rc.T).dot(origin.T).dot(self._pose.rotation),
+                translation=self._pose.translation - origin.dot(center).reshape(3, 1)
+            )
+        return _rotation, _translation
+
+    def _chain_keyframe(self, rotation, translation):
+        """Helper method to add a keyframe that follows the previous frame by relative pose, i.e. ``X = R * X_last + t``.
+        The previous frame is added first if it is not a keyframe yet, e.g. after it failed to compute the pose.
+
+        :param rotation: relative rotation
+        :param translation: relative translation
+        :return: (previous keyframe id, previous rotation, previous translation, keyframe id)
+        """
+        corrected = self._apply_adjustment(*self._adjuster_pose)
+        if corrected is not None:
+            self._adjuster_pose = corrected
+
+        R, t = self._adjuster_pose
+        if self._adjuster_last is None:
+            self._adjuster_last = self._add_keyframe(R, t)
+        last = self._adjuster_last
+        self._adjuster_pose = rotation.dot(R), rotation.dot(t) + np.float64(translation).reshape(3)
+        self._adjuster_last = self._add_keyframe(*self._adjuster_pose)
+        return last, R, t, self._adjuster_last
+
+    def _break_chain(self):
+        """Helper method to mark that the previous frame is not a keyframe"""
+        self._adjuster_last = None
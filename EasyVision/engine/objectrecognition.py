@@ -7,6 +7,8 @@ from EasyVision.models import ObjectModel, ModelView
 from EasyVision.processors.base import *
 from EasyVision.processors import FeatureExtraction
 from EasyVision.processors import FeatureMatchingMixin
+from EasyVision.processors.featureextractor import MATCH_DTYPE
+from multiprocessing.pool import ThreadPool
 import cv2
 import numpy as np
 from collections import namedtuple
@@ -23,15 +25,29 @@ class ObjectRecognitionEngine(FeatureMatchingMixin, EngineBase):
     This implementation matches processed features with all the models and all model views.
 
     Actual matching is delegated to the model.
+
+    Matcher indexes over enrolled model views are built once at setup or enrollment and are rebuilt only when
+    views of a model change, thus per frame cost is only querying the indexes.
+
+    In batched mode descriptors of all enrolled views are concatenated into a single global index with a lookup
+    table of view ids. Every image is then matched with a single kNN query and matches are grouped by view
+    before being verified by the model. Ratio test is applied only if both nearest neighbours belong to the same
+    view, otherwise the nearest neighbour is only checked against the distance threshold.
+
+    If ``parallel`` is set, homography verification of model views is distributed over a thread pool.
+    Results are drawn on the calling thread only.
     """
 
-    def __init__(self, vision, feature_type=None, max_matches=10, *args, **kwargs):
+    def __init__(self, vision, feature_type=None, max_matches=10, batched=False, parallel=False,
+                 *args, **kwargs):
         """Instance initialization.
         May add FeatureExtraction processor if current stack does not contain it.
 
         :param vision: capturing source object.
         :param feature_type: specify feature type. May be left None if capturing source contains ``FeatureExtraction``
         :param max_matches: maximum number of features if using ORB features
+        :param batched: match all model views at once using a single global descriptor index
+        :param parallel: indicates whether to verify model views concurrently. May be set to the number of threads.
         """
         feature_extractor_provided = False
         if not isinstance(vision, ProcessorBase) and not isinstance(vision, VisionBase):
@@ -46,11 +62,29 @@ class ObjectRecognitionEngine(FeatureMatchingMixin, EngineBase):
         self._models = {}
         self._feature_type = feature_type
         self._max_matches = max_matches
+        self._batched = batched
+        self._global_indexes = {}
+        self._parallel = parallel
+        self._pool = None
 
         _vision = FeatureExtraction(vision, feature_type=feature_type) if not feature_extractor_provided else vision
 
         super(ObjectRecognitionEngine, self).__init__(_vision, *args, **kwargs)
 
+    def setup(self):
+        super(ObjectRecognitionEngine, self).setup()
+        self._global_indexes = {}
+        if self._parallel:
+            self._pool = ThreadPool(None if self._parallel is True else self._parallel)
+        self._train_views()
+
+    def release(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        super(ObjectRecognitionEngine, self).release()
+
     def compute(self):
         frame = self.vision.capture()
         if not frame:
@@ -88,7 +122,9 @@ class ObjectRecognitionEngine(FeatureMatchingMixin, EngineBase):
             image = self.vision.process(image)
 
         if model is not None:
-            return model.update_from_processed_frame(image, self, **kwargs)
+            model = model.update_from_processed_frame(image, self, **kwargs)
+            self._train_views()
+            return model
 
         model = ObjectModel.create_from_processed_image(name, image, **kwargs)
         if model is None:
@@ -98,6 +134,7 @@ class ObjectRecognitionEngine(FeatureMatchingMixin, EngineBase):
                 self._models[name].update(model)
             else:
                 self._models[name] = model
+            self._train_views()
         return model
 
     @property
@@ -120,5 +157,114 @@ class ObjectRecognitionEngine(FeatureMatchingMixin, EngineBase):
     def _match_models(self, frame):
         """Helper method to find all matching models with all the matching views.
         Will return MatchResults, where results will be a tuple of all the matching views."""
-        results = (model.compute(frame, self) for model in self._models.values())
-        return MatchResults(sum((i for i in results if i), ()))
+        if self._batched:
+            return MatchResults(self._match_batched(frame))
+        self._train_views()
+        for image in frame.images:
+            if not image.features or not image.feature_type:
+                raise ValueError("Image must implement features")
+        tasks = [(model, view) for model in self._models.values() for view in model]
+        return MatchResults(self._run_tasks(lambda task: task[0]._match_view(frame, task[1], self), tasks))
+
+    def _run_tasks(self, function, tasks):
+        """Helper method to run view matching tasks either sequentially or using a thread pool.
+        First item of each task must be the model. Results are drawn on the calling thread.
+
+        :return: a tuple of MatchResult
+        """
+        if self._pool is not None and len(tasks) > 1:
+            results = self._pool.map(function, tasks)
+        else:
+            results = [function(task) for task in tasks]
+
+        output = ()
+        for task, view_matches in zip(tasks, results):
+            if view_matches:
+                if task[0].display_results:
+                    task[0]._draw(view_matches)
+                output += view_matches
+        return output
+
+    def _global_index(self, feature_type):
+        """Helper method to get global index over all views with specified feature type.
+        Index is rebuilt only if views have changed.
+
+        :return: a tuple of (views, descriptors, view_ids, offsets) or None if no views enrolled
+        """
+        views = [(model, view) for model in self._models.values() for view in model if view.feature_type == feature_type]
+        key = tuple(id(view.features.descriptors) for model, view in views)
+        entry = self._global_indexes.get(feature_type)
+        if entry is not None and entry[0] == key:
+            return entry[1]
+        if entry is not None:
+            self._forget_index(entry[1][1])
+            del self._global_indexes[feature_type]
+        if not views:
+            return None
+
+        descriptors = [view.features.descriptors for model, view in views]
+        descriptors = [d.get() if isinstance(d, cv2.UMat) else d for d in descriptors]
+        sizes = np.array([len(d) for d in descriptors])
+        offsets = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+        view_ids = np.repeat(np.arange(len(views)), sizes)
+        descriptors = np.concatenate(descriptors)
+
+        self._train_index(descriptors, feature_type)
+        result = views, descriptors, view_ids, offsets
+        self._global_indexes[feature_type] = key, result
+        return result
+
+    def _match_batched(self, frame, ratio=0.7, distance_thresh=30):
+        """Helper method to match all images of the frame against all enrolled views using global indexes"""
+        tasks = []
+        for image in frame.images:
+            if not image.features or not image.feature_type:
+                raise ValueError("Image must implement features")
+            index = self._global_index(image.feature_type)
+            descriptors = image.features.descriptors
+            if index is None or descriptors is None or len(descriptors) == 0:
+                continue
+            views, train_descriptors, view_ids, offsets = index
+            if len(train_descriptors) < 2:
+                continue
+
+            indices, distances = self._knn_match(descriptors, train_descriptors, image.feature_type, 2)
+
+            mask = (indices[:, 0] >= 0) & (distances[:, 0] < distance_thresh)
+            second = np.where(indices[:, 1] >= 0, view_ids[indices[:, 1]], -1)
+            same_view = second == view_ids[indices[:, 0]]
+            mask &= ~same_view | (distances[:, 0] < distances[:, 1] * ratio)
+
+            query = np.flatnonzero(mask)
+            train = indices[query, 0]
+            ids = view_ids[train]
+            order = np.argsort(ids, kind='stable')
+            query, train, ids = query[order], train[order], ids[order]
+            bounds = np.flatnonzero(np.diff(ids)) + 1
+
+            for group in np.split(np.arange(len(ids)), bounds):
+                if not len(group):
+                    continue
+                view_id = ids[group[0]]
+                model, view = views[view_id]
+                matches = np.empty(len(group), MATCH_DTYPE).view(np.recarray)
+                matches['query'] = query[group]
+                matches['train'] = train[group] - offsets[view_id]
+                matches['distance'] = distances[query[group], 0]
+                tasks.append((model, image, view, matches))
+        return self._run_tasks(lambda task: task[0].verify_matches(*task[1:]), tasks)
+
+    def _train_views(self):
+        """Helper method to build matcher indexes for new model views and drop indexes of removed views.
+        In batched mode only global indexes are kept. Does nothing until the engine is set up."""
+        if self._matcher_h is None:
+            return
+        keep = [entry[1][1] for entry in self._global_indexes.values()]
+        if not self._batched:
+            # batched matching only queries global indexes
+            views = [view for model in self._models.values() for view in model]
+            for view in views:
+                self._train_index(view.features.descriptors, view.feature_type)
+            keep += [view.features.descriptors for view in views]
+        if len(self._indexes) > len(keep):
+            self._prune_indexes(keep)
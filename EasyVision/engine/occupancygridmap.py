@@ -4,8 +4,528 @@
 from EasyVision.engine.base import MapBase
 from EasyVision.engine.base import Pose
 import numpy as np
+import heapq
 import cv2
-from math import sin, cos, acos, asin
+
+
+class TiledGrid(object):
+    """Sparse unbounded two dimensional grid. Cells are stored in square tiles, which are allocated on demand.
+    Coordinates may be negative. Cells of tiles that were never touched are zero.
+
+    """
+
+    def __init__(self, tile_size=256, dtype=np.float32, clamp=None):
+        """Instance initialization
+
+        :param tile_size: size of the tile side in cells
+        :param dtype: type of cells
+        :param clamp: optional tuple of (min, max) cell values
+        """
+        if tile_size < 1:
+            raise ValueError("Tile size must be positive")
+        self._tile_size = tile_size
+        self._dtype = dtype
+        self._clamp = clamp
+        self._tiles = {}
+
+    @property
+    def tile_size(self):
+        """Size of the tile side in cells"""
+        return self._tile_size
+
+    @property
+    def tiles(self):
+        """Dictionary of allocated tiles indexed by (tile x, tile y)"""
+        return self._tiles
+
+    @property
+    def bounds(self):
+        """Returns (x0, y0, x1, y1) bounds of allocated tiles or None if the grid is empty"""
+        if not self._tiles:
+            return None
+        keys = np.int64(list(self._tiles))
+        x0, y0 = keys.min(axis=0) * self._tile_size
+        x1, y1 = (keys.max(axis=0) + 1) * self._tile_size
+        return int(x0), int(y0), int(x1), int(y1)
+
+    def _parts(self, x0, y0, x1, y1):
+        """Helper method to split a region into tile parts.
+
+        :return: a generator of (tile key, tile slices, region slices)
+        """
+        T = self._tile_size
+        for ty in range(y0 // T, (y1 - 1) // T + 1):
+            for tx in range(x0 // T, (x1 - 1) // T + 1):
+                _x0, _y0 = max(x0, tx * T), max(y0, ty * T)
+                _x1, _y1 = min(x1, (tx + 1) * T), min(y1, (ty + 1) * T)
+                tile = (slice(_y0 - ty * T, _y1 - ty * T), slice(_x0 - tx * T, _x1 - tx * T))
+                region = (slice(_y0 - y0, _y1 - y0), slice(_x0 - x0, _x1 - x0))
+                yield (tx, ty), tile, region
+
+    def add(self, x, y, values):
+        """Adds values to the region starting at (x, y). Only tiles touched by non zero values are allocated.
+
+        :param x: left coordinate of the region
+        :param y: top coordinate of the region
+        :param values: two dimensional array of values
+        """
+        h, w = values.shape
+        for key, tile, region in self._parts(x, y, x + w, y + h):
+            part = values[region]
+            data = self._tiles.get(key)
+            if data is None:
+                if not part.any():
+                    continue
+                data = self._tiles[key] = np.zeros((self._tile_size, self._tile_size), self._dtype)
+            data[tile] += part
+            if self._clamp is not None:
+                np.clip(data[tile], self._clamp[0], self._clamp[1], out=data[tile])
+
+    def window(self, x0, y0, x1, y1):
+        """Returns a dense copy of the region
+
+        :return: two dimensional array of (y1 - y0, x1 - x0) shape
+        """
+        result = np.zeros((y1 - y0, x1 - x0), self._dtype)
+        for key, tile, region in self._parts(x0, y0, x1, y1):
+            data = self._tiles.get(key)
+            if data is not None:
+                result[region] = data[tile]
+        return result
+
+    def todense(self):
+        """Returns a dense copy of allocated tiles and (x, y) coordinates of its top left corner"""
+        bounds = self.bounds
+        if bounds is None:
+            return np.zeros((0, 0), self._dtype), (0, 0)
+        return self.window(*bounds), bounds[:2]
+
+
+class GridPlanner(object):
+    """Shortest path planner on a binary grid with 8-connected moves. Diagonal moves may not cut corners.
+
+    Grid is padded with blocked cells, thus neighbours never need bounds checks. Cells are addressed by flat indices.
+    Two algorithms are implemented:
+        A*
+            with octile distance heuristic, a heap based open set and a closed set in a byte array
+        Jump Point Search
+            expands only jump points, which is much faster in open areas of uniform cost. Straight jumps are O(1)
+            as the next blocked cell or a cell with a forced neighbour is precomputed for every cell and direction.
+
+    Both return optimal paths. Heuristic is scaled by ``TIE_BREAK`` to prefer nodes closer to the goal among nodes
+    of equal cost, which avoids expanding whole open areas.
+    """
+
+    SQRT2 = 2 ** .5
+    TIE_BREAK = 1 + 1e-7
+
+    def __init__(self, passable):
+        """Instance initialization
+
+        :param passable: two dimensional boolean array of passable cells
+        """
+        padded = np.zeros((passable.shape[0] + 2, passable.shape[1] + 2), np.bool_)
+        padded[1:-1, 1:-1] = passable
+        self._height, self._width = padded.shape
+        self._padded = padded
+        self._free = padded.astype(np.uint8).tobytes()
+        self._jumps = None
+
+    @property
+    def shape(self):
+        """Shape of the grid"""
+        return self._height - 2, self._width - 2
+
+    def passable(self, cell):
+        """Checks whether (x, y) cell is passable"""
+        x, y = cell
+        return 0 <= x < self._width - 2 and 0 <= y < self._height - 2 and bool(self._free[(y + 1) * self._width + x + 1])
+
+    def plan(self, start, goal, jps=False):
+        """Finds the shortest path between two cells
+
+        :param start: (x, y) start cell
+        :param goal: (x, y) goal cell
+        :param jps: indicates whether to use Jump Point Search instead of A*
+        :return: a list of (x, y) cells from start to goal inclusive or an empty list if there is no path
+        """
+        start, goal = (int(start[0]), int(start[1])), (int(goal[0]), int(goal[1]))
+        if not self.passable(start) or not self.passable(goal):
+            return []
+        W = self._width
+        start, goal = (start[1] + 1) * W + start[0] + 1, (goal[1] + 1) * W + goal[0] + 1
+        came_from = self._jps(start, goal) if jps else self._astar(start, goal)
+        if goal not in came_from:
+            return []
+
+        nodes = [goal]
+        while nodes[-1] != start:
+            nodes.append(came_from[nodes[-1]])
+        nodes.reverse()
+
+        # jump points are connected by straight or diagonal segments
+        path = [divmod(start, W)]
+        for node in nodes[1:]:
+            y1, x1 = divmod(node, W)
+            y, x = path[-1]
+            dx, dy = (x1 > x) - (x1 < x), (y1 > y) - (y1 < y)
+            while (y, x) != (y1, x1):
+                x, y = x + dx, y + dy
+                path.append((y, x))
+        return [(x - 1, y - 1) for y, x in path]
+
+    def _heuristic(self, node, goal):
+        """Helper method to compute octile distance between cells"""
+        dy, dx = divmod(node, self._width)
+        gy, gx = divmod(goal, self._width)
+        dx, dy = abs(dx - gx), abs(dy - gy)
+        return (dx + dy + (GridPlanner.SQRT2 - 2) * min(dx, dy)) * GridPlanner.TIE_BREAK
+
+    def _astar(self, start, goal):
+        """Helper method implementing A*. Returns a dict of parents"""
+        free, W, SQRT2 = self._free, self._width, GridPlanner.SQRT2
+        moves = ((1, 1., 0, 0), (-1, 1., 0, 0), (W, 1., 0, 0), (-W, 1., 0, 0),
+                 (W + 1, SQRT2, 1, W), (W - 1, SQRT2, -1, W), (-W + 1, SQRT2, 1, -W), (-W - 1, SQRT2, -1, -W))
+        push, pop = heapq.heappush, heapq.heappop
+        heuristic = self._heuristic
+
+        closed = bytearray(len(free))
+        gscore = {start: 0.}
+        came_from = {start: start}
+        heap = [(heuristic(start, goal), 0., start)]
+        while heap:
+            f, h, current = pop(heap)
+            if closed[current]:
+                continue
+            closed[current] = 1
+            if current == goal:
+                break
+            g = gscore[current]
+            for delta, cost, a, b in moves:
+                neighbor = current + delta
+                if closed[neighbor] or not free[neighbor] or not free[current + a] or not free[current + b]:
+                    continue
+                tentative = g + cost
+                if tentative < gscore.get(neighbor, float('inf')):
+                    gscore[neighbor] = tentative
+                    came_from[neighbor] = current
+                    h = heuristic(neighbor, goal)
+                    push(heap, (tentative + h, h, neighbor))
+        return came_from
+
+    def _build_jumps(self):
+        """Helper method to precompute next stop cell for straight jumps in every direction.
+        A jump stops at a blocked cell or at a cell with a forced neighbour."""
+        walk = self._padded
+        h, w = walk.shape
+        blocked = ~walk
+        shifted = lambda dx, dy: np.roll(np.roll(walk, -dy, axis=0), -dx, axis=1)
+        forced = {
+            (1, 0): (shifted(0, -1) & ~shifted(-1, -1)) | (shifted(0, 1) & ~shifted(-1, 1)),
+            (-1, 0): (shifted(0, -1) & ~shifted(1, -1)) | (shifted(0, 1) & ~shifted(1, 1)),
+            (0, 1): (shifted(-1, 0) & ~shifted(-1, -1)) | (shifted(1, 0) & ~shifted(1, -1)),
+            (0, -1): (shifted(-1, 0) & ~shifted(-1, 1)) | (shifted(1, 0) & ~shifted(1, 1)),
+        }
+        index = np.arange(h * w, dtype=np.int64).reshape(h, w)
+        jumps = {}
+        for (dx, dy), _forced in forced.items():
+            events = blocked | _forced
+            if dx > 0:
+                stops = np.minimum.accumulate(np.where(events, index, h * w)[:, ::-1], axis=1)[:, ::-1]
+            elif dx < 0:
+                stops = np.maximum.accumulate(np.where(events, index, -1), axis=1)
+            elif dy > 0:
+                stops = np.minimum.accumulate(np.where(events, index, h * w)[::-1], axis=0)[::-1]
+            else:
+                stops = np.maximum.accumulate(np.where(events, index, -1), axis=0)
+            jumps[dx + dy * w] = stops.ravel()
+        self._jumps = jumps
+
+    def _jump_straight(self, node, step, goal, goal_step):
+        """Helper method to jump from node in a straight direction. Returns a jump point or None"""
+        stop = int(self._jumps[step][node])
+        if (goal - node) % step == 0 and 0 <= (goal - node) // step <= (stop - node) // step and goal_step:
+            return goal
+        return stop if self._free[stop] else None
+
+    def _jump(self, node, dx, dy, goal):
+        """Helper method to jump from node in direction (dx, dy). Returns a jump point or None"""
+        free, W = self._free, self._width
+        gy, gx = divmod(goal, W)
+        if not dx or not dy:
+            y, x = divmod(node, W)
+            return self._jump_straight(node, dx + dy * W, goal, gy == y if dx else gx == x)
+        while True:
+            if not free[node]:
+                return None
+            if node == goal:
+                return node
+            y, x = divmod(node, W)
+            if self._jump_straight(node + dx, dx, goal, gy == y) is not None or \
+                    self._jump_straight(node + dy * W, dy * W, goal, gx == x) is not None:
+                return node
+            if not free[node + dx] or not free[node + dy * W]:
+                return None
+            node += dx + dy * W
+
+    def _directions(self, node, parent):
+        """Helper method to get pruned directions to search from node given its parent"""
+        free, W = self._free, self._width
+        if parent == node:
+            return [(dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1) if (dx or dy) and
+                    free[node + dx + dy * W] and free[node + dx] and free[node + dy * W]]
+        py, px = divmod(parent, W)
+        y, x = divmod(node, W)
+        dx, dy = (x > px) - (x < px), (y > py) - (y < py)
+        directions = []
+        if dx and dy:
+            if free[node + dy * W]:
+                directions.append((0, dy))
+            if free[node + dx]:
+                directions.append((dx, 0))
+            if free[node + dx] and free[node + dy * W] and free[node + dx + dy * W]:
+                directions.append((dx, dy))
+        elif dx:
+            up, down = free[node - W], free[node + W]
+            if free[node + dx]:
+                directions.append((dx, 0))
+                if up and free[node + dx - W]:
+                    directions.append((dx, -1))
+                if down and free[node + dx + W]:
+                    directions.append((dx, 1))
+            if up:
+                directions.append((0, -1))
+            if down:
+                directions.append((0, 1))
+        else:
+            left, right = free[node - 1], free[node + 1]
+            if free[node + dy * W]:
+                directions.append((0, dy))
+                if left and free[node + dy * W - 1]:
+                    directions.append((-1, dy))
+                if right and free[node + dy * W + 1]:
+                    directions.append((1, dy))
+            if left:
+                directions.append((-1, 0))
+            if right:
+                directions.append((1, 0))
+        return directions
+
+    def _jps(self, start, goal):
+        """Helper method implementing Jump Point Search. Returns a dict of parents"""
+        if self._jumps is None:
+            self._build_jumps()
+        W, SQRT2 = self._width, GridPlanner.SQRT2
+        push, pop = heapq.heappush, heapq.heappop
+        heuristic = self._heuristic
+
+        closed = bytearray(len(self._free))
+        gscore = {start: 0.}
+        came_from = {start: start}
+        heap = [(heuristic(start, goal), 0., start)]
+        while heap:
+            f, h, current = pop(heap)
+            if closed[current]:
+                continue
+            closed[current] = 1
+            if current == goal:
+                break
+            g = gscore[current]
+            y, x = divmod(current, W)
+            for dx, dy in self._directions(current, came_from[current]):
+                node = self._jump(current + dx + dy * W, dx, dy, goal)
+                if node is None or closed[node]:
+                    continue
+                ny, nx = divmod(node, W)
+                steps = max(abs(nx - x), abs(ny - y))
+                tentative = g + steps * (SQRT2 if dx and dy else 1.)
+                if tentative < gscore.get(node, float('inf')):
+                    gscore[node] = tentative
+                    came_from[node] = current
+                    h = heuristic(node, goal)
+                    push(heap, (tentative + h, h, node))
+        return came_from
+
+
+class DStarLitePlanner(GridPlanner):
+    """Incremental shortest path planner implementing D* Lite for a fixed goal.
+
+    Search runs from the goal towards the start, thus g values remain valid as the start moves.
+    When passability of cells changes only the vertices around changed cells are repaired, so replanning
+    while moving through a mostly unchanged map is much cheaper than a full search.
+    Search state is kept in dicts, thus memory is only used for visited cells.
+
+    Costs are integers in ``COST`` units per cell, thus keys are compared exactly. Float costs accumulated in a
+    different order after repairs would otherwise break ties inconsistently.
+    """
+
+    COST = 1000000
+    DIAGONAL_COST = int(round(COST * GridPlanner.SQRT2))
+
+    def __init__(self, passable, goal):
+        """Instance initialization
+
+        :param passable: two dimensional boolean array of passable cells
+        :param goal: (x, y) goal cell
+        """
+        super(DStarLitePlanner, self).__init__(passable)
+        W = self._width
+        self._free = bytearray(self._free)
+        self._moves = tuple((dx + dy * W, DStarLitePlanner.DIAGONAL_COST if dx and dy else DStarLitePlanner.COST, dx, dy * W)
+                            for dx in (-1, 0, 1) for dy in (-1, 0, 1) if dx or dy)
+        self._goal_cell = int(goal[0]), int(goal[1])
+        self._goal = (self._goal_cell[1] + 1) * W + self._goal_cell[0] + 1
+        self._last = None
+        self._km = 0
+        self._g = {}
+        self._rhs = {self._goal: 0}
+        self._open = {}
+        self._heap = []
+        self._expanded = 0
+        self._push(self._goal)
+
+    @property
+    def goal(self):
+        """(x, y) goal cell"""
+        return self._goal_cell
+
+    @property
+    def expanded(self):
+        """Number of vertices expanded by the last ``replan``"""
+        return self._expanded
+
+    def update(self, passable):
+        """Updates passability of cells. Vertices around changed cells are repaired during the next ``replan``.
+
+        :param passable: two dimensional boolean array of passable cells of the same shape
+        :return: number of changed cells
+        """
+        if passable.shape != self.shape:
+            raise ValueError("Passable grid shape must not change")
+        changed = np.flatnonzero(self._padded[1:-1, 1:-1] != passable)
+        if not len(changed):
+            return 0
+        self._padded[1:-1, 1:-1] = passable
+        W, free = self._width, self._free
+        changed = (changed // (W - 2) + 1) * W + changed % (W - 2) + 1
+        for cell in changed.tolist():
+            free[cell] = not free[cell]
+        self._jumps = None
+
+        # edges through a changed cell connect only cells of its 3x3 neighbourhood
+        offsets = (0, ) + tuple(move[0] for move in self._moves)
+        for cell in set(cell + offset for cell in changed.tolist() for offset in offsets):
+            self._update_vertex(cell)
+        return len(changed)
+
+    def replan(self, start):
+        """Finds the shortest path from start to the goal reusing previous search state
+
+        :param start: (x, y) start cell
+        :return: a list of (x, y) cells from start to goal inclusive or an empty list if there is no path
+        """
+        if not self.passable(start) or not self.passable(self._goal_cell):
+            return []
+        W, inf = self._width, float('inf')
+        start = (int(start[1]) + 1) * W + int(start[0]) + 1
+        if self._last is not None:
+            self._km += self._distance(self._last, start)
+        else:
+            # keys of the first search depend on the start
+            self._heap = [self._key(cell, start) + (cell, ) for cell in self._open]
+            self._open = dict((cell, key[:2]) for key in self._heap for cell in key[2:])
+            heapq.heapify(self._heap)
+        self._last = start
+        self._compute(start)
+
+        g = self._g
+        if g.get(start, inf) == inf:
+            return []
+        path, current = [start], start
+        while current != self._goal and len(path) <= len(g):
+            current = min(self._successors(current), key=lambda item: item[1] + g.get(item[0], inf))[0]
+            path.append(current)
+        if current != self._goal:
+            return []
+        return [(cell % W - 1, cell // W - 1) for cell in path]
+
+    def _distance(self, node, goal):
+        """Helper method to compute octile distance between cells in cost units"""
+        dy, dx = divmod(node, self._width)
+        gy, gx = divmod(goal, self._width)
+        dx, dy = abs(dx - gx), abs(dy - gy)
+        return DStarLitePlanner.COST * (dx + dy) + (DStarLitePlanner.DIAGONAL_COST - 2 * DStarLitePlanner.COST) * min(dx, dy)
+
+    def _successors(self, cell):
+        """Helper method to iterate over (neighbour, cost) pairs. Diagonal moves may not cut corners."""
+        free = self._free
+        if not free[cell]:
+            return
+        for delta, cost, a, b in self._moves:
+            neighbor = cell + delta
+            if free[neighbor] and free[cell + a] and free[cell + b]:
+                yield neighbor, cost
+
+    def _key(self, cell, start):
+        """Helper method to compute priority of the cell"""
+        inf = float('inf')
+        value = min(self._g.get(cell, inf), self._rhs.get(cell, inf))
+        return value + self._distance(start, cell) + self._km, value
+
+    def _push(self, cell, start=None):
+        """Helper method to add or move the cell in the open set. Outdated heap entries are skipped lazily."""
+        key = self._key(cell, self._goal if start is None else start)
+        self._open[cell] = key
+        heapq.heappush(self._heap, key + (cell, ))
+
+    def _update_vertex(self, cell, start=None):
+        """Helper method to recompute rhs of the cell and its membership in the open set"""
+        inf = float('inf')
+        g, rhs = self._g, self._rhs
+        if cell != self._goal:
+            rhs[cell] = min([cost + g.get(neighbor, inf) for neighbor, cost in self._successors(cell)] or [inf])
+        if g.get(cell, inf) != rhs.get(cell, inf):
+            self._push(cell, self._last if start is None else start)
+        else:
+            self._open.pop(cell, None)
+
+    def _compute(self, start):
+        """Helper method to expand inconsistent vertices until the start is consistent"""
+        inf = float('inf')
+        g, rhs, heap, opened = self._g, self._rhs, self._heap, self._open
+        pop = heapq.heappop
+        expanded = 0
+        while heap:
+            k1, k2, cell = heap[0]
+            if opened.get(cell) != (k1, k2):
+                pop(heap)
+                continue
+            start_rhs = rhs.get(start, inf)
+            if (k1, k2) >= self._key(start, start) and start_rhs == g.get(start, inf):
+                break
+            key = self._key(cell, start)
+            if (k1, k2) < key:
+                self._push(cell, start)
+                continue
+            pop(heap)
+            del opened[cell]
+            expanded += 1
+            if g.get(cell, inf) > rhs.get(cell, inf):
+                value = g[cell] = rhs[cell]
+                # only rhs of neighbours can decrease, thus they are not recomputed from all successors
+                for neighbor, cost in self._successors(cell):
+                    if value + cost < rhs.get(neighbor, inf):
+                        rhs[neighbor] = value + cost
+                        if g.get(neighbor, inf) != value + cost:
+                            self._push(neighbor, start)
+                        else:
+                            opened.pop(neighbor, None)
+            else:
+                g[cell] = inf
+                self._update_vertex(cell, start)
+                for delta, cost, a, b in self._moves:
+                    self._update_vertex(cell + delta, start)
+        self._expanded = expanded
 
 
 class OccupancyGridMap(MapBase):
@@ -13,12 +533,16 @@ class OccupancyGridMap(MapBase):
     Should be used with conjunction with VisualOdometry engine.
     Uses 3d feature points of the Pose. Z coordinate denotes forward, and Y coordinate - up.
 
+    Map is either a dense array of a fixed size or an unbounded ``TiledGrid``, in which case updates only touch
+    tiles in view. Cells hold log odds of being occupied, optionally clamped to keep the map responsive to changes.
     """
 
-    def __init__(self, _map, scale=.001, theta=.01, alpha=.6, beta=-.4, min_y=-10, max_y=5000, max_d=100000, poses=None, *args, **kwargs):
+    def __init__(self, _map, scale=.001, theta=.01, alpha=.6, beta=-.4, min_y=-10, max_y=5000, max_d=100000, poses=None,
+                 tile_size=256, clamp=None, *args, **kwargs):
         """Instance initialization.
 
-        :param _map: Accepts either a tuple of (map_width, map_height) or a np.float32 two dimensional array
+        :param _map: Accepts either a tuple of (map_width, map_height), a np.float32 two dimensional array or
+                     None for an unbounded tiled map
         :param scale: Scale of the map
         :param theta: obstacle reading spread
         :param alpha: obstacle weight
@@ -27,6 +551,8 @@ class OccupancyGridMap(MapBase):
         :param max_y: maximum Y coordinate of the feature
         :param max_d: maximum distance of the feature
         :param poses: a list of poses to initialize a map with
+        :param tile_size: size of the tile side for the tiled map
+        :param clamp: optional tuple of (min, max) log odds
         """
         if poses is None:
             poses = []
@@ -38,11 +564,10 @@ class OccupancyGridMap(MapBase):
             self._map = cv2.normalize(_map, None, alpha=-1, beta=1, norm_type=cv2.NORM_MINMAX, dtype=cv2.CV_32FC1)
         elif isinstance(_map, tuple) and len(_map) == 2:
             self._map = np.zeros(_map + (1,), dtype=np.float32)
+        elif _map is None:
+            self._map = TiledGrid(tile_size, np.float32, clamp)
         else:
-            raise TypeError("Map must be either two dimentional numpy array or a tuple e.g. (width, height)")
-
-        self._obstacles = np.zeros(self._map.shape, dtype=self._map.dtype)
-        self._sensor_model = np.zeros(self._map.shape, dtype=self._map.dtype)
+            raise TypeError("Map must be either two dimentional numpy array, a tuple e.g. (width, height) or None")
 
         self._poses = poses
         self._scale = scale
@@ -52,12 +577,36 @@ class OccupancyGridMap(MapBase):
         self._alpha = alpha
         self._beta = beta
         self._theta = theta
+        self._clamp = clamp
+        self._version = 0
+        self._cache_version = None
+        self._cache_clearance = None
+        self._planners = {}
+        self._dstar = None
+        self._dstar_key = None
+        self._dstar_version = None
         super(OccupancyGridMap, self).__init__(*args, **kwargs)
 
     @property
     def map_raw(self):
+        """Returns the map. Tiled map is converted into a dense array with the top left corner at ``origin``"""
+        if isinstance(self._map, TiledGrid):
+            return self._map.todense()[0]
         return self._map
 
+    @property
+    def origin(self):
+        """Returns (x, y) map coordinates of the top left corner of ``map_raw``"""
+        if isinstance(self._map, TiledGrid):
+            bounds = self._map.bounds
+            return tuple(bounds[:2]) if bounds is not None else (0, 0)
+        return 0, 0
+
+    @property
+    def tiled(self):
+        """Indicates whether the map is an unbounded tiled map"""
+        return isinstance(self._map, TiledGrid)
+
     @property
     def pose(self):
         return self._poses[-1]
@@ -103,46 +652,175 @@ class OccupancyGridMap(MapBase):
         scale = kwargs.get('scale', 1.0)
         max_d = kwargs.get('max_d', self._max_d)
 
-        R, t = pose.rotation, pose.translation
-
-        pts = np.float32([[[a] for a in pt] for pt in pose.features.points3d if self._min_y < pt[1] < self._max_y])
-
-        self._obstacles[:] = 0
-        self._sensor_model[:] = 0
-
-        for pt in pts:
-            dd = (pt[0][0] ** 2 + pt[2][0] ** 2) ** .5
-            a = acos(pt[0][0] / dd)
+        R, t = np.float64(pose.rotation), np.float64(pose.translation).reshape(3)
+
+        pts = np.float64(pose.features.points3d).reshape(-1, 3)
+        pts = pts[(self._min_y < pts[:, 1]) & (pts[:, 1] < self._max_y)]
+        dd = np.hypot(pts[:, 0], pts[:, 2])
+        pts, dd = pts[dd > 0], dd[dd > 0]
+        a = np.arccos(np.clip(pts[:, 0] / dd, -1, 1))
+
+        # all points and arcs are transformed to the map coordinates at once, only x and z coordinates are used
+        _arc = np.zeros((2, len(pts), 3))
+        _arc[0, :, 0], _arc[0, :, 2] = dd * np.cos(a + theta), dd * np.sin(a + theta)
+        _arc[1, :, 0], _arc[1, :, 2] = dd * np.cos(a - theta), dd * np.sin(a - theta)
+        p = ((pts * scale).dot(R.T) + t)[:, ::2] * self._scale
+        arc = ((_arc * scale).dot(R.T) + t)[:, :, ::2] * self._scale
+        origin = t[::2] * self._scale
+        ddd = np.hypot(*(arc[0] - arc[1]).T)
+
+        bounds = None if self.tiled else (0, 0, self._map.shape[1], self._map.shape[0])
+        near = dd < max_d
+        regions = (
+            (self._obstacles_mask(np.int32(p[near]), np.int32(np.maximum(1, ddd[near] / 2)), bounds), alpha),
+            (self._freespace_mask(np.int32(origin), np.int32(arc), bounds), beta)
+        )
+        self._add_regions([(region, value) for region, value in regions if region is not None])
 
-            _arc = np.float32([
-                [[0], [0], [0]],
-                [[dd * cos(a + theta)], [0], [dd * sin(a + theta)]],
-                [[dd * cos(a - theta)], [0], [dd * sin(a - theta)]]
-            ])
-
-            p = (R.dot(pt * scale) + t) * self._scale
-            arc = np.float32([(R.dot(ap * scale) + t) * self._scale for ap in _arc])
-
-            _ddd = arc[1] - arc[2]
-            ddd = (_ddd[0][0] ** 2 + _ddd[2][0] ** 2) ** .5
-
-            if dd < max_d:
-                self._obstacles = cv2.circle(self._obstacles, (int(p[0][0]), int(p[2][0])), int(max(1, ddd / 2)), (alpha), -1)
-            __arc = np.int32([[pt[0][0], pt[2][0]] for pt in arc])
-            self._sensor_model = cv2.fillPoly(self._sensor_model, [__arc], (beta))
-
-        self._map = self._map + self._obstacles + self._sensor_model
         if self.display_results:
             self.draw()
 
         return pose
 
+    def _add_regions(self, regions):
+        """Helper method to add values to the map cells covered by region masks.
+        Only the bounding box of the regions is updated.
+
+        :param regions: a list of ((x, y, mask), value)
+        """
+        if not regions:
+            return
+        self._version += 1
+        x0 = min(x for (x, y, mask), value in regions)
+        y0 = min(y for (x, y, mask), value in regions)
+        x1 = max(x + mask.shape[1] for (x, y, mask), value in regions)
+        y1 = max(y + mask.shape[0] for (x, y, mask), value in regions)
+        delta = np.zeros((y1 - y0, x1 - x0), np.float32)
+        for (x, y, mask), value in regions:
+            delta[y - y0:y - y0 + mask.shape[0], x - x0:x - x0 + mask.shape[1]][mask] += value
+
+        if self.tiled:
+            self._map.add(x0, y0, delta)
+        else:
+            grid = self._map.reshape(self._map.shape[:2])[y0:y1, x0:x1]
+            grid += delta
+            if self._clamp is not None:
+                np.clip(grid, self._clamp[0], self._clamp[1], out=grid)
+
+    @staticmethod
+    def _clip(x0, y0, x1, y1, bounds):
+        """Helper method to clip a region to bounds. Returns None if the region is empty"""
+        if bounds is not None:
+            x0, y0 = max(x0, bounds[0]), max(y0, bounds[1])
+            x1, y1 = min(x1, bounds[2]), min(y1, bounds[3])
+        if x0 >= x1 or y0 >= y1:
+            return None
+        return int(x0), int(y0), int(x1), int(y1)
+
+    @staticmethod
+    def _obstacles_mask(centers, radii, bounds=None):
+        """Helper method to rasterize the union of discs.
+        Discs of the same radius are rasterized at once using a precomputed stencil.
+
+        :param centers: Nx2 array of (x, y) disc centers
+        :param radii: N disc radii
+        :param bounds: optional (x0, y0, x1, y1) region to clip the result to
+        :return: (x, y, mask) of the region covered by discs or None
+        """
+        if not len(centers):
+            return None
+        region = OccupancyGridMap._clip(*(tuple((centers - radii[:, None]).min(axis=0)) +
+                                          tuple((centers + radii[:, None]).max(axis=0) + 1)), bounds=bounds)
+        if region is None:
+            return None
+        x0, y0, x1, y1 = region
+        mask = np.zeros((y1 - y0, x1 - x0), np.bool_)
+        for radius in np.unique(radii).tolist():
+            y, x = np.mgrid[-radius:radius + 1, -radius:radius + 1]
+            inside = x * x + y * y <= radius * radius
+            cells = centers[radii == radius][:, None, :] + np.stack((x[inside], y[inside]), axis=1)[None]
+            cells = cells.reshape(-1, 2) - (x0, y0)
+            valid = (cells[:, 0] >= 0) & (cells[:, 0] < x1 - x0) & (cells[:, 1] >= 0) & (cells[:, 1] < y1 - y0)
+            mask[cells[valid, 1], cells[valid, 0]] = True
+        return x0, y0, mask
+
+    @staticmethod
+    def _freespace_mask(origin, arcs, bounds=None):
+        """Helper method to rasterize the union of triangles sharing the origin vertex.
+        The union of such triangles is star shaped with respect to the origin, thus it is rasterized by casting
+        rays from the origin: every triangle updates the maximum free range of the angular bins it spans and
+        a cell is free if it is closer to the origin than the free range of its bin.
+
+        :param origin: (x, y) common triangle vertex
+        :param arcs: 2xNx2 array of the other two (x, y) vertices of each triangle
+        :param bounds: optional (x0, y0, x1, y1) region to clip the result to
+        :return: (x, y, mask) of the region covered by triangles or None
+        """
+        a, b = np.float64(arcs[0] - origin), np.float64(arcs[1] - origin)
+        if not len(a):
+            return None
+
+        vertices = np.concatenate((arcs[0], arcs[1], [origin]))
+        region = OccupancyGridMap._clip(*(tuple(vertices.min(axis=0)) + tuple(vertices.max(axis=0) + 1)), bounds=bounds)
+        if region is None:
+            return None
+        x0, y0, x1, y1 = region
+
+        reach = np.hypot(*np.concatenate((a, b)).T).max() + 1
+        bins = max(8, int(np.ceil(4 * np.pi * reach)))
+        step = 2 * np.pi / bins
+
+        angle_a, angle_b = np.arctan2(a[:, 1], a[:, 0]), np.arctan2(b[:, 1], b[:, 0])
+        span = (angle_b - angle_a + np.pi) % (2 * np.pi) - np.pi
+        start = np.where(span >= 0, angle_a, angle_b) % (2 * np.pi)
+        span = np.abs(span)
+
+        first = np.int64(np.floor(start / step))
+        counts = np.int64(np.floor((start + span) / step)) - first + 1
+        triangle = np.repeat(np.arange(len(a)), counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        index = first[triangle] + offsets
+        angles = np.clip((index + .5) * step, start[triangle], start[triangle] + span[triangle])
+
+        # distance from the origin to the edge a-b along the ray
+        direction = np.stack((np.cos(angles), np.sin(angles)), axis=1)
+        edge = b[triangle] - a[triangle]
+        denominator = direction[:, 0] * edge[:, 1] - direction[:, 1] * edge[:, 0]
+        numerator = a[triangle, 0] * edge[:, 1] - a[triangle, 1] * edge[:, 0]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ranges = np.where(np.abs(denominator) > 1e-9, numerator / denominator,
+                              np.maximum(np.hypot(*a[triangle].T), np.hypot(*b[triangle].T)))
+
+        free = np.full(bins, -1.0)
+        np.maximum.at(free, index % bins, ranges)
+
+        # a cell is touched by a ray if the ray passes within half a cell from its center, thus nearer cells
+        # look up the maximum free range over a wider window of bins, doubling window radius on each level
+        levels = [free]
+        while 2 ** (len(levels) - 1) < bins:
+            radius = max(1, 2 ** (len(levels) - 2))
+            levels.append(np.maximum(levels[-1], np.maximum(np.roll(levels[-1], radius), np.roll(levels[-1], -radius))))
+        levels = np.stack(levels)
+
+        y, x = np.mgrid[y0:y1, x0:x1]
+        dx, dy = x - origin[0], y - origin[1]
+        distance = np.hypot(dx, dy)
+        cell_bins = np.int64(np.floor((np.arctan2(dy, dx) % (2 * np.pi)) / step)) % bins
+        with np.errstate(divide='ignore'):
+            window = np.floor(.5 / (np.maximum(distance, 1e-9) * step))
+        level = np.minimum(np.ceil(np.log2(np.maximum(window, 1))) + (window > 0), len(levels) - 1)
+        mask = distance <= levels[np.int64(level), cell_bins] + .5
+        return x0, y0, mask
+
     def draw(self, path=None, display=True):
         """Helper method to draw the map"""
         if not len(self._poses):
             return
 
-        disp = self._map
+        disp = self.map_raw
+        if not disp.size:
+            return
+        ox, oy = self.origin
         #disp = cv2.inRange(self._map, (0), (255))
         disp = cv2.normalize(disp, None, alpha=0, beta=255, norm_type=cv2.NORM_MINMAX, dtype=cv2.CV_8U)
         disp = cv2.cvtColor(disp, cv2.COLOR_GRAY2BGR)
@@ -150,13 +828,13 @@ class OccupancyGridMap(MapBase):
         tl = self._poses[0].translation * self._scale
         for p in self._poses[1:]:
             t = p.translation * self._scale
-            cv2.line(disp, (int(tl[0][0]), int(tl[2][0])), (int(t[0][0]), int(t[2][0])), (0, 0, 255))
+            cv2.line(disp, (int(tl[0][0]) - ox, int(tl[2][0]) - oy), (int(t[0][0]) - ox, int(t[2][0]) - oy), (0, 0, 255))
             tl = t
 
         if path is not None:
             tl = path[0]
             for t in path[1:]:
-                cv2.line(disp, (int(tl[0]), int(tl[1])), (int(t[0]), int(t[1])), (0, 255, 0))
+                cv2.line(disp, (int(tl[0]) - ox, int(tl[1]) - oy), (int(t[0]) - ox, int(t[1]) - oy), (0, 255, 0))
                 tl = t
 
         if display:
@@ -164,55 +842,97 @@ class OccupancyGridMap(MapBase):
         else:
             return disp
 
-    def plan(self, target, radius, **kwargs):
+    def plan(self, target, radius, jps=False, **kwargs):
         """Finds the shortest path in the map between current and target poses.
         Only uses translation part of the Pose.
 
+        Obstacles are inflated using a distance transform of the free space, which is cached until the map changes.
+        If the start or the goal are closer to obstacles than the radius, inflation is reduced, so that the robot
+        is able to leave a narrow place.
+
         :param target: Pose with valid coordinates. Will be translated to map coordinates using scale.
-        :param radius: map blurring radius in world coordinates. Will be scaled. Specifies how far the path should be away from obstacles.
+        :param radius: obstacle inflation radius in world coordinates. Will be scaled. Specifies how far the path should be away from obstacles.
+        :param jps: indicates whether to use Jump Point Search, which is faster on large open maps
         :returns: an iterable of (x, y) scaled map coordinates.
         """
+        ox, oy = self.origin
+        start = (int(self.pose.translation[0][0] * self._scale) - ox, int(self.pose.translation[2][0] * self._scale) - oy)
+        goal = (int(target.translation[0][0] * self._scale) - ox, int(target.translation[2][0] * self._scale) - oy)
 
-        start = (int(self.pose.translation[0][0] * self._scale), int(self.pose.translation[2][0] * self._scale))
-        goal = (int(target.translation[0][0] * self._scale), int(target.translation[2][0] * self._scale))
-        bs = int(radius * self._scale + .5)
-
-        grid = cv2.blur(self._map, (bs, bs))
-        grid += self._map
-        grid = cv2.normalize(grid, None, alpha=-1, beta=1, norm_type=cv2.NORM_MINMAX, dtype=cv2.CV_32FC1)
-
-        grid = grid.tolist()
+        clearance = self._clearance()
+        h, w = clearance.shape
+        if not all(0 <= x < w and 0 <= y < h for x, y in (start, goal)):
+            return np.zeros((0, 2), np.float32)
+        limit = min(radius * self._scale, clearance[start[1], start[0]], clearance[goal[1], goal[0]])
 
-        h, w = self._map.shape
+        path = self._planner(limit).plan(start, goal, jps)
+        return (np.float32(path).reshape(-1, 2) + (ox, oy)) / self._scale
 
-        def heuristic(_c, _a, _b):
-            cx, cy = _c
-            ax, ay = _a
-            bx, by = _b
-            adx = ax - cx
-            ady = ay - cy
-            bdx = bx - ax
-            bdy = by - ay
-            dist = (bdx ** 2 + bdy ** 2) ** .5
-            if dist == 0:
-                return 0
-            c = grid[ay][ax] + grid[by][bx] + 4.0
-            return c + dist + 1 - (adx * bdx + ady * bdy) / dist
+    def replan(self, target, radius, **kwargs):
+        """Finds the shortest path in the map between current and target poses reusing the previous search.
+        Meant to be called every frame, e.g. after ``update``. Only cells whose passability changed since
+        the previous call are repaired using D* Lite. Search is started over if the target, the inflation radius or
+        bounds of the tiled map change.
 
-        deltas = ((0, 1), (0, -1), (1, 0), (-1, 0), (1, 1), (1, -1), (-1, 1), (-1, -1))
+        Inflation is reduced to the clearance of the goal. If the current pose is closer to obstacles than
+        the radius, free cells within the radius around it are kept passable until the robot leaves the inflated zone.
 
-        def neighbors(current):
-            for delta in deltas:
-                x, y = current[0] + delta[0], current[1] + delta[1]
-                if x < 0 or y < 0:
-                    continue
-                if x >= w or y >= h:
-                    continue
-                if grid[y][x] > 0:
-                    continue
-
-                yield x, y
-
-        path = np.float32(tuple(self.astar(start, goal, neighbors, heuristic))) / self._scale
-
-        return path[::-1]
+        :param target: Pose with valid coordinates. Will be translated to map coordinates using scale.
+        :param radius: obstacle inflation radius in world coordinates. Will be scaled.
+        :returns: an iterable of (x, y) scaled map coordinates.
+        """
+        ox, oy = self.origin
+        start = (int(self.pose.translation[0][0] * self._scale) - ox, int(self.pose.translation[2][0] * self._scale) - oy)
+        goal = (int(target.translation[0][0] * self._scale) - ox, int(target.translation[2][0] * self._scale) - oy)
+
+        clearance = self._clearance()
+        h, w = clearance.shape
+        if not all(0 <= x < w and 0 <= y < h for x, y in (start, goal)):
+            return np.zeros((0, 2), np.float32)
+        limit = min(radius * self._scale, clearance[goal[1], goal[0]])
+        passable = self._passable(limit)
+
+        # free cells around the start stay passable, so that the robot may leave the inflated zone
+        escape = None
+        if clearance[start[1], start[0]] < limit:
+            escape = start
+            r = int(np.ceil(limit))
+            x0, y0 = max(start[0] - r, 0), max(start[1] - r, 0)
+            x1, y1 = min(start[0] + r + 1, w), min(start[1] + r + 1, h)
+            ys, xs = np.ogrid[y0:y1, x0:x1]
+            passable[y0:y1, x0:x1] |= ((xs - start[0]) ** 2 + (ys - start[1]) ** 2 <= limit ** 2) & \
+                                      (clearance[y0:y1, x0:x1] > 0)
+
+        key = goal, radius, (ox, oy), clearance.shape
+        if self._dstar is None or self._dstar_key != key:
+            self._dstar = DStarLitePlanner(passable, goal)
+            self._dstar_key = key
+        elif self._dstar_version != (self._version, escape):
+            self._dstar.update(passable)
+        self._dstar_version = self._version, escape
+
+        path = self._dstar.replan(start)
+        return (np.float32(path).reshape(-1, 2) + (ox, oy)) / self._scale
+
+    def _passable(self, limit):
+        """Helper method to get cells at least ``limit`` away from obstacles"""
+        clearance = self._clearance()
+        return clearance >= limit if limit > 0 else clearance > 0
+
+    def _clearance(self):
+        """Helper method to get distance from every cell to the nearest obstacle. Cached until the map changes"""
+        if self._cache_version != self._version:
+            self._cache_version = self._version
+            self._planners = {}
+            raw = self.map_raw
+            free = np.uint8(raw.reshape(raw.shape[:2]) <= 0)
+            self._cache_clearance = cv2.distanceTransform(free, cv2.DIST_L2, cv2.DIST_MASK_PRECISE)
+        return self._cache_clearance
+
+    def _planner(self, limit):
+        """Helper method to get a GridPlanner for cells at least ``limit`` away from obstacles. Cached until the map changes"""
+        clearance = self._clearance()
+        planner = self._planners.get(limit)
+        if planner is None:
+            planner = self._planners[limit] = GridPlanner(self._passable(limit))
+        return planner
@@ -0,0 +1,351 @@
+# -*- coding: utf-8 -*-
+"""Implements sparse pose graph optimization used to correct odometry drift.
+
+"""
+
+from EasyVision.engine.base import Pose
+import threading as mt
+import numpy as np
+
+scipy_available = False
+try:
+    import scipy.sparse as sparse
+    import scipy.sparse.linalg as sparse_linalg
+    scipy_available = True
+except ImportError:
+    pass
+
+
+def _skew(v):
+    """Helper function to build Nx3x3 skew symmetric matrices from Nx3 vectors"""
+    S = np.zeros(v.shape[:-1] + (3, 3))
+    S[..., 0, 1], S[..., 0, 2], S[..., 1, 2] = -v[..., 2], v[..., 1], -v[..., 0]
+    S[..., 1, 0], S[..., 2, 0], S[..., 2, 1] = v[..., 2], -v[..., 1], v[..., 0]
+    return S
+
+
+def _exp(v):
+    """Helper function to convert Nx3 rotation vectors into Nx3x3 rotation matrices"""
+    theta = np.linalg.norm(v, axis=-1)[..., None, None]
+    K = _skew(v)
+    small = theta < 1e-8
+    theta = np.where(small, 1., theta)
+    a = np.where(small, 1., np.sin(theta) / theta)
+    b = np.where(small, .5, (1 - np.cos(theta)) / theta ** 2)
+    return np.eye(3) + a * K + b * np.matmul(K, K)
+
+
+def _log(R):
+    """Helper function to convert Nx3x3 rotation matrices into Nx3 rotation vectors"""
+    cos = np.clip((np.trace(R, axis1=-2, axis2=-1) - 1) / 2, -1, 1)
+    theta = np.arccos(cos)
+    w = np.stack((R[..., 2, 1] - R[..., 1, 2], R[..., 0, 2] - R[..., 2, 0], R[..., 1, 0] - R[..., 0, 1]), axis=-1)
+    sin = np.sin(theta)
+    small = sin < 1e-6
+    scale = np.where(small, .5, theta / (2 * np.where(small, 1., sin)))
+    v = w * scale[..., None]
+
+    # close to pi the axis is recovered from the diagonal
+    near_pi = small & (cos < 0)
+    if np.any(near_pi):
+        Rp = R[near_pi]
+        axis = np.sqrt(np.maximum((np.diagonal(Rp, axis1=-2, axis2=-1) + 1) / 2, 0))
+        axis *= np.where(np.stack((np.ones(len(Rp)), Rp[:, 0, 1] + Rp[:, 1, 0], Rp[:, 0, 2] + Rp[:, 2, 0]), axis=-1) < 0, -1, 1)
+        v[near_pi] = axis * theta[near_pi][:, None]
+    return v
+
+
+def _right_jacobian_inv(v):
+    """Helper function to compute inverse right Jacobians of SO(3) for Nx3 rotation vectors"""
+    theta = np.linalg.norm(v, axis=-1)[..., None, None]
+    K = _skew(v)
+    small = theta < 1e-6
+    theta = np.where(small, 1., theta)
+    c = np.where(small, 1. / 12, 1 / theta ** 2 - (1 + np.cos(theta)) / (2 * theta * np.sin(theta)))
+    return np.eye(3) + .5 * K + c * np.matmul(K, K)
+
+
+class PoseGraphOptimizer(object):
+    """Sparse pose graph optimizer.
+
+    Nodes are poses with rotation and translation, edges are relative transforms between nodes measured either by
+    odometry or by loop closure detection. The edge from i to j with measurement Z means ``T_j = T_i * Z``.
+    Graph is optimized with Levenberg-Marquardt, where the sparse normal equations are solved with SciPy. The first node
+    is fixed.
+
+    Optimization is incremental in that it always starts from the current estimate and new nodes are initialized by
+    chaining odometry, thus only loop closures introduce errors to be optimized. If ``background`` is set,
+    ``request`` returns immediately and optimization runs on a separate thread on a snapshot of the graph.
+    Results are published atomically. Nodes added during optimization are moved together with the
+    last node of the snapshot.
+    """
+
+    def __init__(self, iterations=10, tolerance=1e-6, background=True):
+        """Instance initialization
+
+        :param iterations: maximum number of Levenberg-Marquardt iterations per optimization
+        :param tolerance: relative decrease of the error at which to stop iterating
+        :param background: indicates whether to run optimization on a separate thread
+        """
+        if not scipy_available:
+            raise NotImplementedError("SciPy library not imported")
+        self._iterations = iterations
+        self._tolerance = tolerance
+        self._background = background
+        self._rotations = []
+        self._translations = []
+        self._edges = []
+        self._lock = mt.Condition(mt.Lock())
+        self._pending = False
+        self._busy = False
+        self._running = False
+        self._thread = None
+        self._version = 0
+        self._error = 0.0
+
+    def setup(self):
+        """Starts the background thread if required"""
+        if self._background and self._thread is None:
+            self._running = True
+            self._thread = mt.Thread(target=self.run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def release(self):
+        """Stops the background thread. Pending optimization is dropped"""
+        if self._thread is not None:
+            with self._lock:
+                self._running = False
+                self._lock.notify_all()
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        self.setup()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+    def __len__(self):
+        return len(self._rotations)
+
+    @property
+    def edges(self):
+        """A list of edges as (i, j, rotation, translation, sqrt information)"""
+        return self._edges
+
+    @property
+    def version(self):
+        """Number of published optimizations"""
+        return self._version
+
+    @property
+    def error(self):
+        """Weighted squared error after the last optimization"""
+        return self._error
+
+    def add_node(self, rotation, translation):
+        """Adds a node with initial estimate
+
+        :param rotation: 3x3 rotation matrix
+        :param translation: translation vector
+        :return: node id
+        """
+        with self._lock:
+            self._rotations.append(np.float64(rotation).reshape(3, 3))
+            self._translations.append(np.float64(translation).reshape(3))
+            return len(self._rotations) - 1
+
+    def add_edge(self, i, j, rotation, translation, information=None):
+        """Adds a relative transform measurement between nodes
+
+        :param i: id of the node the measurement is relative to
+        :param j: id of the measured node
+        :param rotation: 3x3 relative rotation matrix
+        :param translation: relative translation vector
+        :param information: 6x6 information matrix of rotation vector and translation errors, a vector of 6 diagonal
+                            values or a scalar. Defaults to identity.
+        """
+        if information is None:
+            information = np.eye(6)
+        information = np.float64(information)
+        if information.ndim < 2:
+            information = np.eye(6) * information
+        sqrt_information = np.linalg.cholesky(information).T
+        with self._lock:
+            if not (0 <= i < len(self._rotations) and 0 <= j < len(self._rotations)):
+                raise ValueError("Edge must connect existing nodes")
+            self._edges.append((i, j, np.float64(rotation).reshape(3, 3), np.float64(translation).reshape(3), sqrt_information))
+
+    def add_pose(self, pose, last_pose, information=None):
+        """Adds a node chained to the previous node by odometry.
+
+        :param pose: Pose as measured by odometry
+        :param last_pose: Pose of the previous node as measured by odometry, i.e. relative transform between poses
+                          is used as the edge measurement
+        :param information: edge information, see ``add_edge``
+        :return: node id
+        """
+        rotation, translation = PoseGraphOptimizer.relative(last_pose, pose)
+        with self._lock:
+            i = len(self._rotations) - 1
+            R, t = self._rotations[i], self._translations[i]
+        j = self.add_node(R.dot(rotation), t + R.dot(translation))
+        self.add_edge(i, j, rotation, translation, information)
+        return j
+
+    @staticmethod
+    def relative(a, b):
+        """Computes relative transform from pose a to pose b, i.e. ``T_b = T_a * Z``
+
+        :return: a tuple of rotation matrix and translation vector
+        """
+        Ra, ta = np.float64(a.rotation).reshape(3, 3), np.float64(a.translation).reshape(3)
+        Rb, tb = np.float64(b.rotation).reshape(3, 3), np.float64(b.translation).reshape(3)
+        return Ra.T.dot(Rb), Ra.T.dot(tb - ta)
+
+    def pose(self, i, timestamp=None, features=None):
+        """Returns the current estimate of a node as a Pose"""
+        with self._lock:
+            R, t = self._rotations[i], self._translations[i]
+        return Pose(timestamp, np.float32(R), np.float32(t.reshape(3, 1)), features)
+
+    def request(self):
+        """Requests optimization. Runs on the background thread if enabled, otherwise optimizes immediately"""
+        if self._thread is None:
+            self.optimize()
+            return
+        with self._lock:
+            self._pending = True
+            self._lock.notify_all()
+
+    def wait(self, timeout=None):
+        """Waits until requested optimization is published
+
+        :return: False if timed out
+        """
+        with self._lock:
+            return self._lock.wait_for(lambda: not self._pending and not self._busy, timeout)
+
+    def optimize(self, iterations=None):
+        """Optimizes the graph on the calling thread and publishes the result
+
+        :param iterations: maximum number of iterations
+        :return: weighted squared error
+        """
+        with self._lock:
+            count = len(self._rotations)
+            rotations, translations = np.array(self._rotations), np.array(self._translations)
+            edges = list(self._edges)
+
+        if count > 1 and edges:
+            rotations, translations, error = self._optimize(rotations, translations, edges,
+                                                            self._iterations if iterations is None else iterations,
+                                                            self._tolerance)
+        else:
+            error = 0.0
+
+        with self._lock:
+            self._publish(count, rotations, translations)
+            self._error = error
+        return error
+
+    def run(self):
+        """Background thread loop"""
+        while True:
+            with self._lock:
+                while self._running and not self._pending:
+                    self._lock.wait()
+                if not self._running:
+                    return
+                self._pending = False
+                self._busy = True
+            try:
+                self.optimize()
+            finally:
+                with self._lock:
+                    self._busy = False
+                    self._lock.notify_all()
+
+    def _publish(self, count, rotations, translations):
+        """Helper method to replace estimates of first count nodes. Newer nodes are moved rigidly with the last one."""
+        if count == 0:
+            return
+        last = count - 1
+        R = rotations[last].dot(self._rotations[last].T)
+        t = translations[last] - R.dot(self._translations[last])
+        for k in range(count, len(self._rotations)):
+            self._rotations[k] = R.dot(self._rotations[k])
+            self._translations[k] = R.dot(self._translations[k]) + t
+        self._rotations[:count] = list(rotations)
+        self._translations[:count] = list(translations)
+        self._version += 1
+
+    @staticmethod
+    def _residuals(rotations, translations, i, j, Rz, tz, L):
+        """Helper method to compute whitened residuals of all edges, Ex6 array"""
+        Ri, Rj = rotations[i], rotations[j]
+        RiT = np.swapaxes(Ri, 1, 2)
+        E = np.matmul(np.swapaxes(Rz, 1, 2), np.matmul(RiT, Rj))
+        v = np.einsum('nij,nj->ni', RiT, translations[j] - translations[i])
+        r = np.concatenate((_log(E), v - tz), axis=1)
+        return np.einsum('nij,nj->ni', L, r), r, v
+
+    @staticmethod
+    def _optimize(rotations, translations, edges, iterations, tolerance=1e-6):
+        """Helper method implementing Levenberg-Marquardt. Returns optimized rotations, translations and error"""
+        i = np.int64([e[0] for e in edges])
+        j = np.int64([e[1] for e in edges])
+        Rz = np.array([e[2] for e in edges])
+        tz = np.array([e[3] for e in edges])
+        L = np.array([e[4] for e in edges])
+        n, m = len(rotations), len(edges)
+
+        # every edge contributes a 6x12 block, node parameters are (rotation vector, translation) increments
+        rows = np.broadcast_to(np.arange(6 * m).reshape(m, 6, 1), (m, 6, 12)).ravel()
+        cols = np.concatenate((6 * i[:, None] + np.arange(6), 6 * j[:, None] + np.arange(6)), axis=1)
+        cols = np.broadcast_to(cols[:, None, :], (m, 6, 12)).ravel()
+        # the first node is fixed
+        fixed = cols < 6
+
+        residuals, r, v = PoseGraphOptimizer._residuals(rotations, translations, i, j, Rz, tz, L)
+        error = float(np.sum(residuals ** 2))
+        damping = 1e-4
+        for iteration in range(iterations):
+            Ri, Rj = rotations[i], rotations[j]
+            RiT = np.swapaxes(Ri, 1, 2)
+            Jr = _right_jacobian_inv(r[:, :3])
+            J = np.zeros((m, 6, 12))
+            J[:, :3, :3] = -np.matmul(Jr, np.matmul(np.swapaxes(Rj, 1, 2), Ri))
+            J[:, :3, 6:9] = Jr
+            J[:, 3:, :3] = _skew(v)
+            J[:, 3:, 3:6] = -RiT
+            J[:, 3:, 9:] = RiT
+            J = np.matmul(L, J)
+
+            A = sparse.csr_matrix((J.ravel()[~fixed], (rows[~fixed], cols[~fixed] - 6)), shape=(6 * m, 6 * (n - 1)))
+            H = (A.T.dot(A)).tocsc()
+            g = A.T.dot(residuals.ravel())
+            diagonal = H.diagonal()
+
+            while True:
+                step = sparse_linalg.spsolve(H + sparse.diags(damping * np.maximum(diagonal, 1e-9)), -g)
+                step = np.concatenate((np.zeros(6), step)).reshape(n, 6)
+                _rotations = np.matmul(rotations, _exp(step[:, :3]))
+                _translations = translations + step[:, 3:]
+                _residuals, _r, _v = PoseGraphOptimizer._residuals(_rotations, _translations, i, j, Rz, tz, L)
+                _error = float(np.sum(_residuals ** 2))
+                if _error < error or damping > 1e8:
+                    break
+                damping *= 10
+
+            if _error >= error:
+                break
+            decrease = (error - _error) / max(error, 1e-12)
+            rotations, translations, residuals, r, v, error = _rotations, _translations, _residuals, _r, _v, _error
+            damping = max(damping / 10, 1e-9)
+            if decrease < tolerance:
+                break
+
+        return rotations, translations, error
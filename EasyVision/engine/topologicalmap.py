@@ -3,14 +3,19 @@
 """
 
 from EasyVision.engine.occupancygridmap import OccupancyGridMap
+from EasyVision.engine.bowvocabulary import KeyframeDatabase, VocabularyTree
+from EasyVision.engine.posegraph import PoseGraphOptimizer
 from EasyVision.engine.base import Pose
 import numpy as np
 import cv2
-from math import sin, cos, acos, asin
 import os
-import pyDBoW3 as bow
 from collections import namedtuple
 
+try:
+    import pyDBoW3 as bow
+except ImportError:
+    bow = None
+
 
 ORB_VOCABULARY_PATH = os.path.join("", "EasyVision", "engine", "orbvoc.dbow3")
 
@@ -20,7 +25,7 @@ class Node(namedtuple("Node", "pose links")):
 
         **pose**: a pose for this node
 
-        **links**: references to other nodes this one has connection to.
+        **links**: ids of other nodes this one has connection to.
 
     .. note::
         pose may have rotation/translation set to None. In that case path planning
@@ -31,57 +36,115 @@ class Node(namedtuple("Node", "pose links")):
     def todict(self):
         return {
             "pose": self.pose.todict(),
-            "links": self.links
+            "links": list(self.links)
         }
 
-    def fromdict(self, d):
-        return Node(Pose.fromdict(d['pose']), d['links'])
+    @staticmethod
+    def fromdict(d):
+        return Node(Pose.fromdict(d['pose']), tuple(d['links']))
 
 
 class TopologicalMap(OccupancyGridMap):
-    """Class that implements Topological Map on top of OccupancyGridMap and uses pyDBoW3 library
+    """Class that implements Topological Map on top of OccupancyGridMap and uses BOW place recognition
     for topology building.
 
     On every update call, updates both the topology(visibility graph) and occupancy grid.
+    Pose features are queried against the keyframe database of nodes:
+        - if the best score is above ``loop_threshold``, the robot is considered to be at the matched node. If it
+          came from a different node, both nodes are linked, which closes loops on revisited places.
+          A node that is not linked to the current one is only accepted if it is not one of the last
+          ``loop_exclude`` nodes and it, or its neighbours, were matched in ``loop_consistency`` consecutive updates.
+        - if the best score is below ``new_node_threshold``, a new node is added and linked to the current node.
+
+    Node positions are kept in a uniform grid spatial index, thus nearest node lookup only checks nearby cells.
+    Planning runs A* over the node graph using distances between node positions, which is much cheaper than
+    planning over the occupancy grid.
+
+    If a ``PoseGraphOptimizer`` is supplied, nodes are added to the pose graph with odometry edges and loop closures
+    add edges assuming that the robot is at the pose of the matched node. ``update`` returns the pose corrected
+    by the latest published optimization, i.e. the estimate of the current node followed by odometry since reaching it.
     """
 
-    def __init__(self, _map, vocabulary, *args, graph=None, **kwargs):
+    def __init__(self, _map, vocabulary, *args, graph=None, new_node_threshold=.01, loop_threshold=.1, max_results=5,
+                 index_cell=32, optimizer=None, loop_information=.1, loop_exclude=3, loop_consistency=2, **kwargs):
         """Instance initialization.
 
-        :param _map: Accepts either a tuple of (map_width, map_height) or a np.float32 two dimensional array
-        :param vocabulary: a path to BOW vocabulary in DBoW3 format.
+        :param _map: Accepts either a tuple of (map_width, map_height), a np.float32 two dimensional array or None
+        :param vocabulary: a path to BOW vocabulary in DBoW3 format or a VocabularyTree instance
         :param graph: a list of Node elements
+        :param new_node_threshold: a new node is added if the best BOW score is below this threshold
+        :param loop_threshold: nodes are linked if the best BOW score is at least this threshold
+        :param max_results: number of database query results
+        :param index_cell: size of the spatial index cell in map cells
+        :param optimizer: optional PoseGraphOptimizer used to correct odometry drift
+        :param loop_information: information of loop closure edges relative to odometry edges
+        :param loop_exclude: number of most recently added nodes that can not close a loop
+        :param loop_consistency: number of consecutive updates a loop closure must be matched in
         """
         if graph is None:
             graph = []
 
+        if not isinstance(vocabulary, VocabularyTree) and bow is None:
+            raise NotImplementedError("pyDBoW3 library not imported, use VocabularyTree instead")
+        if optimizer is not None and not isinstance(optimizer, PoseGraphOptimizer):
+            raise TypeError("Optimizer must be of type PoseGraphOptimizer")
+        if new_node_threshold > loop_threshold:
+            raise ValueError("New node threshold must not be greater than loop threshold")
+        if loop_exclude < 0 or loop_consistency < 1:
+            raise ValueError("Loop exclude must not be negative and loop consistency must be positive")
+
         self._database = None
         self._results = None
-        self._voc_path = vocabulary
+        self._vocabulary = vocabulary
         self._graph = graph
-
-        print("myself init")
+        self._current = None
+        self._new_node_threshold = new_node_threshold
+        self._loop_threshold = loop_threshold
+        self._max_results = max_results
+        self._index_cell = index_cell
+        self._index = {}
+        self._positions = []
+        self._optimizer = optimizer
+        self._optimizer_version = None
+        self._loop_information = loop_information
+        self._loop_exclude = loop_exclude
+        self._loop_consistency = loop_consistency
+        self._loop_candidate = None
+        self._odometry = None
+        self._last_corrected = None
 
         super(TopologicalMap, self).__init__(_map, *args, **kwargs)
 
     def setup(self):
-        print("myself setup")
-        self._database = bow.Database()
-        self._database.loadVocabulary(self._voc_path, False, -1)
-
-        print("myself setup pregraph")
-
-        for pose in self._graph:
-            if pose.features is None:
+        if isinstance(self._vocabulary, VocabularyTree):
+            self._database = KeyframeDatabase(self._vocabulary.size, self._vocabulary.idf)
+        else:
+            self._database = bow.Database()
+            self._database.loadVocabulary(self._vocabulary, False, -1)
+
+        graph, self._graph = self._graph, []
+        self._index = {}
+        self._positions = []
+        for node in graph:
+            if node.pose.features is None:
                 raise AttributeError("All poses must contain features")
-            # TODO except for the first pose that initiates the origin of the path
-            self._database.add(pose.features.descriptors)
-            print("myself setup add pose")
+            self._add_node(node)
+
+        if self._optimizer is not None:
+            for node in self._graph:
+                self._optimizer.add_node(node.pose.rotation, node.pose.translation)
+            for id, node in enumerate(self._graph):
+                for link in node.links:
+                    if link > id:
+                        self._optimizer.add_edge(id, link, *PoseGraphOptimizer.relative(node.pose, self._graph[link].pose))
+            self._optimizer_version = self._optimizer.version
+            self._optimizer.setup()
 
         super(TopologicalMap, self).setup()
 
     def release(self):
-        print("myself release")
+        if self._optimizer is not None:
+            self._optimizer.release()
         super(TopologicalMap, self).release()
 
     @property
@@ -90,73 +153,242 @@ class TopologicalMap(OccupancyGridMap):
 
     @property
     def graph(self):
+        self._sync()
         return self._graph
 
-    def update(self, pose, **kwargs):
-        print("myself update")
-        updated_pose = super(TopologicalMap, self).update(pose, **kwargs)
+    @property
+    def current(self):
+        """Id of the node the robot is currently at"""
+        return self._current
 
+    def update(self, pose, **kwargs):
         if pose.features is None:
             raise AttributeError("All poses must contain features")
 
-        results = self._database.query(pose.features.descriptors, 5, -1)
-        self._results = [(result.Score, result.Id) for result in results]
-        print("myself update query", self._results)
+        if self._optimizer is not None:
+            pose = self._correct(pose)
 
-        if not results or max(score for score, id in self._results) < 0.01:
-            self._database.add(pose.features.descriptors)
-            self._graph.append(Node(pose, tuple(result.Id for result in results)))
+        updated_pose = super(TopologicalMap, self).update(pose, **kwargs)
 
-        # TOOD:
-        # query database
-        # if some_criteria:
-        #   database.add
-        #   super().update
-        #   add a node
-        #   update node links based on query results
+        self._results = self._query(pose.features.descriptors)
+        best_id, best_score = max(self._results, key=lambda x: x[1]) if self._results else (None, 0)
+        # a loop candidate is only kept while it is matched in consecutive updates
+        candidate, self._loop_candidate = self._loop_candidate, None
+
+        if best_id is not None and best_score >= self._loop_threshold:
+            if best_id != self._current and self._accept(best_id, candidate):
+                if self._current is not None:
+                    if best_id not in self._graph[self._current].links and self._optimizer is not None:
+                        self._optimizer.add_edge(self._current, best_id, *self._odometry, information=self._loop_information)
+                        self._optimizer.request()
+                    self._link(self._current, best_id)
+                self._current = best_id
+                if self._optimizer is not None:
+                    # the robot is at the matched node now
+                    self._odometry = None
+                    self._sync()
+                    updated_pose = self._last_corrected = self._estimate(updated_pose)
+        elif best_id is None or best_score < self._new_node_threshold:
+            node_id = self._add_node(Node(updated_pose, ()))
+            if self._optimizer is not None:
+                self._optimizer.add_node(updated_pose.rotation, updated_pose.translation)
+                if self._current is not None:
+                    self._optimizer.add_edge(self._current, node_id, *self._odometry)
+                self._odometry = None
+            if self._current is not None:
+                self._link(self._current, node_id)
+            self._current = node_id
 
         return updated_pose
 
+    def _accept(self, node_id, candidate):
+        """Helper method to check whether the robot may move to the matched node.
+        Nodes linked to the current node are accepted right away, other nodes close a loop.
+
+        :param node_id: id of the matched node
+        :param candidate: a tuple of (node id, count) of the loop candidate of the previous update or None
+        :return: True if the robot is at the matched node
+        """
+        if self._current is None or node_id in self._graph[self._current].links:
+            return True
+        if node_id >= len(self._graph) - self._loop_exclude:
+            return False
+
+        count = 1
+        if candidate is not None and (candidate[0] == node_id or node_id in self._graph[candidate[0]].links):
+            count = candidate[1] + 1
+        if count < self._loop_consistency:
+            self._loop_candidate = node_id, count
+            return False
+        return True
+
+    def _correct(self, pose):
+        """Helper method to accumulate odometry since the current node and correct the pose using
+        the current node estimate"""
+        self._sync()
+
+        step = PoseGraphOptimizer.relative(self._last_corrected, pose) if self._last_corrected is not None else None
+        if self._odometry is None:
+            self._odometry = np.eye(3), np.zeros(3)
+        if step is not None:
+            R, t = self._odometry
+            self._odometry = R.dot(step[0]), t + R.dot(step[1])
+
+        pose = self._last_corrected = self._estimate(pose)
+        return pose
+
+    def _estimate(self, pose):
+        """Helper method to replace pose coordinates with the current node estimate followed by odometry"""
+        if self._current is None:
+            return pose
+        node = self._optimizer.pose(self._current)
+        R, t = self._odometry if self._odometry is not None else (np.eye(3), np.zeros(3))
+        rotation = np.float64(node.rotation).dot(R)
+        translation = np.float64(node.translation).ravel() + np.float64(node.rotation).dot(t)
+        return pose._replace(rotation=np.float32(rotation), translation=np.float32(translation.reshape(3, 1)))
+
+    def _sync(self):
+        """Helper method to update node poses and the spatial index with the latest published optimization"""
+        if self._optimizer is None or self._optimizer_version == self._optimizer.version:
+            return
+        self._optimizer_version = self._optimizer.version
+        self._index = {}
+        for id, node in enumerate(self._graph):
+            estimate = self._optimizer.pose(id)
+            node = self._graph[id] = node._replace(pose=node.pose._replace(rotation=estimate.rotation, translation=estimate.translation))
+            position = self._positions[id] = self._position(node.pose)
+            if position is not None:
+                cell = int(position[0] // self._index_cell), int(position[1] // self._index_cell)
+                self._index.setdefault(cell, []).append(id)
+
     def draw(self, path=None):
         disp = super(TopologicalMap, self).draw(path, display=False)
+        if disp is None:
+            return
 
-        matches = tuple(id for _, id in self._results) if self._results else ()
+        ox, oy = self.origin
+        matches = tuple(id for id, _ in self._results) if self._results else ()
 
         for id, node in enumerate(self._graph):
-            draw_x, draw_y = int(node.pose.translation[0] * self._scale), int(node.pose.translation[2] * self._scale)
+            if self._positions[id] is None:
+                continue
+            x, y = self._positions[id]
+            for link in node.links:
+                if link > id and self._positions[link] is not None:
+                    lx, ly = self._positions[link]
+                    cv2.line(disp, (int(x) - ox, int(y) - oy), (int(lx) - ox, int(ly) - oy), (255, 255, 0))
             c = (0, 255, 0) if id in matches else (255, 0, 0)
-            cv2.circle(disp, (draw_x, draw_y), 1, c)
+            cv2.circle(disp, (int(x) - ox, int(y) - oy), 1, c)
 
         cv2.imshow(self.name, disp)
 
-        # TODO:
-        # draw the map
-        # draw nodes
-        # draw matching nodes with different color
+    def nearest(self, pose):
+        """Finds the node nearest to the pose using the spatial index
 
-    def plan(self, target, radius, **kwargs):
+        :param pose: Pose with valid coordinates
+        :return: node id or None if no node has a position
         """
+        self._sync()
+        position = self._position(pose)
+        if position is None or not self._index:
+            return None
+        x, y = position
+        size = self._index_cell
+        cx, cy = int(x // size), int(y // size)
+        radius = max(max(abs(ix - cx), abs(iy - cy)) for ix, iy in self._index)
+
+        best_id, best_distance = None, float('inf')
+        for r in range(radius + 1):
+            for ix in range(cx - r, cx + r + 1):
+                for iy in ((cy - r, cy + r) if abs(ix - cx) < r else range(cy - r, cy + r + 1)):
+                    for id in self._index.get((ix, iy), ()):
+                        nx, ny = self._positions[id]
+                        distance = ((nx - x) ** 2 + (ny - y) ** 2) ** .5
+                        if distance < best_distance:
+                            best_id, best_distance = id, distance
+            # nodes in further rings are at least r cells away
+            if best_distance <= r * size:
+                break
+        return best_id
+
+    def shortest_path(self, start, goal):
+        """Finds the shortest path in the node graph using A* over distances between node positions.
+        Links of nodes without a position have unit length.
+
+        :param start: start node id
+        :param goal: goal node id
+        :return: a list of node ids from start to goal or an empty list if nodes are not connected
+        """
+        def neighbors(current):
+            return iter(self._graph[current].links)
 
-        there are several modes of planning:
-
-            - plan using grid map
-            - plan using graph
-
-            - plan when features are available
-            - plan when features are not available
-            - plan when rotate/translate is available
-            - plan when rotate/translate is not available
+        def heuristic(_a, _b, _c):
+            return self._distance(_b, _c)
 
-        also planning may depend whether graph contains rotate/translate or not.
+        return list(self.astar(start, goal, neighbors, heuristic))[::-1]
 
-        use case::
+    def plan(self, target, radius, use_graph=True, **kwargs):
+        """Finds the path between current and target poses.
 
-            setup the graph so that we only have features. in that case calculate
-            rotate/translate based on relative rotate/translate
+        Graph planning goes from the current node through linked nodes to the node nearest to the target.
+        If graph planning is disabled or there are no nodes with positions, plans over the occupancy grid.
 
-        :param target:
-        :param radius:
-        :param kwargs:
-        :return:
+        :param target: Pose with valid coordinates. Will be translated to map coordinates using scale.
+        :param radius: obstacle inflation radius in world coordinates. Only used for grid planning.
+        :param use_graph: indicates whether to plan over the node graph
+        :returns: an iterable of (x, y) scaled map coordinates.
         """
-        pass
+        if not use_graph or not self._index:
+            return super(TopologicalMap, self).plan(target, radius, **kwargs)
+
+        start = self._current if self._current is not None else self.nearest(self.pose)
+        goal = self.nearest(target)
+        nodes = self.shortest_path(start, goal) if start is not None and goal is not None else []
+        if not nodes:
+            return np.zeros((0, 2), np.float32)
+
+        points = [self._position(self.pose)] + [self._positions[id] for id in nodes] + [self._position(target)]
+        return np.float32([point for point in points if point is not None]) / self._scale
+
+    def _position(self, pose):
+        """Helper method to get (x, y) map coordinates of the pose. Returns None if pose has no translation"""
+        translation = pose.translation
+        if translation is None or translation.size < 3 or not np.all(np.isfinite(translation)):
+            return None
+        translation = translation.ravel()
+        return float(translation[0] * self._scale), float(translation[2] * self._scale)
+
+    def _distance(self, a, b):
+        """Helper method to compute distance between nodes. Nodes without a position are a unit apart"""
+        pa, pb = self._positions[a], self._positions[b]
+        if pa is None or pb is None:
+            return 0 if a == b else 1
+        return ((pa[0] - pb[0]) ** 2 + (pa[1] - pb[1]) ** 2) ** .5
+
+    def _query(self, descriptors):
+        """Helper method to query the database. Returns a list of (node id, score)"""
+        if isinstance(self._database, KeyframeDatabase):
+            return self._database.query(self._vocabulary.histogram(descriptors), self._max_results)
+        return [(result.Id, result.Score) for result in self._database.query(descriptors, self._max_results, -1)]
+
+    def _add_node(self, node):
+        """Helper method to add a node to the database, the graph and the spatial index"""
+        if isinstance(self._database, KeyframeDatabase):
+            self._database.add(self._vocabulary.histogram(node.pose.features.descriptors))
+        else:
+            self._database.add(node.pose.features.descriptors)
+        node_id = len(self._graph)
+        position = self._position(node.pose)
+        self._graph.append(node)
+        self._positions.append(position)
+        if position is not None:
+            cell = int(position[0] // self._index_cell), int(position[1] // self._index_cell)
+            self._index.setdefault(cell, []).append(node_id)
+        return node_id
+
+    def _link(self, a, b):
+        """Helper method to link two nodes both ways"""
+        if b not in self._graph[a].links:
+            self._graph[a] = self._graph[a]._replace(links=self._graph[a].links + (b, ))
+        if a not in self._graph[b].links:
+            self._graph[b] = self._graph[b]._replace(links=self._graph[b].links + (a, ))
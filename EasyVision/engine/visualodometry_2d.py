@@ -3,6 +3,7 @@
 
 """
 from .base import OdometryBase, Pose, EngineCapability
+from .bundleadjustment import BundleAdjustmentMixin
 from EasyVision.processors.base import *
 from EasyVision.processors import FeatureExtraction, CalibratedCamera, FeatureMatchingMixin
 from EasyVision.vision import PyroCapture
@@ -14,7 +15,7 @@ except:
     pass
 
 
-class VisualOdometry2DEngine(FeatureMatchingMixin, OdometryBase):
+class VisualOdometry2DEngine(FeatureMatchingMixin, BundleAdjustmentMixin, OdometryBase):
     """Class that implement Monocular Visual Odometry.
 
     Contains two algorithms:
@@ -22,13 +23,18 @@ class VisualOdometry2DEngine(FeatureMatchingMixin, OdometryBase):
         - feature matching
 
     Feature tracking is available for FAST and GFTT features, otherwise feature matching will be used.
+    Features are tracked with pyramidal Lucas-Kanade optical flow and every track is verified by tracking it back
+    to the last frame. Features are only redetected if the number of tracked features drops below ``min_features``,
+    in which case new features are detected away from already tracked ones.
 
     ``compute`` method will return a frame and computed pose. If pose is not available will return last available pose.
     If a map is provided, then ``map.update`` method will be called.
+    If a bundle adjuster is provided, then every frame with computed pose is added as a keyframe and triangulated
+    inliers are added as landmarks observed from the last two frames. Only feature matching supports it.
 
     Visual odometry algorithm is as follows:
     1. capture a new frame
-    1.1. if tracking enabled - track features
+    1.1. if tracking enabled - track features and redetect them if not enough features left
     2. if previous frame is available
     2.1. compute essential matrix
     2.2. recover pose
@@ -41,8 +47,8 @@ class VisualOdometry2DEngine(FeatureMatchingMixin, OdometryBase):
     """
 
     def __init__(self, vision, _map=None, feature_type=None, pose=None, num_features=6000, min_features=1000,
-                 min_matches=30, distance_thresh=None, ratio=.7, reproj_thresh=None,
-                 debug=False, display_results=False, *args, **kwargs):
+                 min_matches=30, distance_thresh=None, ratio=.7, reproj_thresh=None, track_thresh=1.,
+                 bundle_adjuster=None, debug=False, display_results=False, *args, **kwargs):
         """Instance initialization.
 
         :param vision: capturing source object.
@@ -55,6 +61,8 @@ class VisualOdometry2DEngine(FeatureMatchingMixin, OdometryBase):
         :param distance_thresh: Distance threshold for matching
         :param ratio: Lowe's ratio
         :param reproj_thresh: Reprojection threshold
+        :param track_thresh: Maximum distance between a tracked point and the point tracked back to the last frame
+        :param bundle_adjuster: an instance of BundleAdjuster for local bundle adjustment
         """
         feature_extractor_provided = False
         if not isinstance(vision, ProcessorBase) and not isinstance(vision, VisionBase) and not isinstance(vision, PyroCapture):
@@ -96,10 +104,12 @@ class VisualOdometry2DEngine(FeatureMatchingMixin, OdometryBase):
 
         self._lk_params = dict(
             winSize=(21, 21),
-            #maxLevel = 3,
+            maxLevel=3,
             criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 30, 0.01)
         )
+        self._track_thresh = track_thresh
 
+        self._extractor = _vision.get_source('FeatureExtraction')
         self._camera = _vision.camera
         self._map = _map
         self._last_image = None
@@ -113,14 +123,20 @@ class VisualOdometry2DEngine(FeatureMatchingMixin, OdometryBase):
             self._distance_thresh = distance_thresh
         if reproj_thresh is not None:
             self._reproj_thresh = reproj_thresh
-        super(VisualOdometry2DEngine, self).__init__(_vision, debug=debug, display_results=display_results, *args, **kwargs)
+        super(VisualOdometry2DEngine, self).__init__(_vision, bundle_adjuster=bundle_adjuster, debug=debug,
+                                                     display_results=display_results, *args, **kwargs)
 
     def setup(self):
         super(VisualOdometry2DEngine, self).setup()
+        if not self._extract:
+            # features are detected on demand while tracking
+            self._extractor.enabled = False
         if self._map is not None:
             self._map.setup()
 
     def release(self):
+        if not self._extract:
+            self._extractor.enabled = True
         super(VisualOdometry2DEngine, self).release()
         if self._map is not None:
             self._map.release()
@@ -131,7 +147,7 @@ class VisualOdometry2DEngine(FeatureMatchingMixin, OdometryBase):
             return None
         current_image = frame.images[0]
 
-        pose = self._compute_match(frame.timestamp, current_image, absolute_scale) if self._extract else self._compute_track(current_image, absolute_scale)
+        pose = self._compute_match(frame.timestamp, current_image, absolute_scale) if self._extract else self._compute_track(frame.timestamp, current_image, absolute_scale)
 
         self._last_image = current_image
 
@@ -146,12 +162,13 @@ class VisualOdometry2DEngine(FeatureMatchingMixin, OdometryBase):
         :return: computed and updated pose
         """
         if not self._last_image:
-            self._last_kps = np.float32([x.pt for x in current_image.features.points])
+            self._last_kps = np.float32(current_image.features.pt)
         else:
             M = self._match_features(self._last_features, current_image.features)
 
             if M is None:
                 print("failed to find matches")
+                self._break_chain()
                 return self._pose
             last, current, descriptors = M
 
@@ -164,34 +181,23 @@ class VisualOdometry2DEngine(FeatureMatchingMixin, OdometryBase):
             ret, R, t, mask = cv2.recoverPose(E, current, last, focal=self._camera.focal_point[0], pp=self._camera.center, mask=mask)
 
             if ret:
-                if self._map is not None:
-                    P1 = np.dot(self._camera.matrix, np.hstack((np.eye(3, 3), np.zeros((3, 1)))))
-                    P2 = np.dot(self._camera.matrix, np.hstack((R, t)))
-
+                if self._map is not None or self._adjuster is not None:
                     last_inliers = np.float32([p for m, p in zip(mask, last) if m])
                     current_inliers = np.float32([p for m, p in zip(mask, current) if m])
                     descriptors = np.array([p for m, p in zip(mask, descriptors) if m], dtype=descriptors.dtype)
 
-                    points_4d_hom = cv2.triangulatePoints(P1, P2, np.expand_dims(current_inliers, axis=1), np.expand_dims(last_inliers, axis=1))
-                    points_4d = points_4d_hom / np.tile(points_4d_hom[-1, :], (4, 1))
-                    points_3d = points_4d[:3, :].T
-                    features = Features(current, descriptors, points_3d)
-                else:
-                    features = None
+                    points_3d = self._triangulate(R, t, last_inliers, current_inliers)
+                    features = Features(current, descriptors, points_3d) if self._map is not None else None
 
-                if self._pose:
-                    self._pose = self._pose._replace(
-                        timestamp=timestamp,
-                        translation=self._pose.translation + absolute_scale * self._pose.rotation.dot(t),
-                        rotation=R.dot(self._pose.rotation),
-                        features=features
-                    )
+                    if self._adjuster is not None:
+                        points_3d = absolute_scale * (points_3d.dot(R.T) + t.T)
+                        self._adjust_matches(R.T, -absolute_scale * R.T.dot(t), points_3d, last_inliers, current_inliers)
                 else:
-                    self._pose = Pose(timestamp, R, t, features)
-                self._last_pose = Pose(timestamp, R, t, features)
+                    features = None
 
-                if self._map is not None:
-                    self._pose = self._map.update(self._pose, scale=absolute_scale)
+                self._update_pose(timestamp, R, t, features, absolute_scale)
+            else:
+                self._break_chain()
 
             if self.debug:
                 img = cv2.cvtColor(current_image.image, cv2.COLOR_GRAY2BGR)
@@ -204,54 +210,129 @@ class VisualOdometry2DEngine(FeatureMatchingMixin, OdometryBase):
         self._last_features = current_image.features
         return self._pose
 
+    def _adjust_matches(self, R, t, points_3d, last_points_2d, points_2d):
+        """Helper method to add current frame to the bundle adjuster.
+
+        :param R: relative rotation from last frame to current frame
+        :param t: relative translation from last frame to current frame
+        :param points_3d: triangulated inlier points in last frame coordinates
+        :param last_points_2d: inlier points in last frame
+        :param points_2d: inlier points in current frame
+        """
+        last, Rl, tl, keyframe = self._chain_keyframe(R, t)
+        ids = self._adjuster.add_landmarks((points_3d - tl).dot(Rl))
+        self._adjuster.add_observations(last, ids, last_points_2d)
+        self._adjuster.add_observations(keyframe, ids, points_2d)
+        self._adjuster.request()
+
     def _compute_track(self, timestamp, current_image, absolute_scale):
         """Helper method to compute pose from tracked features.
 
-        FIXME: currently broken code
-
         :param timestamp: current frame timestamp
         :param current_image: current image
         :param absolute_scale: absolute scale that is being passed from ``compute`` method
         :return: computed and updated pose
         """
-        self.vision.enable = False
-        if not self._last_image:
-            self._last_kps = np.array([x.pt for x in current_image.features.points], dtype=np.float32)
+        if not self._last_image or self._last_kps is None or not len(self._last_kps):
+            self._last_kps = self._detect_features(current_image)
+            return self._pose
+
+        last, current = self._track_features(self._last_image.image, current_image.image, self._last_kps)
+
+        # pose is only computed from moving points, as static points(e.g. when camera stops) do not constrain it
+        moving = np.flatnonzero(((current - last) ** 2).sum(axis=1) > 0.5)
+        keep = np.ones(len(current), bool)
+        mask = None
+        if len(moving) >= self._min_matches:
+            E, mask = cv2.findEssentialMat(current[moving], last[moving],
+                                           focal=self._camera.focal_point[0], pp=self._camera.center,
+                                           method=cv2.RANSAC, prob=0.999, threshold=self._reproj_thresh)
+            if E is not None and E.shape == (3, 3):
+                ret, R, t, mask = cv2.recoverPose(E, current[moving], last[moving],
+                                                  focal=self._camera.focal_point[0], pp=self._camera.center, mask=mask)
+                mask = mask.ravel() != 0
+                # outliers of the epipolar constraint are likely bad tracks
+                keep[moving[~mask]] = False
+                if ret:
+                    features = None
+                    if self._map is not None:
+                        current_inliers = current[moving[mask]]
+                        points_3d = self._triangulate(R, t, last[moving[mask]], current_inliers)
+                        features = Features(current_inliers, None, points_3d)
+                    self._update_pose(timestamp, R, t, features, absolute_scale)
+
+        if self.debug:
+            img = cv2.cvtColor(current_image.image, cv2.COLOR_GRAY2BGR)
+            img = img.get() if isinstance(img, cv2.UMat) else img
+            for m, a, b in zip(keep, last, current):
+                cv2.line(img, (int(a[0]), int(a[1])), (int(b[0]), int(b[1])), (0, 255 if m else 0, 0 if m else 255))
+                cv2.circle(img, (int(b[0]), int(b[1])), 3, (0, 255 if m else 0, 0 if m else 255))
+            cv2.imshow(self.name, img)
+
+        current = current[keep]
+        if len(current) < self._min_features:
+            current = np.vstack((current, self._detect_features(current_image, current)))
+        self._last_kps = current
+
+        return self._pose
+
+    def _update_pose(self, timestamp, R, t, features, absolute_scale):
+        """Helper method to update current pose with relative pose and call map update
+
+        :param timestamp: current frame timestamp
+        :param R: relative rotation
+        :param t: relative translation
+        :param features: features associated with the pose
+        :param absolute_scale: absolute scale that is being passed from ``compute`` method
+        """
+        if self._pose:
+            self._pose = self._pose._replace(
+                timestamp=timestamp,
+                translation=self._pose.translation + absolute_scale * self._pose.rotation.dot(t),
+                rotation=R.dot(self._pose.rotation),
+                features=features
+            )
         else:
-            self._last_kps, cur_kps = self._track_features(self._last_image.image, current_image.image, self._last_kps)
+            self._pose = Pose(timestamp, R, t, features)
+        self._last_pose = Pose(timestamp, R, t, features)
 
-            if self.debug:
-                img = cv2.cvtColor(current_image.image, cv2.COLOR_GRAY2BGR)
-                for a, b in zip(last, current):
-                    cv2.line(img, (a[0], a[1]), (b[0], b[1]), (0, 0, 255))
-                for x, y in self._last_kps:
-                    cv2.circle(img, (x, y), 5, (0, 255, 0))
-                cv2.imshow(self.name, img)
+        if self._map is not None:
+            self._pose = self._map.update(self._pose, scale=absolute_scale)
 
-            E, mask = cv2.findEssentialMat(cur_kps, self._last_kps,
-                                           focal=self._camera.focal_point[0], pp=self._camera.center,
-                                           method=cv2.RANSAC, prob=0.999, threshold=self._reproj_thresh)
-            last_kps = np.float32([kp for m, kp in zip(mask, self._last_kps) if m])
-            cur_kps = np.float32([kp for m, kp in zip(mask, cur_kps) if m])
-            _, R, t, mask = cv2.recoverPose(E, cur_kps, last_kps,
-                                            focal=self._camera.focal_point[0], pp=self._camera.center)
-            if self._pose:
-                self._pose = self._pose._replace(
-                    timestamp=timestamp,
-                    translation=self._pose.translation + absolute_scale * self._pose.rotation.dot(t),
-                    rotation=R.dot(self._pose.rotation)
-                )
-            else:
-                self._pose = Pose(timestamp, R, t)
-            self._last_pose = Pose(timestamp, R, t)
+    def _triangulate(self, R, t, last, current):
+        """Helper method to triangulate points from relative pose
 
-            if len(self._last_kps) < self._min_features:
-                current_image = self.vision.process(current_image)
-                cur_kps = np.array([x.pt for x in current_image.features.points], dtype=np.float32)
+        :param R: relative rotation
+        :param t: relative translation
+        :param last: points in last frame
+        :param current: points in current frame
+        :return: Nx3 array of 3d points in current frame coordinates
+        """
+        P1 = np.dot(self._camera.matrix, np.hstack((np.eye(3, 3), np.zeros((3, 1)))))
+        P2 = np.dot(self._camera.matrix, np.hstack((R, t)))
 
-            self._last_kps = cur_kps
+        points_4d_hom = cv2.triangulatePoints(P1, P2, np.expand_dims(current, axis=1), np.expand_dims(last, axis=1))
+        points_4d = points_4d_hom / np.tile(points_4d_hom[-1, :], (4, 1))
+        return points_4d[:3, :].T
 
-        return self._pose
+    def _detect_features(self, image, tracked=None):
+        """Helper method to detect features to track. Features are not detected next to already tracked points.
+
+        :param image: current image
+        :param tracked: Nx2 array of tracked points
+        :return: Nx2 array of detected points
+        """
+        mask = image.mask
+        if tracked is not None and len(tracked):
+            height, width = image.image.get().shape[:2] if isinstance(image.image, cv2.UMat) else image.image.shape[:2]
+            radius = self._lk_params['winSize'][0] // 2
+            free = np.ones((-(-height // radius), -(-width // radius)), bool)
+            free[np.int32(tracked[:, 1] // radius), np.int32(tracked[:, 0] // radius)] = False
+            free = np.uint8(np.repeat(np.repeat(free, radius, axis=0), radius, axis=1)[:height, :width]) * 255
+            mask = free if mask is None else cv2.bitwise_and(mask, free)
+
+        features = self._extractor.process(image._replace(mask=mask)).features
+        return np.ascontiguousarray(features.pt, np.float32).reshape(-1, 2)
 
     @property
     def feature_type(self):
@@ -297,12 +378,14 @@ class VisualOdometry2DEngine(FeatureMatchingMixin, OdometryBase):
 
     def _track_features(self, image_ref, image_cur, px_ref):
         """Helper method to track features.
+        Tracked points are tracked back to the last frame and only consistent tracks within the image are kept.
 
         :param image_ref: last frame
         :param image_cur: current frame
         :param px_ref: last frame features
         :return: last frame points, same points in current frame
         """
+        px_ref = np.ascontiguousarray(px_ref, np.float32).reshape(-1, 1, 2)
         kp2, st, err = cv2.calcOpticalFlowPyrLK(image_ref, image_cur, px_ref, None, **self._lk_params)  # shape: [k,2] [k,1] [k,1]
 
         umat = isinstance(st, cv2.UMat)
@@ -310,11 +393,25 @@ class VisualOdometry2DEngine(FeatureMatchingMixin, OdometryBase):
             st = st.get()
             kp2 = kp2.get()
 
-        st = st.reshape(st.shape[0])
-        kp1 = px_ref[st == 1]
-        kp2 = kp2[st == 1]
+        st = st.reshape(st.shape[0]) == 1
+        kp1, kp2 = px_ref[st], kp2[st]
+        if not len(kp1):
+            return kp1.reshape(-1, 2), kp2.reshape(-1, 2)
+
+        # backward tracking starts from the last frame points, as they are expected to be close
+        kp1_back, st, err = cv2.calcOpticalFlowPyrLK(image_cur, image_ref, kp2, kp1.copy(),
+                                                     flags=cv2.OPTFLOW_USE_INITIAL_FLOW, **self._lk_params)
+        if umat:
+            st = st.get()
+            kp1_back = kp1_back.get()
+
+        height, width = image_cur.get().shape[:2] if isinstance(image_cur, cv2.UMat) else image_cur.shape[:2]
+        kp1, kp2, kp1_back = kp1.reshape(-1, 2), kp2.reshape(-1, 2), kp1_back.reshape(-1, 2)
+        mask = st.ravel() == 1
+        mask &= ((kp1 - kp1_back) ** 2).sum(axis=1) < self._track_thresh ** 2
+        mask &= (kp2[:, 0] >= 0) & (kp2[:, 1] >= 0) & (kp2[:, 0] < width) & (kp2[:, 1] < height)
 
-        return kp1, kp2
+        return kp1[mask], kp2[mask]
 
     def _match_features(self, featuresA, featuresB):
         """Helper method to match features and filter out outliers.
@@ -326,23 +423,25 @@ class VisualOdometry2DEngine(FeatureMatchingMixin, OdometryBase):
         kpsA, descriptorsA, _ = featuresA
         kpsB, descriptorsB, _ = featuresB
 
-        matches = super(VisualOdometry2DEngine, self)._match_features(descriptorsA, descriptorsB, self._feature_type, self._ratio, self._distance_thresh, self._min_matches)
+        matches = self._match_indices(descriptorsA, descriptorsB, self._feature_type, self._ratio, self._distance_thresh, self._min_matches)
 
-        if matches is None or not matches:
+        if matches is None:
             return None
 
-        ptsA = [kpsA[m.queryIdx].pt for m in matches]
-        ptsB = [kpsB[m.trainIdx].pt for m in matches]
-        mask = [0.5 < p[0] ** 2 + p[1] ** 2 < 200 * 200 for p in ((a[0] - b[0], a[1] - b[1]) for a, b in zip(ptsA, ptsB))]
+        query, train = matches.query, matches.train
+        ptsA = featuresA.pt[query]
+        ptsB = featuresB.pt[train]
+        distance = ((ptsA - ptsB) ** 2).sum(axis=1)
+        mask = (0.5 < distance) & (distance < 200 * 200)
 
-        ptsA = np.float32([p for m, p in zip(mask, ptsA) if m])
-        ptsB = np.float32([p for m, p in zip(mask, ptsB) if m])
+        ptsA = np.float32(ptsA[mask])
+        ptsB = np.float32(ptsB[mask])
 
         if isinstance(descriptorsB, cv2.UMat):
             descriptors = descriptorsB.get()
         else:
             descriptors = descriptorsB
-        descriptors = np.array([descriptors[m.trainIdx] for m in matches], dtype=descriptors.dtype)
+        descriptors = descriptors[train[mask]]
 
         if len(ptsA) < self._min_matches:
             print("prune fail")
@@ -4,6 +4,7 @@
 """
 
 from EasyVision.engine.base import *
+from EasyVision.engine.bundleadjustment import BundleAdjustmentMixin
 from EasyVision.processors.base import *
 from EasyVision.processors import FeatureExtraction, CalibratedCamera, FeatureMatchingMixin, Features
 from EasyVision.vision import PyroCapture
@@ -15,13 +16,15 @@ except:
     pass
 
 
-class VisualOdometry3D2DEngine(FeatureMatchingMixin, OdometryBase):
+class VisualOdometry3D2DEngine(FeatureMatchingMixin, BundleAdjustmentMixin, OdometryBase):
     """Class that implement Monocular Visual Odometry 3D-2D algorithm.
 
     All feature types are supported except for FAST and GFTT, as only feature matching is implemented.
 
     ``compute`` method will return a frame and computed pose. If pose is not available will return last available pose.
     If a map is provided, then ``map.update`` method will be called.
+    If a bundle adjuster is provided, then every frame with computed pose is added as a keyframe and PnP inliers
+    are added as landmarks observed from the last two frames.
 
     Visual odometry algorithm is as follows:
     1. capture a new frame
@@ -40,7 +43,8 @@ class VisualOdometry3D2DEngine(FeatureMatchingMixin, OdometryBase):
     """
 
     def __init__(self, vision, _map=None, feature_type=None, pose=None, num_features=3000,
-                 min_matches=30, distance_thresh=None, reproj_thresh=None, reproj_error=None, *args, **kwargs):
+                 min_matches=30, distance_thresh=None, reproj_thresh=None, reproj_error=None, bundle_adjuster=None,
+                 *args, **kwargs):
         """Instance initialization.
 
         :param vision: capturing source object.
@@ -54,6 +58,7 @@ class VisualOdometry3D2DEngine(FeatureMatchingMixin, OdometryBase):
         :param ratio: Lowe's ratio
         :param reproj_thresh: Reprojection threshold
         :param reproj_error: Reprojection Error used in triangulation
+        :param bundle_adjuster: an instance of BundleAdjuster for local bundle adjustment
         """
         feature_extractor_provided = False
         if not isinstance(vision, ProcessorBase) and not isinstance(vision, VisionBase) and not isinstance(vision, PyroCapture):
@@ -109,7 +114,7 @@ class VisualOdometry3D2DEngine(FeatureMatchingMixin, OdometryBase):
         if reproj_error is not None:
             self._reproj_thresh = reproj_error
 
-        super(VisualOdometry3D2DEngine, self).__init__(_vision, *args, **kwargs)
+        super(VisualOdometry3D2DEngine, self).__init__(_vision, bundle_adjuster=bundle_adjuster, *args, **kwargs)
 
     def setup(self):
         super(VisualOdometry3D2DEngine, self).setup()
@@ -138,20 +143,22 @@ class VisualOdometry3D2DEngine(FeatureMatchingMixin, OdometryBase):
 
         if len(self._images) == 3 and self._images[-3][1] is not None:
             # TODO filter those features that have similar distance from -3 and -2
-            matches = self._match_features(self._images[-3][1].descriptors, self._images[-1][0].descriptors,
-                                           self._feature_type, self._ratio, self._distance_thresh / 3, self._min_matches)
+            matches = self._match_indices(self._images[-3][1].descriptors, self._images[-1][0].descriptors,
+                                          self._feature_type, self._ratio, self._distance_thresh / 3, self._min_matches)
 
-            if matches is None or not matches:
+            if matches is None:
                 print("failed to find matches")
+                self._break_chain()
                 return frame, self._pose
 
-            points_3d = np.float32([self._images[-3][1].points3d[m.queryIdx] for m in matches])
-            points_2d = np.float32([self._images[-1][0].points[m.trainIdx].pt for m in matches])
+            query, train = matches.query, matches.train
+            points_3d = np.float32(self._images[-3][1].points3d[query])
+            points_2d = np.float32(self._images[-1][0].pt[train])
             if isinstance(self._images[-3][1].descriptors, cv2.UMat):
                 descriptors = self._images[-3][1].descriptors.get()
             else:
                 descriptors = self._images[-3][1].descriptors
-            descriptors = np.array([descriptors[m.queryIdx] for m in matches], dtype=descriptors.dtype)
+            descriptors = descriptors[query]
 
             _r, _t = None, None
             use_rt = False
@@ -179,6 +186,10 @@ class VisualOdometry3D2DEngine(FeatureMatchingMixin, OdometryBase):
             t *= -1
             if ret:
                 #points_3d_inliers = np.float32([points_3d[i].tolist()[0] for i in inliers])
+                if self._adjuster is not None:
+                    inliers_ = inliers.ravel()
+                    self._adjust_matches(R.T, -absolute_scale * t, absolute_scale * points_3d[inliers_],
+                                         self._images[-3][1].pt[query[inliers_]], points_2d[inliers_])
                 if self._pose:
                     self._pose = self._pose._replace(
                         timestamp=frame.timestamp,
@@ -192,12 +203,14 @@ class VisualOdometry3D2DEngine(FeatureMatchingMixin, OdometryBase):
 
                 if self._map is not None:
                     self._pose = self._map.update(self._pose, scale=absolute_scale)
+            else:
+                self._break_chain()
 
             if self.debug and featuresA is not None and featuresB is not None:
                 img = cv2.cvtColor(self._images[1][2], cv2.COLOR_GRAY2BGR)
                 img = img.get() if isinstance(img, cv2.UMat) else img
-                last = [kp.pt for kp in featuresA.points]
-                current = [kp.pt for kp in featuresB.points]
+                last = featuresA.pt
+                current = featuresB.pt
                 for i, p in enumerate(zip(last, current)):
                     a, b = p
                     m = i in inliers
@@ -207,6 +220,8 @@ class VisualOdometry3D2DEngine(FeatureMatchingMixin, OdometryBase):
                     p = projected_2d[i][0]
                     cv2.circle(img, (int(p[0][0]), int(p[0][1])), 2, (255, 0, 0))
                 cv2.imshow(self.name, img)
+        else:
+            self._break_chain()
 
         return frame, self._pose
 
@@ -252,6 +267,21 @@ class VisualOdometry3D2DEngine(FeatureMatchingMixin, OdometryBase):
                 {'feature_type': ('FREAK', 'SURF', 'SIFT', 'ORB', 'KAZE', 'AKAZE')}
             )
 
+    def _adjust_matches(self, R, t, points_3d, last_points_2d, points_2d):
+        """Helper method to add current frame to the bundle adjuster.
+
+        :param R: relative rotation from last frame to current frame
+        :param t: relative translation from last frame to current frame
+        :param points_3d: inlier 3d points in last frame coordinates
+        :param last_points_2d: inlier points in last frame
+        :param points_2d: inlier points in current frame
+        """
+        last, Rl, tl, keyframe = self._chain_keyframe(R, t)
+        ids = self._adjuster.add_landmarks((points_3d.reshape(-1, 3) - tl).dot(Rl))
+        self._adjuster.add_observations(last, ids, last_points_2d)
+        self._adjuster.add_observations(keyframe, ids, points_2d)
+        self._adjuster.request()
+
     def _calculate_3d(self, featuresA, featuresB, scale):
         """Helper method to calculate 3D points from two consecutive frames.
 
@@ -263,9 +293,9 @@ class VisualOdometry3D2DEngine(FeatureMatchingMixin, OdometryBase):
         kpsA, descriptorsA, _ = featuresA
         kpsB, descriptorsB, _ = featuresB
 
-        matches = self._match_features(descriptorsA, descriptorsB, self._feature_type, self._ratio, self._distance_thresh, self._min_matches)
+        matches = self._match_indices(descriptorsA, descriptorsB, self._feature_type, self._ratio, self._distance_thresh, self._min_matches)
 
-        if matches is None or not matches:
+        if matches is None:
             return None, None
 
         umat_descriptors = isinstance(descriptorsA, cv2.UMat)
@@ -273,20 +303,17 @@ class VisualOdometry3D2DEngine(FeatureMatchingMixin, OdometryBase):
             descriptorsA = descriptorsA.get()
             descriptorsB = descriptorsB.get()
 
-        kpsA = [kpsA[m.queryIdx] for m in matches]
-        kpsB = [kpsB[m.trainIdx] for m in matches]
-        mask = [0.5 < p[0] ** 2 + p[1] ** 2 < 200 * 200 for p in ((a.pt[0] - b.pt[0], a.pt[1] - b.pt[1]) for a, b in zip(kpsA, kpsB))]
-        if sum(mask) < self._min_matches:
+        query, train = matches.query, matches.train
+        distance = ((featuresA.pt[query] - featuresB.pt[train]) ** 2).sum(axis=1)
+        mask = (0.5 < distance) & (distance < 200 * 200)
+        if mask.sum() < self._min_matches:
             print("prune fail")
             return None, None
 
-        kpsA = [p for M, p in zip(mask, kpsA) if M]
-        kpsB = [p for M, p in zip(mask, kpsB) if M]
-        dA = [descriptorsA[m.queryIdx] for M, m in zip(mask, matches) if M]
-        dB = [descriptorsB[m.trainIdx] for M, m in zip(mask, matches) if M]
+        query, train = query[mask], train[mask]
 
-        current = np.float32([kp.pt for kp in kpsB])
-        last = np.float32([kp.pt for kp in kpsA])
+        current = np.float32(featuresB.pt[train])
+        last = np.float32(featuresA.pt[query])
 
         E, mask = cv2.findEssentialMat(current, last, focal=self._camera.focal_point[0], pp=self._camera.center,
                                        method=cv2.RANSAC, prob=0.999, threshold=self._reproj_thresh)
@@ -297,13 +324,13 @@ class VisualOdometry3D2DEngine(FeatureMatchingMixin, OdometryBase):
             print("recoverPose fail")
             return None, None
 
-        kpsA = [kp for m, kp in zip(mask, kpsA) if m]
-        kpsB = [kp for m, kp in zip(mask, kpsB) if m]
-        dA = np.array([d for m, d in zip(mask, dA) if m], dtype=descriptorsA.dtype)
-        dB = np.array([d for m, d in zip(mask, dB) if m], dtype=descriptorsB.dtype)
+        mask = mask.ravel() != 0
+        query, train = query[mask], train[mask]
+        kpsA, kpsB = kpsA[query], kpsB[train]
+        dA, dB = descriptorsA[query], descriptorsB[train]
 
-        last = np.float32([kp.pt for kp in kpsA])
-        current = np.float32([kp.pt for kp in kpsB])
+        last = np.float32(featuresA.pt[query])
+        current = np.float32(featuresB.pt[train])
 
         P1 = np.dot(self._camera.matrix, np.hstack((np.eye(3, 3), np.zeros((3, 1)))))
         P2 = np.dot(self._camera.matrix, np.hstack((R, t)))
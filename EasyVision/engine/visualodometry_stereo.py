@@ -3,9 +3,12 @@
 
 """
 from EasyVision.engine.base import *
+from EasyVision.engine.bundleadjustment import BundleAdjustmentMixin, BundleAdjuster
 from EasyVision.processors.base import *
 from EasyVision.processors import FeatureExtraction, StereoCamera, CalibratedStereoCamera, FeatureMatchingMixin
 from EasyVision.vision import PyroCapture
+from collections import namedtuple
+from time import time
 import cv2
 import numpy as np
 try:
@@ -14,7 +17,10 @@ except:
     pass
 
 
-class VisualOdometryStereoEngine(FeatureMatchingMixin, OdometryBase):
+StageTimings = namedtuple('StageTimings', 'capture triangulation matching pose map total')
+
+
+class VisualOdometryStereoEngine(FeatureMatchingMixin, BundleAdjustmentMixin, OdometryBase):
     """Class that implement Stereo Visual Odometry algorithm. Requires CalibratedStereoCamera.
 
     All feature types are supported except for FAST and GFTT, as only feature matching is implemented.
@@ -28,17 +34,46 @@ class VisualOdometryStereoEngine(FeatureMatchingMixin, OdometryBase):
     3. if last frame is available:
     3.1. use solvePnPRansac to calculate relative pose
     3.2. calculate reprojection error
-    3.3. if reprojection error is larger than specified, go to 3.1. with slightly different parameters
+    3.3. if reprojection error is larger than specified, go to 3.1. with lower RANSAC confidence
     4. update current pose
     5. call ``map.update`` if map is provided
     6. return current pose
+
+    PnP retries stop according to ``exit_strategy``:
+        error
+            the first attempt with mean inlier reprojection error below ``reproj_error`` is accepted
+        inliers
+            same as error, but the attempt must also have at least ``min_inlier_ratio`` inliers. If no attempt does,
+            the acceptable attempt with the lowest error is used
+        best
+            all attempts are run and the acceptable one with the lowest error is used
+
+    Time spent in every stage of the last frame is available as ``timings`` and averages over all frames
+    as ``average_timings``.
+
+    If ``keyframes`` is set, frames are tracked against a local map instead of the previous frame:
+    1. the first frame becomes a keyframe, its triangulated points become map landmarks with their descriptors
+    2. the pose of a new frame is predicted with a constant velocity model
+    3. landmarks are projected with the predicted pose and matched only with features within ``search_radius``
+    4. solvePnPRansac calculates the pose from landmark matches
+    5. if the ratio of tracked landmarks to landmarks tracked at the last keyframe drops below ``min_overlap``,
+       the frame becomes a new keyframe. Landmarks not tracked during the last ``local_keyframes`` keyframes are dropped
+    Stereo triangulation is thus only done for keyframes, and a stationary camera does not accumulate drift.
+
+    If ``bundle_adjuster`` is provided, keyframes with landmark observations are added to it and optimization of
+    the last keyframes is requested. Without ``keyframes`` every frame with a pose is a keyframe and landmarks are
+    inlier matches followed from frame to frame. Corrections are applied to the pose once they are published.
     """
 
+    EXIT_STRATEGIES = ('error', 'inliers', 'best')
+
     def __init__(self, vision, _map=None, feature_type=None, pose=None,
                  num_features=None, nlevels=None,
                  ratio=None, distance_thresh=None, reproj_thresh=None, reproj_error=None,
                  min_dZ=None, max_dZ=None, max_dY=None, max_dX=None,
-                 *args, **kwargs):
+                 pnp_attempts=10, pnp_iterations=100, confidence=.999, confidence_step=.1, exit_strategy='error',
+                 min_inlier_ratio=.5, keyframes=False, search_radius=10, min_overlap=.5, local_keyframes=5,
+                 bundle_adjuster=None, *args, **kwargs):
         """Instance Initialization.
 
         :param vision: capturing source object. Must contain CalibratedStereoCamera processor.
@@ -55,7 +90,23 @@ class VisualOdometryStereoEngine(FeatureMatchingMixin, OdometryBase):
         :param max_dZ: maximum feature distance difference for stereo matching
         :param max_dY: maximum feature Y difference for stereo matching
         :param max_dX: maximum feature X difference for stereo matching
+        :param pnp_attempts: maximum number of solvePnPRansac attempts per frame
+        :param pnp_iterations: number of RANSAC iterations per attempt
+        :param confidence: RANSAC confidence of the first attempt
+        :param confidence_step: decrease of RANSAC confidence with every attempt. Confidence is kept positive.
+        :param exit_strategy: strategy to stop PnP attempts. One of error, inliers, best
+        :param min_inlier_ratio: minimum ratio of inliers for inliers exit strategy
+        :param keyframes: indicates whether to track frames against a local map of keyframe landmarks
+        :param search_radius: radius in pixels of the search window around projected landmarks
+        :param min_overlap: ratio of tracked landmarks below which a new keyframe is inserted
+        :param local_keyframes: number of keyframes during which a landmark stays in the local map if not tracked
+        :param bundle_adjuster: optional instance of BundleAdjuster created with the left camera matrix.
+                                Its history must cover ``local_keyframes``, so that local map landmarks are kept
         """
+        if exit_strategy not in VisualOdometryStereoEngine.EXIT_STRATEGIES:
+            raise ValueError("Exit strategy must be one of %s" % ", ".join(VisualOdometryStereoEngine.EXIT_STRATEGIES))
+        if isinstance(bundle_adjuster, BundleAdjuster) and keyframes and bundle_adjuster.history < local_keyframes:
+            raise ValueError("Bundle adjuster history must not be shorter than local keyframes")
 
         if not isinstance(_map, MapBase) and _map is not None:
             raise TypeError("Occupancy Map must be of type MapBase")
@@ -102,6 +153,30 @@ class VisualOdometryStereoEngine(FeatureMatchingMixin, OdometryBase):
 
         self._map = _map
 
+        self._pnp_attempts = pnp_attempts
+        self._pnp_iterations = pnp_iterations
+        self._confidence = confidence
+        self._confidence_step = confidence_step
+        self._exit_strategy = exit_strategy
+        self._min_inlier_ratio = min_inlier_ratio
+        self._timings = None
+        self._total_timings = np.zeros(len(StageTimings._fields))
+        self._frames = 0
+
+        self._keyframes = keyframes
+        self._search_radius = search_radius
+        self._min_overlap = min_overlap
+        self._local_keyframes = local_keyframes
+        self._keyframe_count = 0
+        self._keyframe_tracked = 0
+        self._landmarks = None
+        self._landmark_descriptors = None
+        self._landmark_keyframe = None
+        self._landmark_ids = None
+        self._world_pose = None
+        self._velocity = None
+        self._last_ids = None
+
         self._ratio = 0.7
         self._distance_thresh = 100
         self._min_matches = 10
@@ -140,7 +215,7 @@ class VisualOdometryStereoEngine(FeatureMatchingMixin, OdometryBase):
         if max_dY is not None:
             self._dY = max_dY
 
-        super(VisualOdometryStereoEngine, self).__init__(_vision, *args, **kwargs)
+        super(VisualOdometryStereoEngine, self).__init__(_vision, bundle_adjuster=bundle_adjuster, *args, **kwargs)
 
     def setup(self):
         super(VisualOdometryStereoEngine, self).setup()
@@ -153,67 +228,48 @@ class VisualOdometryStereoEngine(FeatureMatchingMixin, OdometryBase):
             self._map.release()
 
     def compute(self):
+        start = time()
         frame = self.vision.capture()
         if not frame:
             print('no frame')
             return None
+        timings = [time() - start, 0, 0, 0, 0]
+
+        if self._keyframes:
+            return self._track_local_map(frame, timings, start)
 
+        stage = time()
         stereo_features = self._calculate_3d(frame.images[0].features, frame.images[1].features)
+        timings[1] = time() - stage
 
         if self._last_3dfeatures is not None:
+            stage = time()
             matches = self._match_stereo(self._last_3dfeatures, stereo_features)
             self._last_3dfeatures = stereo_features
+            timings[2] = time() - stage
 
             if matches is None or not matches:
                 self._last_frame = frame
+                self._last_ids = None
+                self._update_timings(timings, start)
                 print('no matches')
                 return frame, self._pose
 
-            last_points_2d, last_points_3d, _, new_points_2d, new_points_3d, new_descriptors, last_points_2d_right, new_points_2d_right = matches
-
-            _r, _t = None, None
-            use_rt = False
-            if self._last_pose:
-                R, _t = self._last_pose[1:3]
-                _r, _ = cv2.Rodrigues(R)
-                _r *= -1
-                _t *= -1
-                use_rt = True
-
-            for iteration in range(10):
-                ret, r, t, inliers = cv2.solvePnPRansac(last_points_3d, new_points_2d, self._camera.left.matrix, None,
-                                                        _r, _t, use_rt, reprojectionError=self._reproj_error, confidence=.999 - .1 * iteration, iterationsCount=100)
-                projected_2d, _ = cv2.projectPoints(last_points_3d, r, t, self._camera.left.matrix, None)
-
-                reproj_error_inliers = sum(p.dot(p) ** .5 for i, p in enumerate(a - b[0] for a, b in zip(new_points_2d, projected_2d)) if i in inliers) / len(inliers)
-                reproj_error = sum(p.dot(p) ** .5 for p in (a - b[0] for a, b in zip(new_points_2d, projected_2d))) / len(new_points_2d)
-                if reproj_error_inliers < self._reproj_error:
-                    R, _ = cv2.Rodrigues(r * -1)
-                    t *= -1
-                    dZ = sum(i[0] ** 2 for i in t) ** .5
-                    break
-                else:
-                    print('failed to find inliers', reproj_error_inliers, '<', self._reproj_error)
-            else:
-                ret = False
+            last_points_2d, last_points_3d, _, new_points_2d, new_points_3d, new_descriptors, last_points_2d_right, new_points_2d_right = matches[:8]
+
+            stage = time()
+            ret, R, t, mask, projected_2d, reproj_error_inliers, reproj_error = self._estimate_pose(last_points_3d, new_points_2d)
+            timings[3] = time() - stage
 
             if ret:
-                new_points_3d_inliers = np.float32([new_points_3d[i].tolist()[0] for i in inliers])
-
-                if self._pose:
-                    self._pose = self._pose._replace(
-                        timestamp=frame.timestamp,
-                        translation=self._pose.translation + self._pose.rotation.dot(t),
-                        rotation=R.dot(self._pose.rotation),
-                        features=Features(new_points_2d, new_descriptors, new_points_3d_inliers)
-                    )
-                else:
-                    self._pose = Pose(frame.timestamp, R, t, Features(new_points_2d, new_descriptors, new_points_3d_inliers))
-                self._last_pose = Pose(frame.timestamp, R, t, Features(new_points_2d, new_descriptors, new_points_3d_inliers))
-
-                if self._map is not None:
-                    self._pose = self._map.update(self._pose)
+                dZ = np.sqrt(np.dot(t.ravel(), t.ravel()))
+                if self._adjuster is not None:
+                    self._adjust_matches(R, t, matches, mask, stereo_features)
+                features = Features(new_points_2d, new_descriptors, np.float32(new_points_3d[mask]))
+                timings[4] = self._update_pose(frame, R, t, features)
             else:
+                self._last_ids = None
+                dZ = 0
                 print('not found')
 
             if self.debug:
@@ -241,7 +297,7 @@ class VisualOdometryStereoEngine(FeatureMatchingMixin, OdometryBase):
                 text = "Number of matching features: %i" % len(new_points_2d)
                 cv2.putText(self.features, text, (20, 40), cv2.FONT_HERSHEY_PLAIN, 1, (255, 255, 255), 1, 8)
 
-                text = "Number of inliers: %i" % len(inliers)
+                text = "Number of inliers: %i" % np.count_nonzero(mask)
                 cv2.putText(self.features, text, (20, 55), cv2.FONT_HERSHEY_PLAIN, 1, (255, 255, 255), 1, 8)
 
                 MIN = min(a[2] - b[2] for a, b in zip(last_points_3d, new_points_3d))
@@ -269,46 +325,344 @@ class VisualOdometryStereoEngine(FeatureMatchingMixin, OdometryBase):
 
                 for i, P in enumerate(zip(last_points_2d, last_points_2d_right)):
                     l, r = P
-                    cv2.line(img, (int(l[0]), int(l[1])), (int(r[0]), int(r[1])), (0, 255 if i in inliers else 0, 0 if i in inliers else 255))
+                    cv2.line(img, (int(l[0]), int(l[1])), (int(r[0]), int(r[1])), (0, 255 if mask[i] else 0, 0 if mask[i] else 255))
                 for i, P in enumerate(zip(new_points_2d, new_points_2d_right)):
                     l, r = P
-                    cv2.line(img, (int(l[0]), int(l[1]) + h), (int(r[0]), int(r[1]) + h), (0, 255 if i in inliers else 0, 0 if i in inliers else 255))
+                    cv2.line(img, (int(l[0]), int(l[1]) + h), (int(r[0]), int(r[1]) + h), (0, 255 if mask[i] else 0, 0 if mask[i] else 255))
 
                 for i, P in enumerate(zip(last_points_2d, new_points_2d)):
                     l, n = P
-                    cv2.line(img, (int(l[0]), int(l[1])), (int(n[0]), int(n[1]) + h), (255 if i in inliers else 0, 0, 0 if i in inliers else 255))
+                    cv2.line(img, (int(l[0]), int(l[1])), (int(n[0]), int(n[1]) + h), (255 if mask[i] else 0, 0, 0 if mask[i] else 255))
 
                 for p in projected_2d:
-                    cv2.circle(img, (int(p[0][0]), int(p[0][1]) + h), 3, (0, 0, 255))
+                    cv2.circle(img, (int(p[0]), int(p[1]) + h), 3, (0, 0, 255))
 
                 cv2.imshow("feature matches", img)
                 cv2.imshow("3D points", self.features)
 
                 if reproj_error_inliers > 5:
-                    print('fail')
-                    print(last_points_3d.tolist())
-                    print(new_points_2d.tolist())
-                    if use_rt:
-                        print(_r.tolist())
-                        print(_t.tolist())
-                    print(self._camera.left.matrix.tolist())
-
+                    # pause on badly aligned frames
                     cv2.waitKey(0)
 
         self._last_frame = frame
         self._last_3dfeatures = stereo_features
+        self._update_timings(timings, start)
+        return frame, self._pose
+
+    def _update_pose(self, frame, R, t, features):
+        """Helper method to compose current pose with relative pose and to update the map
+
+        :return: time spent updating the map
+        """
+        if self._pose:
+            self._pose = self._pose._replace(
+                timestamp=frame.timestamp,
+                translation=self._pose.translation + self._pose.rotation.dot(t),
+                rotation=R.dot(self._pose.rotation),
+                features=features
+            )
+        else:
+            self._pose = Pose(frame.timestamp, R, t, features)
+        self._last_pose = Pose(frame.timestamp, R, t, features)
+
+        if self._map is None:
+            return 0
+        stage = time()
+        self._pose = self._map.update(self._pose)
+        return time() - stage
+
+    def _adjust_matches(self, R, t, matches, mask, stereo_features):
+        """Helper method to add the frame as a keyframe to the bundle adjuster with observations of inlier matches.
+        Landmarks are created for inliers of the last frame that were not observed before.
+
+        :param R: relative rotation as returned by ``_estimate_pose``
+        :param t: relative translation as returned by ``_estimate_pose``
+        :param matches: matches as returned by ``_match_stereo``
+        :param mask: inlier mask of matches
+        :param stereo_features: stereo features of the frame
+        """
+        last_points_2d, last_points_3d, _, new_points_2d = matches[:4]
+        query, train = matches[8:]
+        if self._last_ids is None:
+            self._break_chain()
+        last, Rl, tl, keyframe = self._chain_keyframe(R.T, -t)
+
+        ids = self._last_ids[query[mask]] if self._last_ids is not None else np.full(np.count_nonzero(mask), -1)
+        new = ids < 0
+        if np.any(new):
+            ids[new] = self._adjuster.add_landmarks((last_points_3d[mask][new] - tl).dot(Rl))
+            self._adjuster.add_observations(last, ids[new], last_points_2d[mask][new])
+        self._adjuster.add_observations(keyframe, ids, new_points_2d[mask])
+
+        self._last_ids = np.full(len(stereo_features[2]), -1, np.int64)
+        self._last_ids[train[mask]] = ids
+        self._adjuster.request()
+
+    def _track_local_map(self, frame, timings, start):
+        """Tracks the frame against the local map and inserts a keyframe if necessary
+
+        :return: (frame, pose)
+        """
+        features = frame.images[0].features
+        if self._landmarks is None or not len(self._landmarks):
+            # local map is started at the last known pose once landmarks are triangulated
+            stage = time()
+            self._insert_keyframe(frame, *(self._world_pose or (np.eye(3), np.zeros(3))))
+            timings[1] = time() - stage
+            self._last_frame = frame
+            self._update_timings(timings, start)
+            return frame, self._pose
+
+        corrected = self._apply_adjustment(*self._world_pose)
+        if corrected is not None:
+            self._world_pose = corrected
+            self._landmarks = self._adjuster.landmarks(self._landmark_ids)
+
+        # the pose predicted by the motion model is tried first, then the last pose with a wider search window
+        guesses = [(self._world_pose, self._search_radius * 2)]
+        if self._velocity is not None:
+            Rv, tv = self._velocity
+            Rl, tl = self._world_pose
+            guesses.insert(0, ((Rv.dot(Rl), Rv.dot(tl) + tv), self._search_radius))
+
+        best = None
+        for (Rw, tw), radius in guesses:
+            stage = time()
+            matches = self._match_local_map(features, Rw, tw, radius)
+            timings[2] += time() - stage
+            if matches is None:
+                continue
+
+            stage = time()
+            r, _ = cv2.Rodrigues(Rw)
+            ret, r, t, mask = self._solve_pnp(self._landmarks[matches.query], np.float32(features.pt[matches.train]),
+                                              r, tw.reshape(3, 1))[:4]
+            timings[3] += time() - stage
+            if ret and (best is None or np.count_nonzero(mask) > np.count_nonzero(best[3])):
+                best = matches, r, t, mask
+            if best is not None and np.count_nonzero(best[3]) >= self._min_overlap * self._keyframe_tracked:
+                break
+
+        if best is None:
+            # tracking is lost, start a new local map at the last known pose
+            if self.debug:
+                print('not found')
+            stage = time()
+            self._velocity = None
+            self._insert_keyframe(frame, *self._world_pose)
+            timings[1] = time() - stage
+            self._last_frame = frame
+            self._update_timings(timings, start)
+            return frame, self._pose
+
+        # landmarks are matched again with the estimated pose and a narrow window to drop wrong matches of the guess
+        matches, r, t, mask = best
+        stage = time()
+        refined = self._match_local_map(features, cv2.Rodrigues(r)[0], t.ravel(), self._search_radius / 2.)
+        timings[2] += time() - stage
+        if refined is not None:
+            stage = time()
+            result = self._solve_pnp(self._landmarks[refined.query], np.float32(features.pt[refined.train]), r, t)[:4]
+            timings[3] += time() - stage
+            if result[0]:
+                matches, r, t, mask = (refined,) + result[1:]
+
+        points_2d = np.float32(features.pt[matches.train])
+        Rc, _ = cv2.Rodrigues(r)
+        tc = t.ravel()
+        Rl, tl = self._world_pose
+        Rv = Rc.dot(Rl.T)
+        self._velocity = Rv, tc - Rv.dot(tl)
+        self._world_pose = Rc, tc
+
+        descriptors = features.descriptors
+        descriptors = descriptors.get() if isinstance(descriptors, cv2.UMat) else descriptors
+        tracked = matches.query[mask]
+        points_3d = np.float32(self._landmarks[tracked].dot(Rc.T) + tc)
+        # relative pose is expressed the same way as for frame to frame tracking
+        R, t = Rv.T, -self._velocity[1].reshape(3, 1)
+        timings[4] = self._update_pose(frame, R, t, Features(points_2d, descriptors[matches.train], points_3d))
+
+        if len(tracked) < self._min_overlap * self._keyframe_tracked:
+            stage = time()
+            self._insert_keyframe(frame, Rc, tc, tracked, matches.train[mask])
+            timings[1] = time() - stage
+
+        self._last_frame = frame
+        self._update_timings(timings, start)
         return frame, self._pose
 
+    def _match_local_map(self, features, R, t, radius):
+        """Matches landmarks of the local map projected with the predicted pose against frame features
+
+        :param features: left image features
+        :param R: predicted rotation of the camera from world coordinates
+        :param t: predicted translation of the camera from world coordinates
+        :param radius: search window radius in pixels
+        :return: record array of matches, where query are landmark indices and train are feature indices, or None
+        """
+        points = self._landmarks.dot(R.T) + t
+        visible = np.flatnonzero(points[:, 2] > 0)
+        if not len(visible):
+            return None
+
+        projected = points[visible].dot(self._camera.left.matrix.T)
+        projected = projected[:, :2] / projected[:, 2:]
+        matches = self._match_guided(projected, self._landmark_descriptors[visible], features.pt, features.descriptors,
+                                     self._feature_type, radius, self._ratio, self._distance_thresh,
+                                     self._min_matches)
+        if matches is not None:
+            matches.query = visible[matches.query]
+        return matches
+
+    def _insert_keyframe(self, frame, R, t, tracked=(), tracked_features=()):
+        """Triangulates frame features and adds them as landmarks to the local map.
+        Features that were tracked are not added again. Old landmarks are dropped.
+
+        :param frame: stereo frame
+        :param R: rotation of the camera from world coordinates
+        :param t: translation of the camera from world coordinates
+        :param tracked: indices of landmarks tracked in the frame. If empty, local map is restarted
+        :param tracked_features: indices of left image features that were tracked
+        :return: True if keyframe was inserted. If local map could not be restarted, it is cleared.
+        """
+        stereo_features = self._calculate_3d(frame.images[0].features, frame.images[1].features)
+        new = None
+        if stereo_features is not None:
+            left, _, points_3d, new_descriptors, indices = stereo_features
+            new = (points_3d[:, 2] > 0) & ~np.in1d(indices, tracked_features)
+        if not len(tracked) and (new is None or not np.any(new)):
+            self._landmarks = self._landmark_descriptors = self._landmark_keyframe = self._landmark_ids = None
+            self._keyframe_tracked = 0
+            return False
+
+        self._keyframe_count += 1
+        self._world_pose = R, t
+        adjuster_keyframe = self._add_keyframe(R, t) if self._adjuster is not None else None
+
+        if len(tracked):
+            if adjuster_keyframe is not None:
+                self._adjuster.add_observations(adjuster_keyframe, self._landmark_ids[tracked],
+                                                frame.images[0].features.pt[tracked_features])
+            self._landmark_keyframe[tracked] = self._keyframe_count
+            keep = self._landmark_keyframe > self._keyframe_count - self._local_keyframes
+            landmarks = self._landmarks[keep]
+            descriptors = self._landmark_descriptors[keep]
+            keyframe = self._landmark_keyframe[keep]
+            ids = self._landmark_ids[keep]
+        else:
+            landmarks, descriptors, keyframe, ids = np.zeros((0, 3)), None, np.zeros(0, np.int32), np.zeros(0, np.int64)
+
+        added = 0
+        if new is not None:
+            new_descriptors = new_descriptors.get() if isinstance(new_descriptors, cv2.UMat) else new_descriptors
+            added = np.count_nonzero(new)
+            new_landmarks = (points_3d[new] - t).dot(R)
+            if adjuster_keyframe is not None:
+                new_ids = self._adjuster.add_landmarks(new_landmarks)
+                self._adjuster.add_observations(adjuster_keyframe, new_ids, left[new])
+            else:
+                new_ids = np.full(added, -1, np.int64)
+            landmarks = np.concatenate((landmarks, new_landmarks))
+            descriptors = new_descriptors[new] if descriptors is None else np.concatenate((descriptors, new_descriptors[new]))
+            keyframe = np.concatenate((keyframe, np.full(added, self._keyframe_count, np.int32)))
+            ids = np.concatenate((ids, new_ids))
+
+        if descriptors is not None:
+            self._landmarks, self._landmark_descriptors, self._landmark_keyframe = landmarks, descriptors, keyframe
+            self._landmark_ids = ids
+        self._keyframe_tracked = len(tracked) + added
+        if adjuster_keyframe is not None:
+            self._adjuster.request()
+        return True
+
+    def _estimate_pose(self, points_3d, points_2d):
+        """Estimates relative pose using solvePnPRansac with decreasing confidence until exit strategy is satisfied.
+        The previous relative pose is used as the initial guess.
+
+        :param points_3d: Nx3 points of the last frame
+        :param points_2d: Nx2 points of the new frame
+        :return: (ret, R, t, inlier mask, projected points, mean inlier error, mean error)
+        """
+        _r, _t = None, None
+        if self._last_pose:
+            _r, _ = cv2.Rodrigues(self._last_pose.rotation)
+            _r, _t = -_r, -np.float64(self._last_pose.translation)
+
+        result = self._solve_pnp(points_3d, points_2d, _r, _t)
+        if not result[0]:
+            return result
+        ret, r, t = result[:3]
+        R, _ = cv2.Rodrigues(-r)
+        return (True, R, -t) + result[3:]
+
+    def _solve_pnp(self, points_3d, points_2d, _r=None, _t=None):
+        """Runs solvePnPRansac attempts with decreasing confidence until exit strategy is satisfied.
+
+        :param points_3d: Nx3 object points
+        :param points_2d: Nx2 image points
+        :param _r: optional initial rotation vector
+        :param _t: optional initial translation vector
+        :return: (ret, rvec, tvec, inlier mask, projected points, mean inlier error, mean error)
+        """
+        use_rt = _r is not None
+        matrix = self._camera.left.matrix
+        count = len(points_2d)
+        best = None
+        last = None
+        for attempt in range(self._pnp_attempts):
+            ret, r, t, inliers = cv2.solvePnPRansac(points_3d, points_2d, matrix, None,
+                                                    None if _r is None else _r.copy(), None if _t is None else _t.copy(),
+                                                    use_rt, reprojectionError=self._reproj_error,
+                                                    confidence=max(self._confidence - self._confidence_step * attempt, 1e-3),
+                                                    iterationsCount=self._pnp_iterations)
+            if not ret or inliers is None or not len(inliers):
+                continue
+
+            projected, _ = cv2.projectPoints(points_3d, r, t, matrix, None)
+            projected = projected.reshape(-1, 2)
+            errors = np.sqrt(((points_2d - projected) ** 2).sum(axis=1))
+            mask = np.zeros(count, np.bool_)
+            mask[inliers.ravel()] = True
+            error_inliers = float(errors[mask].mean())
+            result = r, t, mask, projected, error_inliers, float(errors.mean())
+            last = result
+
+            if error_inliers >= self._reproj_error:
+                if self.debug:
+                    print('failed to find inliers', error_inliers, '<', self._reproj_error)
+                continue
+            if best is None or error_inliers < best[4]:
+                best = result
+            if self._exit_strategy == 'error':
+                break
+            if self._exit_strategy == 'inliers' and np.count_nonzero(mask) >= self._min_inlier_ratio * count:
+                best = result
+                break
+
+        if best is None:
+            if last is None:
+                return False, None, None, np.zeros(count, np.bool_), np.zeros((0, 2), np.float32), 0., 0.
+            return (False, None, None) + last[2:]
+
+        return (True,) + best
+
+    def _update_timings(self, timings, start):
+        """Helper method to store stage timings of the frame"""
+        self._timings = StageTimings(*(timings + [time() - start]))
+        self._total_timings += self._timings
+        self._frames += 1
+
     def _calculate_3d(self, featuresA, featuresB):
         """ Finds stereo correspondances and triangulates the points.
         will return corresponding left/right points and triangulated points
-        :return: (left, right, 3d points) or None
+        :return: (left, right, 3d points, left descriptors, left feature indices) or None
         """
         kpsA, descriptorsA, _ = featuresA
         kpsB, descriptorsB, _ = featuresB
-        matches = self._match_features(descriptorsA, descriptorsB, self._feature_type, self._ratio, self._distance_thresh, self._min_matches)
+        matches = self._match_indices(descriptorsA, descriptorsB, self._feature_type, self._ratio, self._distance_thresh, self._min_matches)
 
-        if matches is None or not matches:
+        if matches is None:
             return None
 
         umat_descriptors = isinstance(descriptorsA, cv2.UMat)
@@ -316,18 +670,17 @@ class VisualOdometryStereoEngine(FeatureMatchingMixin, OdometryBase):
             descriptorsA = descriptorsA.get()
             descriptorsB = descriptorsB.get()
 
-        kpsA = [kpsA[m.queryIdx] for m in matches]
-        kpsB = [kpsB[m.trainIdx] for m in matches]
-        mask = [abs(a.pt[1] - b.pt[1]) < self._dY and 0 < a.pt[0] - b.pt[0] < self._dX for a, b in zip(kpsA, kpsB)]
-
-        dA = np.array([descriptorsA[m.queryIdx] for M, m in zip(mask, matches) if M], dtype=descriptorsA.dtype)
-        dB = np.array([descriptorsB[m.trainIdx] for M, m in zip(mask, matches) if M], dtype=descriptorsB.dtype)
+        query, train = matches.query, matches.train
+        left = featuresA.pt[query]
+        right = featuresB.pt[train]
+        disparity = left[:, 0] - right[:, 0]
+        mask = (np.abs(left[:, 1] - right[:, 1]) < self._dY) & (0 < disparity) & (disparity < self._dX)
 
-        kpsA = [p for M, p in zip(mask, kpsA) if M]
-        kpsB = [p for M, p in zip(mask, kpsB) if M]
+        dA = descriptorsA[query[mask]]
+        dB = descriptorsB[train[mask]]
 
-        left = np.float32([kp.pt for kp in kpsA])
-        right = np.float32([kp.pt for kp in kpsB])
+        left = np.float32(left[mask])
+        right = np.float32(right[mask])
 
         if self._camera.left.projection is None or self._camera.left.projection is None:
             P1 = np.dot(self._camera.left.matrix, np.hstack((np.eye(3, 3), np.zeros((3, 1)))))
@@ -343,37 +696,40 @@ class VisualOdometryStereoEngine(FeatureMatchingMixin, OdometryBase):
         if umat_descriptors:
             dA = cv2.UMat(dA)
             dB = cv2.UMat(dB)
-        return left, right, point_3d, dA
+        return left, right, point_3d, dA, query[mask]
 
     def _match_stereo(self, last_features, new_features):
         """Matches Last frame features with new frame features.
         Filters matched features based on triangulated points.
 
-        :return: (last2d, last3d, last_descr, new2d, new3d, new_descr, last_points_right, new_points_right) or None
+        :return: (last2d, last3d, last_descr, new2d, new3d, new_descr, last_points_right, new_points_right,
+                 last indices, new indices) or None
         """
-        matches = self._match_features(last_features[3], new_features[3],
+        matches = self._match_indices(last_features[3], new_features[3],
                 self._feature_type, self._ratio, self._distance_thresh / 3, self._min_matches)
 
         if matches is None:
             return None
 
-        last_points_3d = [last_features[2][m.queryIdx] for m in matches]
-        new_points_3d = [new_features[2][m.trainIdx] for m in matches]
+        query, train = matches.query, matches.train
+        last_points_3d = np.float32(last_features[2])[query]
+        new_points_3d = np.float32(new_features[2])[train]
 
         dZ = 3 * sum(i[0] ** 2 for i in self._last_pose.translation) ** .5 if self._last_pose else self._dZ
         dZ = min(self._max_dZ, max(self._dZ, dZ))
         self._dZ = dZ
-        mask = [abs(a[2] - b[2]) < dZ for a, b in zip(last_points_3d, new_points_3d)]
+        mask = np.abs(last_points_3d[:, 2] - new_points_3d[:, 2]) < dZ
 
-        if sum(mask) < self._min_matches:
+        if mask.sum() < self._min_matches:
             return None
 
-        new_points_3d = np.float32([p for M, p in zip(mask, new_points_3d) if M])
-        last_points_3d = np.float32([p for M, p in zip(mask, last_points_3d) if M])
-        new_points_2d = np.float32([new_features[0][m.trainIdx] for M, m in zip(mask, matches) if M])
-        new_points_2d_right = np.float32([new_features[1][m.trainIdx] for M, m in zip(mask, matches) if M])
-        last_points_2d = np.float32([last_features[0][m.queryIdx] for M, m in zip(mask, matches) if M])
-        last_points_2d_right = np.float32([last_features[1][m.queryIdx] for M, m in zip(mask, matches) if M])
+        query, train = query[mask], train[mask]
+        new_points_3d = new_points_3d[mask]
+        last_points_3d = last_points_3d[mask]
+        new_points_2d = np.float32(new_features[0])[train]
+        new_points_2d_right = np.float32(new_features[1])[train]
+        last_points_2d = np.float32(last_features[0])[query]
+        last_points_2d_right = np.float32(last_features[1])[query]
 
         if isinstance(last_features[3], cv2.UMat):
             last_descriptors = last_features[3].get()
@@ -381,10 +737,10 @@ class VisualOdometryStereoEngine(FeatureMatchingMixin, OdometryBase):
         else:
             last_descriptors = last_features[3]
             new_descriptors = new_features[3]
-        last_descriptors = np.array([last_descriptors[m.queryIdx] for M, m in zip(mask, matches) if M], dtype=last_descriptors.dtype)
-        new_descriptors = np.array([new_descriptors[m.trainIdx] for M, m in zip(mask, matches) if M], dtype=new_descriptors.dtype)
+        last_descriptors = last_descriptors[query]
+        new_descriptors = new_descriptors[train]
 
-        return last_points_2d, last_points_3d, last_descriptors, new_points_2d, new_points_3d, new_descriptors, last_points_2d_right, new_points_2d_right
+        return last_points_2d, last_points_3d, last_descriptors, new_points_2d, new_points_3d, new_descriptors, last_points_2d_right, new_points_2d_right, query, train
 
     @property
     def feature_type(self):
@@ -404,6 +760,26 @@ class VisualOdometryStereoEngine(FeatureMatchingMixin, OdometryBase):
             raise TypeError("Pose must be of type Pose")
         self._pose = value
 
+    @property
+    def timings(self):
+        """Time in seconds spent in every stage of the last frame as StageTimings"""
+        return self._timings
+
+    @property
+    def average_timings(self):
+        """Average time in seconds spent in every stage as StageTimings"""
+        return StageTimings(*(self._total_timings / max(self._frames, 1)))
+
+    @property
+    def keyframe_count(self):
+        """Number of keyframes inserted so far if tracking against the local map"""
+        return self._keyframe_count
+
+    @property
+    def landmarks(self):
+        """Nx3 array of local map landmarks in coordinates of the first keyframe or None"""
+        return self._landmarks
+
     @property
     def relative_pose(self):
         return self._last_pose
@@ -6,6 +6,7 @@
 from .base import *
 from collections import namedtuple
 from EasyVision.vision import Image, Frame
+from EasyVision.processors import FeatureMatchingMixin
 import cv2
 import numpy as np
 
@@ -26,7 +27,15 @@ class ObjectModel(ModelBase):
         super(ObjectModel, self).__init__(name, views, *args, **kwargs)
         self.setup()
 
-    def compute(self, frame, matcher, **kwargs):
+    def compute(self, frame, matcher, pool=None, **kwargs):
+        """Matches all model views against a processed frame
+
+        :param frame: processed frame
+        :param matcher: matcher which subclasses FeatureMatchingMixin
+        :param pool: optional thread pool to match and verify views concurrently
+        :param kwargs: kwargs to pass to matcher
+        :return: a tuple of MatchResult
+        """
         if not isinstance(frame, Frame):
             raise TypeError("frame must be Frame type")
 
@@ -36,7 +45,16 @@ class ObjectModel(ModelBase):
             if not image.feature_type:
                 raise ValueError("Image must implement feature_type")
 
-        views = (self._match_view(frame, view, matcher, **kwargs) for view in self)
+        def match_view(view):
+            return self._match_view(frame, view, matcher, **kwargs)
+
+        views = list(self)
+        views = pool.map(match_view, views) if pool is not None and len(views) > 1 else [match_view(v) for v in views]
+
+        if self.display_results:
+            for view_matches in views:
+                if view_matches:
+                    self._draw(view_matches)
 
         return sum((v for v in views if v), ())
 
@@ -71,7 +89,8 @@ class ObjectModel(ModelBase):
         that case the object will occupy most of the camera view.
         """
         _, mask = cv2.threshold(mask, 180, 255, cv2.THRESH_BINARY)
-        _, contours, hierarchy = cv2.findContours(mask, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
+        # OpenCV 3 returns (image, contours, hierarchy), OpenCV 4 returns (contours, hierarchy)
+        contours, hierarchy = cv2.findContours(mask, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)[-2:]
 
         # Isolate largest contour
         contour_sizes = [(cv2.contourArea(contour), contour) for contour in contours]
@@ -98,7 +117,8 @@ class ObjectModel(ModelBase):
 
             thumb = thumb[y:y + h, x:x + w]
             outline = np.float32([(i[0][0] - x, i[0][1] - y) for i in outline])
-            kp = [p._replace(pt=(p.pt[0] - x, p.pt[1] - y)) for p in image.features.points]
+            kp = image.features.points.copy()
+            kp['pt'] -= (x, y)
             features = image.features._replace(points=kp)
         else:
             h, w, _ = image.image.shape
@@ -179,7 +199,11 @@ class ObjectModel(ModelBase):
             cv2.imshow(self.name, img)
             cv2.imshow("%s mask" % self.name, image.mask)
 
-        views = (self._match_view(frame, view, matcher, **kwargs) for view in self)
+        views = [self._match_view(frame, view, matcher, **kwargs) for view in self]
+        if self.display_results:
+            for view_matches in views:
+                if view_matches:
+                    self._draw(view_matches)
         views = sum((v for v in views if v), ())
 
         if not views:
@@ -192,13 +216,10 @@ class ObjectModel(ModelBase):
             return self
 
     def _match_view(self, frame, view, matcher, **kwargs):
-        """Helper method to match a view against a processed frame"""
+        """Helper method to match a view against a processed frame. Does not draw, thus is safe to run on a thread pool."""
         view_matches = (self._match_features(image, view, matcher, **kwargs) for image in (i for i in frame.images if i.feature_type == view.feature_type))
         view_matches = sum((v for v in view_matches if v), ())
 
-        if self.display_results:
-            self._draw(view_matches)
-
         return view_matches if view_matches else None
 
     def _match_features(self, image, view, matcher, display_results=False, **kwargs):
@@ -208,16 +229,30 @@ class ObjectModel(ModelBase):
         """
         kpsA, descriptorsA, _ = image.features
         kpsB, descriptorsB, _ = view.features
-        outline = view.outline
-        _outline = outline.reshape((-1, 1, 2))
 
-        matches = matcher._match_features(descriptorsA, descriptorsB, view.feature_type, min_matches=self._min_matches, **kwargs)
+        matches = matcher._match_indices(descriptorsA, descriptorsB, view.feature_type, min_matches=self._min_matches, **kwargs)
 
+        return self.verify_matches(image, view, matches)
+
+    def verify_matches(self, image, view, matches):
+        """Verifies matches between processed image and a view by computing homography, transforming outline and
+        checking if features are contained by the outline. Will repeat for remaining matches as the image may contain
+        several instances of the object.
+
+        :param image: processed image, i.e. query features
+        :param view: model view, i.e. train features
+        :param matches: matches record array as returned by ``FeatureMatchingMixin._match_indices``
+        :return: a tuple of MatchResult or None if not enough matches
+        """
         if matches is None or len(matches) < self._min_matches:
             return None
 
-        ptsA = np.float32([kpsA[m.queryIdx].pt for m in matches])
-        ptsB = np.float32([kpsB[m.trainIdx].pt for m in matches])
+        descriptorsB = view.features.descriptors
+        outline = view.outline
+        _outline = outline.reshape((-1, 1, 2))
+
+        ptsA = np.float32(image.features.pt[matches.query])
+        ptsB = np.float32(view.features.pt[matches.train])
 
         results = ()
 
@@ -227,23 +262,43 @@ class ObjectModel(ModelBase):
             if H is None:
                 return results
 
-            if sum(inliers) < self._min_matches or sum(inliers) < len(descriptorsB) * .01:
+            inliers = inliers.ravel() != 0
+            num_inliers = np.count_nonzero(inliers)
+            if num_inliers < self._min_matches or num_inliers < len(descriptorsB) * .01:
                 return results
 
             __outline = cv2.perspectiveTransform(_outline, H)
-            inside = [inlier and cv2.pointPolygonTest(__outline, (pt[0], pt[1]), False) >= 0 for inlier, pt in zip(inliers, ptsA)]
+            inside = inliers & ObjectModel._points_in_polygon(ptsA, __outline.reshape((-1, 2)))
 
-            if sum(inside) < self._min_matches:
+            if np.count_nonzero(inside) < self._min_matches:
                 return results
 
-            _matches = [m for i, m in zip(inside, matches) if i]
-            matches = [m for i, m in zip(inside, matches) if not i]
-            ptsA = np.float32([pt for i, pt in zip(inside, ptsA) if not i])
-            ptsB = np.float32([pt for i, pt in zip(inside, ptsB) if not i])
+            _matches = matches[inside]
+            matches = matches[~inside]
+            ptsA = ptsA[~inside]
+            ptsB = ptsB[~inside]
             results += (MatchResult(self, view, image, _matches, H, __outline),)
 
         return results
 
+    @staticmethod
+    def _points_in_polygon(points, polygon):
+        """Helper method to test which points are inside of a polygon using even-odd rule.
+        Vectorized replacement for calling ``cv2.pointPolygonTest`` for every point.
+
+        :param points: Nx2 array of points
+        :param polygon: Mx2 array of polygon vertices
+        :return: boolean array of length N
+        """
+        x, y = points[:, 0:1], points[:, 1:2]
+        xa, ya = polygon[:, 0], polygon[:, 1]
+        xb, yb = np.roll(xa, -1), np.roll(ya, -1)
+
+        crosses = (ya > y) != (yb > y)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x_cross = xa + (y - ya) * (xb - xa) / (yb - ya)
+        return np.count_nonzero(crosses & (x < x_cross), axis=1) % 2 == 1
+
     def _draw(self, view_matches):
         """Helper method to draw matches"""
         for index, match in enumerate(view_matches):
@@ -254,6 +309,6 @@ class ObjectModel(ModelBase):
                                flags=2)
             res = cv2.drawMatches(match.image.image, match.image.features.keypoints,
                                   match.view.image, match.view.features.keypoints,
-                                  match.matches, None, **params)
+                                  FeatureMatchingMixin.todmatches(match.matches), None, **params)
             res = cv2.polylines(res, [np.int32(match.outline)], True, [255, 0, 0], 3, 8)
             cv2.imshow(name, res)
\ No newline at end of file
@@ -9,6 +9,7 @@ from .imagetransform import ImageTransform
 from .histogrambackprojection import HistogramBackprojection
 from .backgroundseparation import BackgroundSeparation
 from .mptransform import MultiProcessing
+from .pptransform import ProcessPool
 from .mttransform import MultiThreading
 from .mctransform import MultiConsumers
 from .synchronization import Synchronize
@@ -6,6 +6,9 @@ Can also be used to build processor stacks with the help of Processor Stack Buil
 """
 
 from EasyVision.vision.base import *
+from EasyVision.vision import codec
+from EasyVision.vision.codec import KEYPOINT_DTYPE
+from multiprocessing.pool import ThreadPool
 import cv2
 import numpy as np
 
@@ -22,9 +25,13 @@ except:
 
 class KeyPoint(namedtuple('KeyPoint', 'pt size angle response octave class_id')):
     """KeyPoint struct that mirrors cv2.KeyPoint. Mainly used for serialization as pickle does not understand cv2.KeyPoint.
+
+    Features store keypoints as a structured array of ``KeyPoint.dtype``, which is a much more compact representation.
     """
     __slots__ = ()
 
+    dtype = KEYPOINT_DTYPE
+
     def todict(self):
         """Converts KeyPoint into a dictionary"""
         return self._asdict()
@@ -34,36 +41,70 @@ class KeyPoint(namedtuple('KeyPoint', 'pt size angle response octave class_id'))
         """Creates KeyPoint object from a dictionary"""
         return KeyPoint(**d)
 
+    @staticmethod
+    def toarray(keypoints):
+        """Converts a sequence of cv2.KeyPoint or KeyPoint items into a record array of ``KeyPoint.dtype``
+
+        :param keypoints: a sequence of objects with pt, size, angle, response, octave and class_id attributes
+        :return: numpy.recarray
+        """
+        points = np.array([(pt.pt, pt.size, pt.angle, pt.response, pt.octave, pt.class_id) for pt in keypoints],
+                          dtype=KeyPoint.dtype)
+        return points.view(np.recarray)
+
 
 class Features(namedtuple('Features', 'points descriptors points3d')):
     """Image Features structure.
-    Contains feature points either as 2d points or KeyPoint, descriptors and associated 3d points.
+    Contains feature points either as 2d points or keypoints, descriptors and associated 3d points.
     Basically points can be anything.
+
+    Keypoints are stored as a single record array of ``KeyPoint.dtype`` with fields
+    pt, size, angle, response, octave and class_id. Thus keypoint attributes can be accessed without creating
+    python objects, e.g. ``features.points['pt'][indices]`` or ``features.pt[indices]``.
     """
     __slots__ = ()
 
     def __new__(cls, points, descriptors, points3d=None):
-        if len(points) and hasattr(points[0], 'pt'):
-            points = tuple(KeyPoint(pt.pt, pt.size, pt.angle, pt.response, pt.octave, pt.class_id) for pt in points)
+        if isinstance(points, np.ndarray) and points.dtype.names:
+            points = points.view(np.recarray)
+        elif len(points) and hasattr(points[0], 'pt'):
+            points = KeyPoint.toarray(points)
         elif not isinstance(points, np.ndarray):
             points = np.float32(points)
         if not isinstance(points3d, np.ndarray) and points3d is not None:
             points3d = np.float32(points3d)
         return super(Features, cls).__new__(cls, points, descriptors, points3d)
 
+    @property
+    def has_keypoints(self):
+        """Returns True if points are keypoints"""
+        return self.points.dtype.names is not None
+
+    @property
+    def pt(self):
+        """Returns a Nx2 array of 2d point coordinates. Keypoints are not copied"""
+        return self.points['pt'] if self.has_keypoints else self.points
+
     @property
     def keypoints(self):
         """Returns a list of cv2.KeyPoint items for displaying purposes"""
-        return [cv2.KeyPoint(x=pt.pt[0], y=pt.pt[1], _size=pt.size, _angle=pt.angle,
-                             _response=pt.response, _octave=pt.octave, _class_id=pt.class_id) for pt in self.points]
+        if not self.has_keypoints:
+            return [cv2.KeyPoint(float(x), float(y), 1.0) for x, y in self.points.reshape(-1, 2).tolist()]
+        return [cv2.KeyPoint(x, y, size, angle, response, octave, class_id)
+                for (x, y), size, angle, response, octave, class_id in self.points.tolist()]
 
     def todict(self):
         """Converts Features into a dictionary"""
+        if self.has_keypoints:
+            points = [KeyPoint(tuple(pt[0]), *pt[1:]).todict() for pt in self.points.tolist()]
+        else:
+            points = self.points.tolist()
+        descriptors = self.descriptors.get() if isinstance(self.descriptors, cv2.UMat) else self.descriptors
         d = {
-            'points': [pt.todict() for pt in self.points] if len(points) and isinstance(points[0], KeyPoint) else self.points.tolist(),
-            'points3d': self.points.tolist(),
-            'descriptors': self.descriptors.tolist(),
-            'dtype': self.descriptors.dtype.name
+            'points': points,
+            'points3d': self.points3d.tolist() if self.points3d is not None else None,
+            'descriptors': descriptors.tolist(),
+            'dtype': descriptors.dtype.name
         }
         return d
 
@@ -79,22 +120,22 @@ class Features(namedtuple('Features', 'points descriptors points3d')):
         return Features(points, descriptors, d['points3d'])
 
     def tobytes(self):
-        """Uses pickle to serialize Features into bytes"""
-        return pickle.dumps(self, protocol=-1)
+        """Uses binary codec to serialize Features into bytes. Keypoints are packed into a structured array"""
+        return codec.encode(self)
 
     @staticmethod
     def frombytes(data):
-        """Uses pickle to deserialize Features from bytes"""
-        return pickle.loads(data)
+        """Uses binary codec to deserialize Features from bytes"""
+        return codec.decode(data)
 
     def tobuffer(self, buf):
-        """Uses pickle to serialize Features to buffer-like object"""
-        pickle.dump(self, buf, protocol=-1)
+        """Uses binary codec to serialize Features to buffer-like object"""
+        codec.write(buf, self)
 
     @staticmethod
     def frombuffer(buf):
-        """Uses pickle to deserialize Features from buffer-like object"""
-        return pickle.load(buf)
+        """Uses binary codec to deserialize Features from buffer-like object"""
+        return codec.read(buf)
 
     def __reduce__(self):
         """Used for pickle serialization in order to deal with UMat descriptors"""
@@ -108,6 +149,10 @@ class ProcessorBase(VisionBase):
     Mask is a string of '1' and '0', where index of the mask is the same as the index of frame image.
     Processor mask will override frame processor mask.
 
+    If ``parallel`` is set, images of a multi-image frame(e.g. stereo) will be processed concurrently using
+    a thread pool. Order of images is preserved. Note, that ``process`` must be thread safe in this case,
+    which is true for most OpenCV algorithms as they release the GIL.
+
     Abstract methods:
         process
 
@@ -120,7 +165,8 @@ class ProcessorBase(VisionBase):
         in ``__init__`` method. All internal attributes should be starting from "_", e.g. ``self._my_internal_var = 0``.
     """
 
-    def __init__(self, vision, processor_mask=None, append=False, null_image=False, enabled=True, *args, **kwargs):
+    def __init__(self, vision, processor_mask=None, append=False, null_image=False, enabled=True, parallel=False,
+                 *args, **kwargs):
         """Instance initialization. Must be called using super().__init__(*args, *kwargs)
 
         :param vision: capturing source object.
@@ -128,6 +174,7 @@ class ProcessorBase(VisionBase):
         :param append: indicates whether to replace images or append to the frame
         :param null_image: indicates whether to set image.image to None for processed image
         :param enabled: indicates whether to run processing
+        :param parallel: indicates whether to process frame images concurrently. May be set to the number of threads.
         """
         if not isinstance(vision, VisionBase) and vision is not None:
             raise TypeError("Vision object must be of type VisionBase")
@@ -136,6 +183,8 @@ class ProcessorBase(VisionBase):
         self._enabled = True
         self._append = append
         self._null_image = null_image
+        self._parallel = parallel
+        self._pool = None
         self.enabled = enabled
         super(ProcessorBase, self).__init__(*args, **kwargs)
 
@@ -162,19 +211,34 @@ class ProcessorBase(VisionBase):
             processor_mask = self._processor_mask if self._processor_mask is not None else frame.processor_mask
             if processor_mask is None:
                 processor_mask = "1" * len(frame.images)
+            masked = tuple(zip(processor_mask, frame.images))
+            processed = self._process_images(tuple(img for m, img in masked if m != "0"))
             if not self._append:
-                images = tuple(m == "0" and img or postprocess(self.process(img)) for m, img in zip(processor_mask, frame.images))
+                processed = iter(processed)
+                images = tuple(m == "0" and img or postprocess(next(processed)) for m, img in masked)
             else:
-                images = tuple(postprocess(self.process(img)) for m, img in zip(processor_mask, frame.images) if m != "0")
+                images = tuple(postprocess(img) for img in processed)
                 images = frame.images + images
             return frame._replace(images=images)
 
+    def _process_images(self, images):
+        """Helper method to process images either sequentially or using a thread pool. Preserves the order of images."""
+        if self._pool is not None and len(images) > 1:
+            return self._pool.map(self.process, images)
+        return (self.process(img) for img in images)
+
     def setup(self):
         if self._vision is not None:
             self._vision.setup()
+        if self._parallel:
+            self._pool = ThreadPool(None if self._parallel is True else self._parallel)
         super(ProcessorBase, self).setup()
 
     def release(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
         if self._vision is not None:
             self._vision.release()
         super(ProcessorBase, self).release()
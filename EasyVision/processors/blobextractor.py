@@ -141,5 +141,8 @@ class BlobMatchingMixin(object):
     def setup(self):
         super(BlobMatchingMixin, self).setup()
 
+    def _match_indices(self, descriptorsA, descriptorsB, feature_type, ratio=0.7, distance_thresh=30, min_matches=10):
+        return None
+
     def _match_features(self, descriptorsA, descriptorsB, feature_type, ratio=0.7, distance_thresh=30, min_matches=10):
         return None
@@ -8,13 +8,33 @@ import numpy as np
 from .base import *
 
 
+# parameter and its default value that are lowered to redetect features in cells with insufficient features
+GRID_THRESHOLDS = {
+    'ORB': ('fastThreshold', 20),
+    'BRISK': ('thresh', 30),
+    'SURF': ('hessianThreshold', 100),
+    'SIFT': ('contrastThreshold', .04),
+    'KAZE': ('threshold', .001),
+    'AKAZE': ('threshold', .001),
+    'FAST': ('threshold', 10),
+    'GFTT': ('qualityLevel', .01),
+}
+
+
 class FeatureExtraction(ProcessorBase):
     """Class that implements feature extraction from capturing source.
     Will update Image object in the frame with Features object.
 
+    If ``grid`` is set, keypoints are bucketed into grid cells and each cell keeps at most an even share of
+    ``grid_features`` strongest keypoints, so that keypoints are distributed uniformly over the image instead of
+    clustering on textured areas. Cells that yield fewer keypoints are redetected separately with a lower detector
+    threshold. Descriptors are then computed for merged keypoints on the whole image.
+    If ``parallel`` is set together with ``grid``, the thread pool is used to redetect cells concurrently instead
+    of processing frame images concurrently, as cell tasks would otherwise wait for the pool they are running on.
+
     """
 
-    def __init__(self, vision, feature_type, extract=True, *args, **kwargs):
+    def __init__(self, vision, feature_type, extract=True, grid=None, grid_features=None, *args, **kwargs):
         """
 
         :param vision:
@@ -22,63 +42,87 @@ class FeatureExtraction(ProcessorBase):
             types may be supported(e.g. SURF and SIFT are patented and thus excluded from standard OpenCV build) and not all
             feature types support feature extraction, i.e. only detection is supported.
         :param extract: if set to False will only detect features.
+        :param grid: a tuple of (rows, cols) to distribute features uniformly over grid cells.
+        :param grid_features: total number of features to detect with grid. Defaults to ``nfeatures`` for ORB.
         """
         if feature_type in ['FAST', 'GFTT'] and extract:
                 raise ValueError("Cannot extract features with %s detector" % feature_type)
+        if grid is not None and (len(grid) != 2 or min(grid) < 1):
+            raise ValueError("Grid must be a tuple of (rows, cols)")
+        if grid is not None and grid_features is None and feature_type != 'ORB':
+            raise ValueError("Number of grid features must be provided for %s features" % feature_type)
         self._kwargs = dict(**kwargs)
         self._kwargs.pop('enabled', None)
         self._kwargs.pop('debug', None)
         self._kwargs.pop('display_results', None)
         self._kwargs.pop('processor_mask', None)
+        self._kwargs.pop('parallel', None)
         self._feature_type = feature_type
         self._extract = extract
         self._detector = self._descriptor = None
+        self._grid = tuple(grid) if grid is not None else None
+        self._grid_features = grid_features
+        self._grid_detector = self._grid_fallback = None
         super(FeatureExtraction, self).__init__(vision, *args, **kwargs)
 
     def setup(self):
         super(FeatureExtraction, self).setup()
+        self._descriptor, self._detector = self._create(self._kwargs)
+        if self._grid is not None:
+            self._grid_detector, self._grid_fallback = self._create_grid_detectors()
+
+    def release(self):
+        self._grid_detector = self._grid_fallback = None
+        super(FeatureExtraction, self).release()
+
+    def _create(self, kwargs, detector_kwargs=None):
+        """Helper method to create descriptor extractor and detector
+
+        :param kwargs: descriptor extractor parameters
+        :param detector_kwargs: detector parameters if feature type uses a separate detector
+        :return: a tuple of descriptor extractor and detector. Detector is None if descriptor extractor also detects.
+        """
+        detector = None
         if self._feature_type == 'ORB':
             defaults = dict(nfeatures=10000)
-            defaults.update(self._kwargs)
-            self._descriptor = cv2.ORB_create(**defaults)
+            defaults.update(kwargs)
+            descriptor = cv2.ORB_create(**defaults)
         elif self._feature_type == 'BRISK':
             defaults = dict()
-            defaults.update(self._kwargs)
-            self._descriptor = cv2.BRISK_create(**defaults)
+            defaults.update(kwargs)
+            descriptor = cv2.BRISK_create(**defaults)
         elif self._feature_type == 'SURF':
             defaults = dict()
-            defaults.update(self._kwargs)
-            self._descriptor = cv2.xfeatures2d.SURF_create(**defaults)
+            defaults.update(kwargs)
+            descriptor = cv2.xfeatures2d.SURF_create(**defaults)
         elif self._feature_type == 'SIFT':
             defaults = dict()
-            defaults.update(self._kwargs)
-            self._descriptor = cv2.xfeatures2d.SIFT_create(**defaults)
+            defaults.update(kwargs)
+            descriptor = cv2.xfeatures2d.SIFT_create(**defaults)
         elif self._feature_type == 'KAZE':
             defaults = dict()
-            defaults.update(self._kwargs)
-            self._descriptor = cv2.KAZE_create(**defaults)
+            defaults.update(kwargs)
+            descriptor = cv2.KAZE_create(**defaults)
         elif self._feature_type == 'AKAZE':
             defaults = dict()
-            defaults.update(self._kwargs)
-            self._descriptor = cv2.AKAZE_create(**defaults)
+            defaults.update(kwargs)
+            descriptor = cv2.AKAZE_create(**defaults)
         elif self._feature_type == 'FREAK':
             defaults = dict()
-            defaults.update(self._kwargs)
-            self._descriptor = cv2.xfeatures2d.FREAK_create(**defaults)
-            self._detector = cv2.xfeatures2d.SURF_create()
+            defaults.update(kwargs)
+            descriptor = cv2.xfeatures2d.FREAK_create(**defaults)
+            detector = cv2.xfeatures2d.SURF_create(**(detector_kwargs or {}))
         elif self._feature_type == 'FAST':
             defaults = dict()
-            defaults.update(self._kwargs)
-            self._descriptor = cv2.FastFeatureDetector_create(**defaults)
+            defaults.update(kwargs)
+            descriptor = cv2.FastFeatureDetector_create(**defaults)
         elif self._feature_type == 'GFTT':
             defaults = dict()
-            defaults.update(self._kwargs)
-            self._descriptor = cv2.GFTTDetector_create(**defaults)
+            defaults.update(kwargs)
+            descriptor = cv2.GFTTDetector_create(**defaults)
         else:
             raise ValueError("Invalid feature type")
-
-    def release(self):
-        super(FeatureExtraction, self).release()
+        return descriptor, detector
 
     @property
     def description(self):
@@ -89,8 +133,15 @@ class FeatureExtraction(ProcessorBase):
         """Returns feature type that was set for this processor"""
         return self._feature_type
 
+    @property
+    def grid(self):
+        """Returns grid used to detect features or None"""
+        return self._grid
+
     def process(self, image):
-        if not self._detector:
+        if self._grid is not None:
+            keypoints, descriptors = self._detect_grid(image.image, image.mask), None
+        elif not self._detector:
             keypoints, descriptors = self._descriptor.detect(image.image, image.mask), None
         else:
             keypoints, descriptors = self._detector.detect(image.image, image.mask), None
@@ -107,6 +158,144 @@ class FeatureExtraction(ProcessorBase):
 
         return image._replace(features=Features(keypoints, descriptors), feature_type=self._feature_type)
 
+    def _grid_quota(self):
+        """Helper method that returns maximum number of features in a grid cell"""
+        features = self._grid_features
+        if features is None:
+            features = self._kwargs.get('nfeatures', 10000)
+        return -(-features // (self._grid[0] * self._grid[1]))
+
+    def _create_grid_detectors(self):
+        """Helper method to create grid detectors
+
+        :return: a tuple of detector that finds candidate keypoints on the whole image and detector with lower threshold
+        """
+        kwargs = dict(self._kwargs)
+        if self._feature_type == 'ORB':
+            # detect more candidates, so that every cell may keep its share
+            kwargs['nfeatures'] = 2 * self._grid_quota() * self._grid[0] * self._grid[1]
+        descriptor, detector = self._create(kwargs)
+        candidates = detector or descriptor
+
+        name, default = GRID_THRESHOLDS['SURF' if self._feature_type == 'FREAK' else self._feature_type]
+        if self._feature_type == 'ORB':
+            kwargs['nfeatures'] = 4 * self._grid_quota()
+        if self._feature_type == 'FREAK':
+            descriptor, detector = self._create(kwargs, {name: default / 3.0})
+        else:
+            kwargs[name] = type(default)(kwargs.get(name, default) / 3.0)
+            descriptor, detector = self._create(kwargs)
+        return candidates, detector or descriptor
+
+    def _grid_border(self):
+        """Helper method that returns the size of cell margin, so that detector may use pixels around the cell.
+        Margin covers the finest scale only, as cells are redetected just to fill up low textured areas.
+        """
+        if self._feature_type == 'ORB':
+            return max(self._grid_fallback.getEdgeThreshold(), self._grid_fallback.getPatchSize())
+        return 16
+
+    def _grid_cells(self, pt, height, width):
+        """Helper method that returns grid cell index of each point
+
+        :param pt: Nx2 array of points
+        :param height: image height
+        :param width: image width
+        :return: array of cell indices in row major order
+        """
+        rows, cols = self._grid
+        row = np.clip((pt[:, 1] * rows // height).astype(np.intp), 0, rows - 1)
+        col = np.clip((pt[:, 0] * cols // width).astype(np.intp), 0, cols - 1)
+        return row * cols + col
+
+    @staticmethod
+    def _retain_best(keypoints, cells, quota):
+        """Helper method to keep at most quota strongest keypoints in each cell
+
+        :param keypoints: a list of keypoints
+        :param cells: cell index of each keypoint
+        :param quota: maximum number of keypoints in a cell
+        :return: sorted indices of retained keypoints
+        """
+        response = np.fromiter((kp.response for kp in keypoints), np.float32, len(keypoints))
+        order = np.lexsort((-response, cells))
+        cells = cells[order]
+        first = np.searchsorted(cells, cells)
+        return np.sort(order[np.arange(len(order)) - first < quota])
+
+    def _detect_cell(self, image, mask, height, width, cell, quota):
+        """Helper method to redetect keypoints in a grid cell with a lower threshold
+
+        :param image: whole image
+        :param mask: whole image mask or None
+        :param height: image height
+        :param width: image width
+        :param cell: cell index
+        :param quota: maximum number of keypoints
+        :return: a list of keypoints in whole image coordinates
+        """
+        rows, cols = self._grid
+        i, j = divmod(cell, cols)
+        border = self._grid_border()
+        left, right = max(j * width // cols - border, 0), min(-(-(j + 1) * width // cols) + border, width)
+        top, bottom = max(i * height // rows - border, 0), min(-(-(i + 1) * height // rows) + border, height)
+        if isinstance(image, cv2.UMat):
+            roi = cv2.UMat(image, (top, bottom), (left, right))
+            roi_mask = cv2.UMat(mask, (top, bottom), (left, right)) if mask is not None else None
+        else:
+            roi = image[top:bottom, left:right]
+            roi_mask = mask[top:bottom, left:right] if mask is not None else None
+
+        keypoints = self._grid_fallback.detect(roi, roi_mask)
+        if not len(keypoints):
+            return []
+        pt = cv2.KeyPoint_convert(keypoints).reshape(-1, 2) + (left, top)
+        inside = np.flatnonzero(self._grid_cells(pt, height, width) == cell)
+        keypoints = [keypoints[i] for i in inside]
+
+        result = []
+        for i in self._retain_best(keypoints, np.zeros(len(keypoints), np.intp), quota):
+            kp = keypoints[i]
+            kp.pt = tuple(pt[inside[i]].tolist())
+            result.append(kp)
+        return result
+
+    def _detect_grid(self, image, mask):
+        """Helper method to detect keypoints, keep the strongest keypoints in each grid cell and
+        redetect cells with insufficient keypoints.
+
+        :param image: whole image
+        :param mask: whole image mask or None
+        :return: a list of keypoints
+        """
+        height, width = image.get().shape[:2] if isinstance(image, cv2.UMat) else image.shape[:2]
+        rows, cols = self._grid
+        quota = self._grid_quota()
+
+        keypoints = self._grid_detector.detect(image, mask)
+        cells = self._grid_cells(cv2.KeyPoint_convert(keypoints).reshape(-1, 2), height, width)
+        keep = self._retain_best(keypoints, cells, quota)
+        keypoints, cells = [keypoints[i] for i in keep], cells[keep]
+
+        weak = np.flatnonzero(np.bincount(cells, minlength=rows * cols) < quota)
+        if not len(weak):
+            return keypoints
+
+        detect = lambda cell: self._detect_cell(image, mask, height, width, cell, quota)
+        if self._pool is not None:
+            redetected = self._pool.map(detect, weak.tolist())
+        else:
+            redetected = [detect(cell) for cell in weak.tolist()]
+
+        weak = np.isin(cells, weak)
+        return [kp for kp, w in zip(keypoints, weak) if not w] + [kp for cell in redetected for kp in cell]
+
+    def _process_images(self, images):
+        """Processes frame images sequentially with grid, as the thread pool is used to redetect grid cells"""
+        if self._grid is not None:
+            return (self.process(img) for img in images)
+        return super(FeatureExtraction, self)._process_images(images)
+
     def _draw_keypoints(self, image, keypoints):
         """Helper method to draw keypoints"""
         img = cv2.drawKeypoints(image, keypoints, np.array([]), color=(0, 0, 255),
@@ -114,17 +303,30 @@ class FeatureExtraction(ProcessorBase):
         cv2.imshow(self.name, img)
 
 
+MATCH_DTYPE = np.dtype([('query', '<i4'), ('train', '<i4'), ('distance', '<f4')])
+POPCOUNT = np.unpackbits(np.arange(1 << 16, dtype='<u2').view(np.uint8).reshape(-1, 2), axis=1).sum(axis=1).astype(np.uint8)
+
+
 class FeatureMatchingMixin(object):
     """Feature matching mixin class that allows to match features extracted with ``FeatureExtraction`` processor.
 
+    Matches are returned as a record array of ``MATCH_DTYPE`` with query, train and distance fields, so that
+    keypoints and descriptors can be gathered with index arrays, e.g. ``features.pt[matches.query]``.
+
+    Train descriptors that do not change between calls(e.g. enrolled model views) can be indexed once with
+    ``_train_index``. Matching against them will then reuse the index and only query it.
+    Cached indexes are looked up by the identity of the train descriptors object.
     """
 
-    SLOTS = ('_matcher_h', '_matcher_l')
+    SLOTS = ('_matcher_h', '_matcher_l', '_indexes')
     __slots__ = ()
 
+    BINARY_FEATURES = ('ORB', 'AKAZE', 'FREAK', 'BRISK')
+
     def __init__(self, *args, **kwargs):
         self._matcher_l = None
         self._matcher_h = None
+        self._indexes = {}
         super(FeatureMatchingMixin, self).__init__(*args, **kwargs)
 
     def setup(self):
@@ -134,14 +336,200 @@ class FeatureMatchingMixin(object):
                             key_size=12,
                             multi_probe_level=1)
         search_params = dict(checks=50)
-        self._matcher_h = cv2.FlannBasedMatcher(index_params, search_params)
+        self._matcher_h = index_params, search_params
 
         FLANN_INDEX_KDTREE = 0
         index_params = dict(algorithm=FLANN_INDEX_KDTREE, trees=5)
         search_params = dict(checks=50)   # or pass empty dictionary
-        self._matcher_l = cv2.FlannBasedMatcher(index_params, search_params)
+        self._matcher_l = index_params, search_params
+        self._indexes = {}
         super(FeatureMatchingMixin, self).setup()
 
+    def _build_index(self, descriptors, feature_type):
+        """Helper method to build FLANN index over train descriptors
+
+        :return: a tuple of index, search parameters and whether descriptors are binary
+        """
+        binary = feature_type in FeatureMatchingMixin.BINARY_FEATURES
+        index_params, search_params = self._matcher_h if binary else self._matcher_l
+        if isinstance(descriptors, cv2.UMat):
+            descriptors = descriptors.get()
+        return cv2.flann_Index(descriptors, index_params), search_params, binary
+
+    def _train_index(self, descriptors, feature_type):
+        """Builds and keeps an index over static train descriptors. Does nothing if the index already exists.
+
+        :param descriptors: Train descriptors
+        :param feature_type: type of features
+        :return: None
+        """
+        entry = self._indexes.get(id(descriptors))
+        if entry is not None and entry[0] is descriptors and entry[1] == feature_type:
+            return
+        self._indexes[id(descriptors)] = (descriptors, feature_type) + self._build_index(descriptors, feature_type)
+
+    def _forget_index(self, descriptors):
+        """Drops cached index built over descriptors if any
+
+        :param descriptors: Train descriptors
+        :return: None
+        """
+        entry = self._indexes.get(id(descriptors))
+        if entry is not None and entry[0] is descriptors:
+            del self._indexes[id(descriptors)]
+
+    def _prune_indexes(self, keep=()):
+        """Drops cached indexes except for those built over descriptors in keep
+
+        :param keep: an iterable of train descriptors whose indexes should be kept
+        :return: None
+        """
+        keep = set(id(descriptors) for descriptors in keep)
+        for key in [key for key in self._indexes if key not in keep]:
+            del self._indexes[key]
+
+    def _knn_match(self, descriptorsA, descriptorsB, feature_type, k=2):
+        """Helper method to find k nearest train descriptors for each query descriptor
+
+        :param descriptorsA: Query descriptors
+        :param descriptorsB: Train descriptors
+        :param feature_type: type of features. requires as binary and float descriptors use different indexes
+        :param k: number of nearest neighbours
+        :return: a tuple of indices and distances arrays of shape (N, k). Missing neighbours have negative index.
+        """
+        entry = self._indexes.get(id(descriptorsB))
+        if entry is not None and entry[0] is descriptorsB and entry[1] == feature_type:
+            index, search_params, binary = entry[2:]
+        else:
+            index, search_params, binary = self._build_index(descriptorsB, feature_type)
+        if isinstance(descriptorsA, cv2.UMat):
+            descriptorsA = descriptorsA.get()
+
+        indices, distances = index.knnSearch(descriptorsA, k, params=search_params)
+        # KD tree reports squared L2 distances
+        return indices, distances if binary else np.sqrt(distances)
+
+    def _match_indices(self, descriptorsA, descriptorsB, feature_type, ratio=0.7, distance_thresh=30, min_matches=10):
+        """Helper method to match descriptors extracted with ``FeatureExtraction``.
+        Lowe's ratio test and distance threshold are applied to whole arrays at once.
+
+        :param descriptorsA: Query descriptors
+        :param descriptorsB: Train descriptors
+        :param feature_type: type of features. requires as binary and float descriptors use different matchers
+        :param ratio: ratio test as per Lowe's paper
+        :param distance_thresh: maximum allowed matched feature distance
+        :param min_matches: minimum number of features.
+        :return: record array of ``MATCH_DTYPE`` or None if not enough matches found
+        """
+        if descriptorsA is None or descriptorsB is None or len(descriptorsA) == 0 or len(descriptorsB) < 2:
+            return None
+
+        indices, distances = self._knn_match(descriptorsA, descriptorsB, feature_type, 2)
+
+        mask = (indices[:, 0] >= 0) & (indices[:, 1] >= 0)
+        mask &= distances[:, 0] < distances[:, 1] * ratio
+        mask &= distances[:, 0] < distance_thresh
+
+        query = np.flatnonzero(mask)
+        if len(query) < min_matches:
+            return None
+
+        matches = np.empty(len(query), MATCH_DTYPE)
+        matches['query'] = query
+        matches['train'] = indices[query, 0]
+        matches['distance'] = distances[query, 0]
+        return matches.view(np.recarray)
+
+    def _match_guided(self, pointsA, descriptorsA, pointsB, descriptorsB, feature_type, radius=15, ratio=0.7,
+                      distance_thresh=30, min_matches=10):
+        """Helper method to match descriptors of points with known predicted positions, e.g. projected map points.
+        Every query point is only compared with train points within ``radius`` pixels. Train points are bucketed into
+        a grid of ``radius`` sized cells, so only candidates of 3x3 neighbouring cells are considered.
+        Each train point is matched at most once.
+
+        :param pointsA: Nx2 predicted positions of query points
+        :param descriptorsA: Query descriptors
+        :param pointsB: Mx2 positions of train points
+        :param descriptorsB: Train descriptors
+        :param feature_type: type of features. binary descriptors use Hamming distance and float descriptors L2
+        :param radius: search window radius in pixels
+        :param ratio: ratio test as per Lowe's paper applied to candidates within the window
+        :param distance_thresh: maximum allowed matched feature distance
+        :param min_matches: minimum number of features.
+        :return: record array of ``MATCH_DTYPE`` or None if not enough matches found
+        """
+        if descriptorsA is None or descriptorsB is None or len(pointsA) == 0 or len(pointsB) == 0:
+            return None
+        if isinstance(descriptorsA, cv2.UMat):
+            descriptorsA = descriptorsA.get()
+        if isinstance(descriptorsB, cv2.UMat):
+            descriptorsB = descriptorsB.get()
+        pointsA = np.float32(pointsA).reshape(-1, 2)
+        pointsB = np.float32(pointsB).reshape(-1, 2)
+
+        # sort train points by grid cell, so that each cell is a contiguous range
+        cellsB = np.int64(np.floor(pointsB / radius))
+        origin = cellsB.min(axis=0) - 1
+        cellsB -= origin
+        width = cellsB[:, 0].max() + 2
+        keysB = cellsB[:, 1] * width + cellsB[:, 0]
+        order = np.argsort(keysB, kind='stable')
+        keysB = keysB[order]
+
+        offsets = np.int64([(dx, dy) for dy in (-1, 0, 1) for dx in (-1, 0, 1)])
+        cells = (np.int64(np.floor(pointsA / radius)) - origin)[:, None, :] + offsets
+        keys = cells[..., 1] * width + cells[..., 0]
+        starts = np.searchsorted(keysB, keys, 'left').ravel()
+        counts = np.searchsorted(keysB, keys, 'right').ravel() - starts
+        counts[~((cells[..., 0] >= 0) & (cells[..., 0] < width)).ravel()] = 0
+
+        total = counts.sum()
+        if total == 0:
+            return None
+        within = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+        query = np.repeat(np.arange(len(pointsA)).repeat(len(offsets)), counts)
+        train = order[np.repeat(starts, counts) + within]
+
+        near = ((pointsA[query] - pointsB[train]) ** 2).sum(axis=1) <= radius * radius
+        query, train = query[near], train[near]
+        if not len(query):
+            return None
+
+        if feature_type in FeatureMatchingMixin.BINARY_FEATURES:
+            # popcount of 16 bit words halves the number of lookups, descriptors of odd length are padded
+            if descriptorsA.shape[1] % 2:
+                descriptorsA = np.pad(descriptorsA, ((0, 0), (0, 1)), 'constant')
+                descriptorsB = np.pad(descriptorsB, ((0, 0), (0, 1)), 'constant')
+            words = np.bitwise_xor(descriptorsA.view('<u2')[query], descriptorsB.view('<u2')[train])
+            distances = POPCOUNT[words].sum(axis=1, dtype=np.int32)
+        else:
+            distances = np.sqrt(((np.float32(descriptorsA[query]) - descriptorsB[train]) ** 2).sum(axis=1))
+
+        # best and second best candidates of every query point
+        order = np.lexsort((distances, query))
+        query, train, distances = query[order], train[order], distances[order]
+        first = np.flatnonzero(np.r_[True, query[1:] != query[:-1]])
+        second = np.full(len(first), np.inf)
+        has_second = np.r_[first[1:], len(query)] - first > 1
+        second[has_second] = distances[first[has_second] + 1]
+
+        best = distances[first]
+        first = first[(best < distance_thresh) & (best < second * ratio)]
+
+        # resolve train points claimed by several query points in favour of the closest descriptor
+        first = first[np.argsort(distances[first], kind='stable')]
+        _, unique = np.unique(train[first], return_index=True)
+        first = np.sort(first[unique])
+
+        if len(first) < min_matches:
+            return None
+
+        matches = np.empty(len(first), MATCH_DTYPE)
+        matches['query'] = query[first]
+        matches['train'] = train[first]
+        matches['distance'] = distances[first]
+        return matches.view(np.recarray)
+
     def _match_features(self, descriptorsA, descriptorsB, feature_type, ratio=0.7, distance_thresh=30, min_matches=10):
         """Helper method to match descriptors extracted with ``FeatureExtraction``
 
@@ -153,17 +541,14 @@ class FeatureMatchingMixin(object):
         :param min_matches: minimum number of features.
         :return: a list of matches found. match elements contain queryIdx, trainIdx and distance fields. refer to openCV documentation for more.
         """
-        if feature_type in ['ORB', 'AKAZE', 'FREAK', 'BRISK']:
-            matches = self._matcher_h.knnMatch(descriptorsA, descriptorsB, 2)
-        else:
-            matches = self._matcher_l.knnMatch(descriptorsA, descriptorsB, 2)
+        matches = self._match_indices(descriptorsA, descriptorsB, feature_type, ratio, distance_thresh, min_matches)
 
         if matches is None:
             return None
 
-        matches = [M[0] for M in matches if len(M) == 2 and M[0].distance < M[1].distance * ratio and M[0].distance < distance_thresh]
-
-        if len(matches) < min_matches:
-            return None
+        return FeatureMatchingMixin.todmatches(matches)
 
-        return matches
+    @staticmethod
+    def todmatches(matches):
+        """Converts matches record array into a list of cv2.DMatch, e.g. for ``cv2.drawMatches``"""
+        return [cv2.DMatch(query, train, distance) for query, train, distance in matches.tolist()]
@@ -5,11 +5,15 @@ NOTE: will set ``multiprocessing.connection.BUFSIZE`` to 64Mb in order to increa
 This is needed as using Pipe is much faster than using e.g. RawArray or anything else. Although Pipe is still very slow.
 By the way, Multiprocessing doesn't really work fine with e.g. feature extraction or any other openCV algorithms
 and usually is a little bit slower than if processing sequentially. See tests for more details.
+
+If ``shared_memory`` is requested (Python 3.8+), image, mask and feature arrays are written into a ring of
+``multiprocessing.shared_memory`` slots and only a small pickled header crosses the pipe.
 """
 
 import multiprocessing as mp
 import multiprocessing.connection
 from .base import *
+from EasyVision.vision import codec
 import functools
 
 try:
@@ -17,9 +21,185 @@ try:
 except ImportError:
     import pickle
 
+try:
+    from multiprocessing import shared_memory
+    from multiprocessing import resource_tracker
+except ImportError:
+    shared_memory = None
+
 Attr = namedtuple("Attr", 'name method args kwargs')
 multiprocessing.connection.BUFSIZE = 64 * 1024 * 1024
 
+SharedArray = namedtuple("SharedArray", 'offset shape dtype')
+SharedFrameHeader = namedtuple("SharedFrameHeader", 'slot name timestamp index images processor_mask')
+
+
+class SharedFrameRing(object):
+    """Ring of shared memory slots used to pass frames between processes without pickling ndarrays.
+
+    The writer (forked process) copies every ndarray of a frame (image, original, mask, feature points,
+    descriptors and 3d points) into the next slot of the ring and returns a ``SharedFrameHeader`` that describes
+    where each array lives. Only the header is pickled and sent through the pipe.
+    The reader (parent process) attaches to the slot by name and reconstructs the frame with ndarrays that are
+    views into the shared memory, i.e. no copy is made.
+
+    .. warning::
+        Arrays of a received frame are only valid until the writer wraps around the ring, i.e. after ``num_slots``
+        more frames were sent. Copy the arrays if the frame must be retained for longer than that.
+    """
+
+    ALIGNMENT = 64
+
+    def __init__(self, num_slots=4):
+        """SharedFrameRing instance initialization
+
+        :param num_slots: number of shared memory slots in the ring
+        """
+        if shared_memory is None:
+            raise NotImplementedError("multiprocessing.shared_memory requires Python 3.8+")
+        if num_slots < 2:
+            raise ValueError("Ring must contain at least two slots")
+        self._num_slots = num_slots
+        self._slot = 0
+        self._owned = {}
+        self._attached = {}
+        self._retired = []
+
+    @property
+    def num_slots(self):
+        """Number of shared memory slots in the ring"""
+        return self._num_slots
+
+    def _layout(self, arrays):
+        """Helper method to calculate offsets of arrays in a slot"""
+        offsets, size = [], 0
+        for arr in arrays:
+            offsets.append(size)
+            size += (arr.nbytes + self.ALIGNMENT - 1) // self.ALIGNMENT * self.ALIGNMENT
+        return offsets, max(size, self.ALIGNMENT)
+
+    def _allocate(self, slot, size):
+        """Helper method to get a writable slot of at least ``size`` bytes. Will reallocate the slot if needed."""
+        shm = self._owned.get(slot)
+        if shm is not None and shm.size >= size:
+            return shm
+        if shm is not None:
+            # reader has already attached to the outgrown slot, so its name is not needed anymore
+            try:
+                shm.close()
+            except BufferError:
+                pass
+            shm.unlink()
+        shm = shared_memory.SharedMemory(create=True, size=size)
+        self._owned[slot] = shm
+        return shm
+
+    @staticmethod
+    def _collect(value, arrays):
+        """Helper method replacing ndarray/UMat with an index into arrays list"""
+        if isinstance(value, cv2.UMat):
+            value = value.get()
+        if isinstance(value, np.ndarray):
+            arrays.append(np.ascontiguousarray(value))
+            return SharedArray(len(arrays) - 1, value.shape, value.dtype.descr if value.dtype.names else value.dtype.str)
+        return value
+
+    def write(self, frame):
+        """Copies frame arrays into the next slot.
+
+        :param frame: Frame object to be written
+        :return: SharedFrameHeader that must be sent to the reader
+        """
+        arrays = []
+        images = []
+        for img in frame.images:
+            features = img.features
+            if features is not None:
+                features = (isinstance(features, Features), tuple(self._collect(i, arrays) for i in features))
+            images.append((
+                self._collect(img.image, arrays),
+                self._collect(img.original, arrays),
+                self._collect(img.mask, arrays),
+                features,
+                img.feature_type
+            ))
+
+        offsets, size = self._layout(arrays)
+        slot = self._slot
+        self._slot = (self._slot + 1) % self._num_slots
+        shm = self._allocate(slot, size)
+
+        for arr, offset in zip(arrays, offsets):
+            np.ndarray(arr.shape, arr.dtype, buffer=shm.buf, offset=offset)[...] = arr
+
+        def relocate(value):
+            if isinstance(value, SharedArray):
+                return value._replace(offset=offsets[value.offset])
+            return value
+
+        images = tuple(
+            tuple(relocate(i) for i in img[:3]) +
+            ((img[3][0], tuple(relocate(i) for i in img[3][1])) if img[3] is not None else None, img[4])
+            for img in images)
+
+        return SharedFrameHeader(slot, shm.name, frame.timestamp, frame.index, images, frame.processor_mask)
+
+    def _attach(self, slot, name):
+        """Helper method to attach to a slot created by the writer"""
+        shm = self._attached.get(slot)
+        if shm is not None and shm.name == name:
+            return shm
+        if shm is not None:
+            self._retired.append(shm)
+        shm = shared_memory.SharedMemory(name=name)
+        self._attached[slot] = shm
+        return shm
+
+    def read(self, header, source=None):
+        """Reconstructs a frame from a header. Arrays are views into the shared memory.
+
+        :param header: SharedFrameHeader received from the writer
+        :param source: source object to be set for every image
+        :return: Frame object
+        """
+        shm = self._attach(header.slot, header.name)
+
+        def restore(value):
+            if isinstance(value, SharedArray):
+                return np.ndarray(value.shape, np.dtype(value.dtype), buffer=shm.buf, offset=value.offset)
+            return value
+
+        def restore_features(features):
+            if features is None:
+                return None
+            is_features, items = features
+            items = tuple(restore(i) for i in items)
+            return Features(*items) if is_features else items
+
+        images = tuple(
+            Image(source, restore(image), restore(original), restore(mask), restore_features(features), feature_type)
+            for image, original, mask, features, feature_type in header.images)
+
+        return Frame(header.timestamp, header.index, images, header.processor_mask)
+
+    def close(self):
+        """Closes attached slots and unlinks owned slots."""
+        for shm in self._retired + list(self._attached.values()):
+            try:
+                shm.close()
+            except BufferError:
+                # arrays referencing this slot are still alive
+                pass
+        for shm in self._owned.values():
+            try:
+                shm.close()
+            except BufferError:
+                pass
+            shm.unlink()
+        self._retired = []
+        self._attached = {}
+        self._owned = {}
+
 
 class MultiProcessing(ProcessorBase):
     """Implements processor stack using multiprocessing
@@ -34,16 +214,22 @@ class MultiProcessing(ProcessorBase):
 
     Usually for streaming devices freerun should be used. Lazy mode is used primarily for tests that use ImagesReader
     so that every frame will be processed.
+
+    If ``shared_memory`` is set, frames are transferred through a ``SharedFrameRing``. Arrays of captured frames
+    are then views into shared memory, that are valid until ``num_slots`` more frames were captured.
     """
 
-    def __init__(self, vision, freerun=True, timeout=10, *args, **kwargs):
+    def __init__(self, vision, freerun=True, timeout=10, shared_memory=False, num_slots=4, *args, **kwargs):
         """MultiProcessing instance initialization
 
         :param vision: capturing source object
         :param freerun: indicates whether to execute capturing loop asynchronously
         :param timeout: timeout for calls
+        :param shared_memory: indicates whether to transfer frame arrays using shared memory instead of the pipe
+        :param num_slots: number of shared memory slots used when ``shared_memory`` is set
         """
         self._freerun = freerun
+        self._ring = SharedFrameRing(num_slots) if shared_memory else None
 
         self._timeout = timeout
         self._running = mp.Value("b", 0)
@@ -107,6 +293,9 @@ class MultiProcessing(ProcessorBase):
 
     def setup(self):
         assert(not self._running.value)
+        if self._ring is not None:
+            # forked process must share the resource tracker so that slots are unlinked only once
+            resource_tracker.ensure_running()
         self._process = mp.Process(target=self.run)
         self._process.start()
         if not self._run_event.wait(self._timeout):
@@ -116,6 +305,8 @@ class MultiProcessing(ProcessorBase):
         self._running.value = False
         self._process.join(self._timeout)
         self._process = None
+        if self._ring is not None:
+            self._ring.close()
 
     @property
     def is_open(self):
@@ -141,7 +332,11 @@ class MultiProcessing(ProcessorBase):
                 return None
             raise TimeoutError("Timeout occured while waiting for a frame")
 
-        frame = Frame.frombytes(self._frame_in.recv_bytes())
+        data = self._frame_in.recv_bytes()
+        # copied into bytearray so that decoded arrays are writable
+        frame = Frame.frombytes(bytearray(data)) if codec.is_encoded(data) else pickle.loads(data)
+        if isinstance(frame, SharedFrameHeader):
+            frame = self._ring.read(frame, self)
         self._frame_event.clear()
         if isinstance(frame, Exception):
             raise frame
@@ -246,11 +441,17 @@ class MultiProcessing(ProcessorBase):
             cv2.waitKey(0)
 
         super(MultiProcessing, self).release()
+        if self._ring is not None:
+            self._ring.close()
 
     def _send_frame(self, frame):
-        """Helper method to send a frame. Will pickle None, Frame and exceptions."""
+        """Helper method to send a frame. Frames are encoded using binary codec, None and exceptions are pickled.
+        Frames will be written to shared memory ring if ``shared_memory`` was requested."""
         if not self._frame_event.is_set():
-            data = frame.tobytes() if isinstance(frame, Frame) else pickle.dumps(frame, protocol=-1)
+            if isinstance(frame, Frame) and self._ring is not None:
+                data = pickle.dumps(self._ring.write(frame), protocol=-1)
+            else:
+                data = frame.tobytes() if isinstance(frame, Frame) else pickle.dumps(frame, protocol=-1)
             self._frame_out.send_bytes(data)
             self._frame_event.set()
 
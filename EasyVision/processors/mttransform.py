@@ -3,31 +3,63 @@
 """
 
 import threading as mt
+from collections import deque, namedtuple
+from time import time
 from .base import *
 import cv2
 
 
+StageStats = namedtuple('StageStats', 'name captured delivered dropped occupancy latency wait')
+
+
 class MultiThreading(ProcessorBase):
-    """
+    """Captures frames from the source on a separate thread into a bounded frame queue.
+
+    Queue policy determines what happens when the queue is full:
+        drop_oldest
+            the oldest queued frame is dropped. Favors latency. With queue size of 1 ``capture`` always
+            returns the latest captured frame.
+        drop_newest
+            newly captured frame is dropped. Favors older frames being delivered.
+        block
+            capturing thread waits until ``capture`` is called. Favors completeness.
+
+    Number of delivered and dropped frames as well as queue occupancy are available as properties.
+    Average time spent capturing a frame from the source is available as ``stage_latency``, which makes
+    MultiThreading usable as a pipeline stage boundary(see ``Builder``).
     """
 
-    def __init__(self, vision, timeout=10, *args, **kwargs):
+    POLICIES = ('drop_oldest', 'drop_newest', 'block')
+
+    def __init__(self, vision, timeout=10, queue_size=1, policy='drop_oldest', *args, **kwargs):
         """MultiThreading instance initialization
 
         :param vision: capturing source object
         :param timeout: timeout for calls
+        :param queue_size: maximum number of frames in the queue
+        :param policy: queue policy. One of drop_oldest, drop_newest, block
         """
+        if queue_size < 1:
+            raise ValueError("Queue size must be at least 1")
+        if policy not in MultiThreading.POLICIES:
+            raise ValueError("Policy must be one of %s" % ", ".join(MultiThreading.POLICIES))
+
         self._timeout = timeout
+        self._queue_size = queue_size
+        self._policy = policy
 
         self._run_event = mt.Event()
         self._exit_event = mt.Event()
-        self._frame_event = mt.Event()
         self._run_event.clear()
         self._exit_event.clear()
-        self._frame_event.clear()
-        self._frame = None
+        self._queue = deque()
         self._thread = None
-        self._lock = mt.Lock()
+        self._lock = mt.Condition(mt.Lock())
+        self._delivered = 0
+        self._dropped = 0
+        self._captured = 0
+        self._busy_time = 0.0
+        self._wait_time = 0.0
 
         super(MultiThreading, self).__init__(vision, *args, **kwargs)
 
@@ -42,56 +74,143 @@ class MultiThreading(ProcessorBase):
         assert(not self._run_event.is_set())
         super(MultiThreading, self).setup()
 
-        self._run_event.clear()
         self._exit_event.clear()
-        self._frame_event.clear()
-        self._frame = None
-
+        self._queue.clear()
+        self._delivered = 0
+        self._dropped = 0
+        self._captured = 0
+        self._busy_time = 0.0
+        self._wait_time = 0.0
+
+        # set before the thread starts as a finite source may be exhausted before setup returns
+        self._run_event.set()
         self._thread = mt.Thread(target=self.run)
         self._thread.start()
-        if not self._run_event.wait(self._timeout):
-            raise TimeoutError()
 
     def release(self):
-        self._run_event.clear()
+        with self._lock:
+            self._run_event.clear()
+            self._lock.notify_all()
         self._exit_event.wait(self._timeout)
+        self._thread = None
         super(MultiThreading, self).release()
 
     @property
     def description(self):
         return "Allows multithreaded capturing"
 
+    @property
+    def queue_size(self):
+        """Maximum number of frames in the queue"""
+        return self._queue_size
+
+    @property
+    def policy(self):
+        """Queue policy"""
+        return self._policy
+
+    @property
+    def queue_occupancy(self):
+        """Current number of frames in the queue"""
+        with self._lock:
+            return len(self._queue)
+
+    @property
+    def frames_delivered(self):
+        """Number of frames returned by ``capture``"""
+        return self._delivered
+
+    @property
+    def frames_dropped(self):
+        """Number of frames dropped due to the queue being full"""
+        return self._dropped
+
+    @property
+    def frames_captured(self):
+        """Number of frames captured from the source"""
+        return self._captured
+
+    @property
+    def stage_latency(self):
+        """Average time in seconds spent capturing a frame from the source"""
+        return self._busy_time / self._captured if self._captured else 0.0
+
+    @property
+    def consumer_wait(self):
+        """Average time in seconds ``capture`` waited for a frame"""
+        return self._wait_time / self._delivered if self._delivered else 0.0
+
+    @property
+    def stats(self):
+        """Returns StageStats for the source of this processor.
+        Latency includes the time the source waited for its own source, i.e. upstream ``consumer_wait``."""
+        return StageStats(self._vision.__class__.__name__, self._captured, self._delivered, self._dropped,
+                          self.queue_occupancy, self.stage_latency, self.consumer_wait)
+
     def process(self, image):
         return self.source.process(image)
 
     def capture(self):
-        if not self._run_event.is_set():
+        if self._thread is None:
             return None
         self.update_fps()
-        if not self._frame_event.wait(self._timeout):
-            raise TimeoutError()
+        start = time()
+        deadline = start + self._timeout
         with self._lock:
-            frame = self._frame
-            self._frame_event.clear()
+            while not self._queue:
+                if self._exit_event.is_set():
+                    return None
+                remaining = deadline - time()
+                if remaining <= 0:
+                    raise TimeoutError()
+                self._lock.wait(remaining)
+
+            frame = self._queue.popleft()
+            self._delivered += 1
+            self._wait_time += time() - start
+            self._lock.notify_all()
 
         return frame
 
-    def run(self):
-        self._run_event.set()
-        for frame in self.source:
-            if not self._run_event.is_set():
-                break
-
-            with self._lock:
-                self._frame = frame
-                self._frame_event.set()
-
-            if self.display_results:
-                cv2.waitKey(1)
+    def _enqueue(self, frame):
+        """Helper method to add a frame to the queue according to the queue policy.
 
+        :return: False if capturing should be stopped
+        """
         with self._lock:
-            self._frame = None
-            self._frame_event.set()
+            if len(self._queue) >= self._queue_size:
+                if self._policy == 'drop_oldest':
+                    self._queue.popleft()
+                    self._dropped += 1
+                elif self._policy == 'drop_newest':
+                    self._dropped += 1
+                    return True
+                else:
+                    while len(self._queue) >= self._queue_size and self._run_event.is_set():
+                        self._lock.wait(.1)
+                    if not self._run_event.is_set():
+                        return False
+            self._queue.append(frame)
+            self._lock.notify_all()
+        return True
 
-        self._run_event.clear()
-        self._exit_event.set()
+    def run(self):
+        try:
+            start = time()
+            for frame in self.source:
+                self._busy_time += time() - start
+                self._captured += 1
+                if not self._run_event.is_set():
+                    break
+
+                if not self._enqueue(frame):
+                    break
+
+                if self.display_results:
+                    cv2.waitKey(1)
+                start = time()
+        finally:
+            with self._lock:
+                self._run_event.clear()
+                self._exit_event.set()
+                self._lock.notify_all()
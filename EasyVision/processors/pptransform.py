@@ -0,0 +1,320 @@
+# -*- coding: utf-8 -*-
+"""Uses a pool of processes to fan frames out across several cores.
+
+Every worker process holds its own copy of the processor stack built from the same ``Builder`` description.
+Frames are captured in the parent process, dispatched to the workers and the results are returned
+in the same order as they were captured.
+
+NOTE: frames are pickled and transferred through ``multiprocessing.Pipe`` same as with ``MultiProcessing``.
+"""
+
+import multiprocessing as mp
+import multiprocessing.connection
+from collections import deque
+from .base import *
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+
+class FrameFeeder(VisionBase):
+    """Capturing adapter that returns frames pushed into it. Used as a source for worker processor stacks."""
+
+    def __init__(self, *args, **kwargs):
+        self._frame = None
+        super(FrameFeeder, self).__init__(*args, **kwargs)
+
+    def push(self, frame):
+        """Sets a frame to be returned by the next ``capture`` call"""
+        self._frame = frame
+
+    def capture(self):
+        super(FrameFeeder, self).capture()
+        frame, self._frame = self._frame, None
+        return frame
+
+    def setup(self):
+        super(FrameFeeder, self).setup()
+
+    def release(self):
+        super(FrameFeeder, self).release()
+
+    @property
+    def description(self):
+        return "Frame feeder for process pool workers"
+
+    @property
+    def is_open(self):
+        return True
+
+    @property
+    def frame_size(self):
+        return None
+
+    @property
+    def fps(self):
+        return None
+
+    @property
+    def frame_count(self):
+        return -1
+
+    @property
+    def path(self):
+        return None
+
+    @property
+    def devices(self):
+        return None
+
+    @property
+    def autoexposure(self):
+        return None
+
+    @property
+    def autofocus(self):
+        return None
+
+    @property
+    def autowhitebalance(self):
+        return None
+
+    @property
+    def autogain(self):
+        return None
+
+    @property
+    def exposure(self):
+        return None
+
+    @property
+    def focus(self):
+        return None
+
+    @property
+    def whitebalance(self):
+        return None
+
+    @property
+    def gain(self):
+        return None
+
+
+class ProcessPool(ProcessorBase):
+    """Implements a pool of worker processes each running a copy of the processor stack.
+
+    Frames are captured from the source in the parent process and dispatched to the workers either in
+    round robin order or to the least loaded worker. Up to ``max_pending`` frames per worker are in flight at once.
+    ``capture`` returns the results in the order frames were captured, i.e. ordered by ``Frame.index``.
+
+    Example::
+
+        stack = Builder(
+            CalibratedCamera, Args(camera),
+            FeatureExtraction, Args(feature_type='ORB')
+        )
+        with ProcessPool(VideoCapture(0), stack, num_workers=4) as vision:
+            for frame in vision:
+                pass
+
+    """
+
+    DISPATCH = ('round_robin', 'least_loaded')
+
+    def __init__(self, vision, builder, num_workers=None, dispatch='round_robin', max_pending=2, timeout=10,
+                 *args, **kwargs):
+        """ProcessPool instance initialization
+
+        :param vision: capturing source object
+        :param builder: ``Builder`` object describing the processors that will be run by every worker
+        :param num_workers: number of worker processes. Defaults to the number of cores
+        :param dispatch: either 'round_robin' or 'least_loaded'
+        :param max_pending: maximum number of frames in flight per worker
+        :param timeout: timeout for waiting for worker results
+        """
+        # processorstackbuilder imports engines, that in turn import processors
+        from EasyVision.processorstackbuilder import Builder
+
+        if not isinstance(builder, Builder):
+            raise TypeError("Builder must be of type Builder")
+        if dispatch not in ProcessPool.DISPATCH:
+            raise ValueError("Dispatch must be one of %s" % ", ".join(ProcessPool.DISPATCH))
+        if max_pending < 1:
+            raise ValueError("At least one frame per worker must be allowed")
+
+        self._builder = builder
+        self._num_workers = num_workers if num_workers else mp.cpu_count()
+        self._dispatch = dispatch
+        self._max_pending = max_pending
+        self._timeout = timeout
+
+        self._workers = []
+        self._connections = []
+        self._loads = []
+        self._next_worker = 0
+        self._order = deque()
+        self._results = {}
+        self._exhausted = False
+
+        super(ProcessPool, self).__init__(vision, *args, **kwargs)
+
+    def setup(self):
+        super(ProcessPool, self).setup()
+        self._order.clear()
+        self._results = {}
+        self._exhausted = False
+        self._next_worker = 0
+        self._loads = [0] * self._num_workers
+
+        for index in range(self._num_workers):
+            conn, worker_conn = mp.Pipe(True)
+            process = mp.Process(target=self._run_worker, args=(worker_conn, ))
+            process.daemon = True
+            process.start()
+            self._workers.append(process)
+            self._connections.append(conn)
+
+        for conn in self._connections:
+            if not conn.poll(self._timeout):
+                raise TimeoutError("Timeout occured while setup")
+            result = pickle.loads(conn.recv_bytes())
+            if isinstance(result, Exception):
+                raise result
+
+    def release(self):
+        for conn in self._connections:
+            try:
+                conn.send_bytes(pickle.dumps(None, protocol=-1))
+            except (IOError, OSError):
+                pass
+        for process in self._workers:
+            process.join(self._timeout)
+            if process.is_alive():
+                process.terminate()
+        for conn in self._connections:
+            conn.close()
+        self._workers = []
+        self._connections = []
+        super(ProcessPool, self).release()
+
+    @property
+    def description(self):
+        return "Allows processors to run on a pool of processes"
+
+    @property
+    def num_workers(self):
+        """Number of worker processes"""
+        return self._num_workers
+
+    @property
+    def loads(self):
+        """A tuple of number of frames in flight per worker"""
+        return tuple(self._loads)
+
+    def process(self, image):
+        """Processes an image with the top processor of the least loaded worker stack"""
+        worker = self._select_worker()
+        self._connections[worker].send_bytes(pickle.dumps(('PROCESS', image), protocol=-1))
+        self._loads[worker] += 1
+        while True:
+            kind, result = self._receive(worker)
+            if kind == 'PROCESS':
+                break
+        if isinstance(result, Exception):
+            raise result
+        if isinstance(result, Image):
+            result = result._replace(source=self)
+        return result
+
+    def capture(self):
+        super(ProcessorBase, self).capture()
+
+        while True:
+            self._dispatch_frames()
+            if not self._order:
+                return None
+
+            index = self._order[0]
+            while index not in self._results:
+                self._collect()
+            self._order.popleft()
+            frame = self._results.pop(index)
+
+            if isinstance(frame, Exception):
+                raise frame
+            if frame is not None:
+                return frame._replace(images=tuple(i._replace(source=self) for i in frame.images))
+
+    def _select_worker(self):
+        """Helper method to select a worker according to dispatch strategy"""
+        if self._dispatch == 'least_loaded':
+            order = [(i + self._next_worker) % self._num_workers for i in range(self._num_workers)]
+            worker = min(order, key=lambda i: self._loads[i])
+        else:
+            worker = self._next_worker
+        self._next_worker = (worker + 1) % self._num_workers
+        return worker
+
+    def _dispatch_frames(self):
+        """Helper method that keeps workers busy by capturing and sending frames up to ``max_pending`` per worker"""
+        while not self._exhausted and len(self._order) < self._num_workers * self._max_pending:
+            if self._dispatch == 'round_robin' and self._loads[self._next_worker] >= self._max_pending:
+                break
+            frame = self._vision.capture()
+            if frame is None:
+                self._exhausted = True
+                break
+            worker = self._select_worker()
+            self._connections[worker].send_bytes(pickle.dumps(('FRAME', frame), protocol=-1))
+            self._loads[worker] += 1
+            self._order.append(frame.index)
+
+    def _receive(self, worker):
+        """Helper method to receive a single result from a worker. Frame results are stored for reordering."""
+        kind, index, result = pickle.loads(self._connections[worker].recv_bytes())
+        self._loads[worker] -= 1
+        if kind == 'FRAME':
+            self._results[index] = result
+        return kind, result
+
+    def _collect(self):
+        """Helper method to wait for any worker results"""
+        ready = multiprocessing.connection.wait(self._connections, self._timeout)
+        if not ready:
+            raise TimeoutError("Timeout occured while waiting for a frame")
+        for conn in ready:
+            self._receive(self._connections.index(conn))
+
+    def _run_worker(self, conn):
+        """Worker process loop. Builds processor stack and processes received frames and images."""
+        try:
+            feeder = FrameFeeder()
+            stack = self._builder.build(feeder)
+            stack.setup()
+        except Exception as e:
+            conn.send_bytes(pickle.dumps(e, protocol=-1))
+            return
+
+        conn.send_bytes(pickle.dumps(True, protocol=-1))
+        try:
+            while True:
+                message = pickle.loads(conn.recv_bytes())
+                if message is None:
+                    break
+                kind, data = message
+                index = data.index if kind == 'FRAME' else None
+                try:
+                    if kind == 'FRAME':
+                        feeder.push(data)
+                        result = stack.capture()
+                    else:
+                        result = stack.process(data)
+                except Exception as e:
+                    result = e
+                conn.send_bytes(pickle.dumps((kind, index, result), protocol=-1))
+        except (EOFError, KeyboardInterrupt):
+            pass
+        finally:
+            stack.release()
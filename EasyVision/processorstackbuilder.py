@@ -99,6 +99,7 @@ Example using json:
 
 from EasyVision.vision.base import VisionBase
 from EasyVision.processors.base import ProcessorBase
+from EasyVision.processors.mttransform import MultiThreading
 from EasyVision.engine.base import EngineBase
 import inspect
 
@@ -282,13 +283,27 @@ class Builder(object):
         ]
     """
     def __init__(self, *args, **kwargs):
+        """Builder initialization
+
+        :param args: classes and Args objects describing the stack
+        :param pipeline: optional keyword argument. If set to a positive number, every built vision/processor
+            will be wrapped into ``MultiThreading`` with a blocking queue of that size. This way every stage of the
+            stack runs on its own thread and the stack behaves like a pipeline. ``True`` means queue size of 2.
+        :param kwargs: keyword arguments passed to every class
+        """
+        pipeline = kwargs.pop('pipeline', 0)
+        self.pipeline = 2 if pipeline is True else int(pipeline or 0)
         self.args = args
         self.kwargs = kwargs
 
-    def build(self):
-        """Builds the processor stack using provided processors and their arguments"""
+    def build(self, vision=None):
+        """Builds the processor stack using provided processors and their arguments
+
+        :param vision: optional capturing source for the first processor. Allows to build a stack that
+            only describes processors, e.g. for ``ProcessPool`` workers.
+        """
         index = 0
-        args = ()
+        args = (vision, ) if vision is not None else ()
         cls = None
         for pos, arg in enumerate(self.args):
             if isinstance(arg, Builder):
@@ -305,6 +320,8 @@ class Builder(object):
                 default.update(arg.kwargs)
                 default.update(self.kwargs)
                 obj = cls(*(args + arg.args), **default)
+                if self.pipeline and isinstance(obj, VisionBase):
+                    obj = MultiThreading(obj, queue_size=self.pipeline, policy='block')
                 args = (obj, )
                 index += 1
             else:
@@ -337,6 +354,8 @@ class Builder(object):
             objects, _, kwargs = Args.convert_kwargs({}, 0, self.kwargs)
             d['kwargs'] = kwargs
             d['objects'] = objects
+        if self.pipeline:
+            d['pipeline'] = self.pipeline
         return d
 
     @staticmethod
@@ -355,7 +374,21 @@ class Builder(object):
         for arg, value in d['kwargs'].items():
             kwargs[arg] = Args._retrieve_object(arg_classes, d['objects'], value)
 
-        return Builder(*args, **kwargs)
+        return Builder(*args, pipeline=d.get('pipeline', 0), **kwargs)
+
+    @staticmethod
+    def pipeline_stats(vision):
+        """Collects per stage statistics of a stack built with ``pipeline`` option.
+
+        :param vision: built processor stack
+        :return: a tuple of StageStats starting from the top of the stack
+        """
+        stats = ()
+        while isinstance(vision, ProcessorBase):
+            if isinstance(vision, MultiThreading):
+                stats += (vision.stats, )
+            vision = vision.source
+        return stats
 
     @staticmethod
     def convert_classes(classes):
@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 """Processor stack server using Pyro4. Used in conjunction with vision.PyroCapture.
 
-Uses Pyro4 for RPC and raw socket for return data transfer.
+Uses Pyro4 for RPC and raw socket for return data transfer. Frames are sent using binary codec, other results are pickled.
 
 NOTE: Passing images to the server is very inefficient.
 """
@@ -22,7 +22,7 @@ try:
 except ImportError:
     pass
 
-from EasyVision.vision.base import VisionBase
+from EasyVision.vision.base import VisionBase, Frame
 
 try:
     import cPickle as pickle
@@ -93,7 +93,7 @@ class ProxyVision(object):
     def send_data(self, data):
         if data is None:
             return None
-        data = pickle.dumps(data, protocol=-1)
+        data = data.tobytes() if isinstance(data, Frame) else pickle.dumps(data, protocol=-1)
         data_id = str(uuid.uuid4())
         self._pyroDaemon.datablobs[data_id] = data
         return data_id
@@ -6,6 +6,7 @@
 from EasyVision.base import *
 from collections import namedtuple
 from datetime import datetime
+from . import codec
 import cv2
 
 try:
@@ -51,30 +52,34 @@ class Image(NamedTupleExtendHelper, namedtuple('_Image', ['source', 'image', 'or
         return super(Image, cls).__new__(cls, source, image, original, mask, features, feature_type)
 
     def tobytes(self):
-        """Uses pickle to serialize Image object into bytes"""
-        return pickle.dumps(self, protocol=-1)
+        """Uses binary codec to serialize Image object into bytes"""
+        return codec.encode(self)
 
     @staticmethod
     def frombytes(data):
-        """Uses pickle to deserialize Image object from bytes"""
-        return pickle.loads(data)
+        """Uses binary codec to deserialize Image object from bytes. Arrays are not copied.
+
+        :param data: bytes-like object
+        :return: Image object
+        """
+        return codec.decode(data)
 
     def tobuffer(self, buf):
-        """Uses pickle to serialize Image object into a buffer
+        """Uses binary codec to serialize Image object into a buffer
 
         :param buf: Buffer-like object, that supports read/write methods
         :return: None
         """
-        pickle.dump(self, buf, protocol=-1)
+        codec.write(buf, self)
 
     @staticmethod
     def frombuffer(buf):
-        """Uses pickle to deserialize Image object from a buffer
+        """Uses binary codec to deserialize Image object from a buffer
 
         :param buf: Buffer-like object, that supports read/write methods
         :return: Image object
         """
-        return pickle.load(buf)
+        return codec.read(buf)
 
     def __reduce__(self):
         """Used for pickle to properly convert between UMat and numpy array"""
@@ -153,30 +158,34 @@ class Frame(NamedTupleExtendHelper, namedtuple('_Frame', ['timestamp', 'index',
         return "".join(i and "1" or "0" for i in processor_mask) if isinstance(processor_mask, tuple) else processor_mask
 
     def tobytes(self):
-        """Uses pickle to serialize Frame object into bytes"""
-        return pickle.dumps(self, protocol=-1)
+        """Uses binary codec to serialize Frame object into bytes"""
+        return codec.encode(self)
 
     @staticmethod
     def frombytes(data):
-        """Uses pickle to deserialize Frame object from bytes"""
-        return pickle.loads(data)
+        """Uses binary codec to deserialize Frame object from bytes. Arrays are not copied.
+
+        :param data: bytes-like object
+        :return: Frame object
+        """
+        return codec.decode(data)
 
     def tobuffer(self, buf):
-        """Uses pickle to serialize Frame object into a buffer
+        """Uses binary codec to serialize Frame object into a buffer
 
         :param buf: Buffer-like object, that supports read/write methods
         :return: None
         """
-        pickle.dump(self, buf, protocol=-1)
+        codec.write(buf, self)
 
     @staticmethod
     def frombuffer(buf):
-        """Uses pickle to deserialize Frame object from a buffer
+        """Uses binary codec to deserialize Frame object from a buffer
 
         :param buf: Buffer-like object, that supports read/write methods
         :return: Frame object
         """
-        return pickle.load(buf)
+        return codec.read(buf)
 
 
 class VisionBase(EasyVisionBase):
@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+"""Compact versioned binary codec for Frame, Image and Features objects.
+
+Unlike pickle the codec does not execute arbitrary code while decoding and does not convert arrays element by element.
+Encoded data consists of a fixed header followed by a stream of tagged values. Arrays are stored as raw buffers
+aligned to ``ALIGNMENT`` bytes, thus decoding creates ``np.frombuffer`` views into the data without copying.
+Keypoints are stored as a single structured array of ``KEYPOINT_DTYPE``.
+
+Header layout(little endian)::
+
+    magic(3 bytes) version(uint8) payload size(uint64)
+
+Supported values are None, bool, int, float, str, bytes, datetime, ndarray, UMat(downloaded), tuple, list,
+Frame, Image and Features(or any object with ``points`` and ``descriptors`` fields holding keypoints).
+Timezone aware datetime values are converted to UTC and decoded as naive datetime.
+Image source is not encoded, same as with pickle.
+
+.. note::
+    Decoded arrays are views into the supplied data. Arrays decoded from ``bytes`` are read only,
+    pass a ``bytearray`` to get writable arrays.
+"""
+
+from datetime import datetime, timedelta
+import struct
+import cv2
+import numpy as np
+
+
+MAGIC = b'EVB'
+VERSION = 1
+ALIGNMENT = 16
+
+HEADER = struct.Struct('<3sBQ')
+
+KEYPOINT_DTYPE = np.dtype([
+    ('pt', '<f4', (2, )),
+    ('size', '<f4'),
+    ('angle', '<f4'),
+    ('response', '<f4'),
+    ('octave', '<i4'),
+    ('class_id', '<i4'),
+])
+
+_NONE, _FALSE, _TRUE, _INT, _FLOAT, _STR, _BYTES, _DATETIME, _ARRAY, _TUPLE, _LIST, _FRAME, _IMAGE, _FEATURES, _KEYPOINTS = range(15)
+
+_EPOCH = datetime(1970, 1, 1)
+
+_TAG = struct.Struct('<B')
+_INT64 = struct.Struct('<q')
+_UINT32 = struct.Struct('<I')
+_FLOAT64 = struct.Struct('<d')
+
+
+def is_encoded(data):
+    """Checks whether data starts with the codec header
+
+    :param data: bytes-like object
+    :return: True if data was produced by ``encode``
+    """
+    return bytes(data[:len(MAGIC)]) == MAGIC
+
+
+def _import_types():
+    """Helper function to import structures lazily as vision.base and processors.base depend on this module"""
+    global Image, Frame, Features, KeyPoint
+    from .base import Image, Frame
+    from EasyVision.processors.base import Features, KeyPoint
+
+
+def encode(value):
+    """Encodes a value into bytes
+
+    :param value: Frame, Image, Features or any other supported value
+    :return: bytes
+    :raises: TypeError if value is not supported
+    """
+    _import_types()
+    buf = bytearray(HEADER.size)
+    _encode(buf, value)
+    HEADER.pack_into(buf, 0, MAGIC, VERSION, len(buf) - HEADER.size)
+    return bytes(buf)
+
+
+def decode(data):
+    """Decodes a value from bytes-like object. Arrays are not copied.
+
+    :param data: bytes-like object produced by ``encode``
+    :return: decoded value
+    :raises: ValueError if data is not valid
+    """
+    _import_types()
+    data = memoryview(data).cast('B')
+    size = _check_header(data[:HEADER.size])
+    if len(data) < HEADER.size + size:
+        raise ValueError("Encoded data is truncated")
+    value, offset = _decode(data, HEADER.size)
+    return value
+
+
+def write(buf, value):
+    """Encodes a value into a buffer-like object
+
+    :param buf: Buffer-like object, that supports write method
+    :param value: value to encode
+    :return: None
+    """
+    buf.write(encode(value))
+
+
+def read(buf):
+    """Decodes a value from a buffer-like object
+
+    :param buf: Buffer-like object, that supports read method
+    :return: decoded value
+    """
+    header = buf.read(HEADER.size)
+    size = _check_header(header)
+    data = bytearray(header)
+    data += buf.read(size)
+    return decode(data)
+
+
+def _check_header(header):
+    """Helper function to validate header and return payload size"""
+    if len(header) < HEADER.size:
+        raise ValueError("Encoded data is truncated")
+    magic, version, size = HEADER.unpack(bytes(header))
+    if magic != MAGIC:
+        raise ValueError("Data is not encoded with EasyVision codec")
+    if version != VERSION:
+        raise ValueError("Unsupported codec version %d" % version)
+    return size
+
+
+def _encode_array(buf, value):
+    """Helper function to write ndarray header, alignment padding and raw buffer"""
+    value = np.ascontiguousarray(value)
+    dtype = value.dtype.str.encode('ascii')
+    buf += _TAG.pack(len(dtype))
+    buf += dtype
+    buf += _TAG.pack(value.ndim)
+    buf += struct.pack('<%dq' % value.ndim, *value.shape)
+    buf += b'\0' * (-len(buf) % ALIGNMENT)
+    buf += value.data if value.size else b''
+
+
+def _encode_keypoints(buf, points):
+    """Helper function to write keypoints structured array. KeyPoint-like objects are packed first."""
+    if not isinstance(points, np.ndarray):
+        points = KeyPoint.toarray(points)
+    buf += _TAG.pack(_KEYPOINTS)
+    buf += _UINT32.pack(len(points))
+    buf += b'\0' * (-len(buf) % ALIGNMENT)
+    buf += np.ascontiguousarray(points, dtype=KEYPOINT_DTYPE).data
+
+
+def _encode(buf, value):
+    """Helper function to encode a single tagged value"""
+    if value is None:
+        buf += _TAG.pack(_NONE)
+    elif value is True or value is False or isinstance(value, np.bool_):
+        buf += _TAG.pack(_TRUE if value else _FALSE)
+    elif isinstance(value, (int, np.integer)):
+        buf += _TAG.pack(_INT)
+        buf += _INT64.pack(value)
+    elif isinstance(value, (float, np.floating)):
+        buf += _TAG.pack(_FLOAT)
+        buf += _FLOAT64.pack(value)
+    elif isinstance(value, str):
+        value = value.encode('utf-8')
+        buf += _TAG.pack(_STR)
+        buf += _UINT32.pack(len(value))
+        buf += value
+    elif isinstance(value, (bytes, bytearray)):
+        buf += _TAG.pack(_BYTES)
+        buf += _UINT32.pack(len(value))
+        buf += value
+    elif isinstance(value, datetime):
+        if value.utcoffset() is not None:
+            # timezone aware timestamps are stored as naive UTC
+            value = (value - value.utcoffset()).replace(tzinfo=None)
+        delta = value - _EPOCH
+        buf += _TAG.pack(_DATETIME)
+        buf += _INT64.pack((delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds)
+    elif isinstance(value, cv2.UMat):
+        buf += _TAG.pack(_ARRAY)
+        _encode_array(buf, value.get())
+    elif isinstance(value, np.ndarray) and value.dtype.names is None:
+        buf += _TAG.pack(_ARRAY)
+        _encode_array(buf, value)
+    elif isinstance(value, Frame):
+        buf += _TAG.pack(_FRAME)
+        for item in (value.timestamp, value.index, value.processor_mask):
+            _encode(buf, item)
+        buf += _UINT32.pack(len(value.images))
+        for image in value.images:
+            _encode(buf, image)
+    elif isinstance(value, Image):
+        buf += _TAG.pack(_IMAGE)
+        for item in value[1:]:
+            _encode(buf, item)
+    elif isinstance(value, Features) or (isinstance(value, tuple) and hasattr(value, 'points') and hasattr(value, 'descriptors')):
+        points = value.points
+        buf += _TAG.pack(_FEATURES)
+        if (isinstance(points, np.ndarray) and points.dtype == KEYPOINT_DTYPE) or (len(points) and hasattr(points[0], 'pt')):
+            _encode_keypoints(buf, points)
+        else:
+            _encode(buf, points)
+        _encode(buf, value.descriptors)
+        _encode(buf, getattr(value, 'points3d', None))
+    elif isinstance(value, (tuple, list)):
+        buf += _TAG.pack(_TUPLE if isinstance(value, tuple) else _LIST)
+        buf += _UINT32.pack(len(value))
+        for item in value:
+            _encode(buf, item)
+    else:
+        raise TypeError("Value of type %s can not be encoded" % type(value).__name__)
+
+
+def _decode_array(data, offset):
+    """Helper function to create ndarray view into the data"""
+    length = data[offset]
+    dtype = np.dtype(bytes(data[offset + 1:offset + 1 + length]).decode('ascii'))
+    offset += 1 + length
+    ndim = data[offset]
+    shape = struct.unpack_from('<%dq' % ndim, data, offset + 1)
+    offset += 1 + 8 * ndim
+    offset += -offset % ALIGNMENT
+    count = int(np.prod(shape, dtype=np.int64))
+    value = np.frombuffer(data, dtype, count, offset).reshape(shape)
+    return value, offset + count * dtype.itemsize
+
+
+def _decode(data, offset):
+    """Helper function to decode a single tagged value"""
+    tag = data[offset]
+    offset += 1
+    if tag == _NONE:
+        return None, offset
+    elif tag == _FALSE or tag == _TRUE:
+        return tag == _TRUE, offset
+    elif tag == _INT:
+        return _INT64.unpack_from(data, offset)[0], offset + _INT64.size
+    elif tag == _FLOAT:
+        return _FLOAT64.unpack_from(data, offset)[0], offset + _FLOAT64.size
+    elif tag == _STR or tag == _BYTES:
+        length = _UINT32.unpack_from(data, offset)[0]
+        offset += _UINT32.size
+        value = bytes(data[offset:offset + length])
+        return value.decode('utf-8') if tag == _STR else value, offset + length
+    elif tag == _DATETIME:
+        value = _INT64.unpack_from(data, offset)[0]
+        return _EPOCH + timedelta(microseconds=value), offset + _INT64.size
+    elif tag == _ARRAY:
+        return _decode_array(data, offset)
+    elif tag == _KEYPOINTS:
+        count = _UINT32.unpack_from(data, offset)[0]
+        offset += _UINT32.size
+        offset += -offset % ALIGNMENT
+        points = np.frombuffer(data, KEYPOINT_DTYPE, count, offset).view(np.recarray)
+        return points, offset + count * KEYPOINT_DTYPE.itemsize
+    elif tag == _FRAME:
+        timestamp, offset = _decode(data, offset)
+        index, offset = _decode(data, offset)
+        processor_mask, offset = _decode(data, offset)
+        count = _UINT32.unpack_from(data, offset)[0]
+        offset += _UINT32.size
+        images = []
+        for i in range(count):
+            image, offset = _decode(data, offset)
+            images.append(image)
+        return Frame(timestamp, index, tuple(images), processor_mask), offset
+    elif tag == _IMAGE:
+        items = []
+        for i in range(len(Image._fields) - 1):
+            item, offset = _decode(data, offset)
+            items.append(item)
+        return Image(None, *items), offset
+    elif tag == _FEATURES:
+        items = []
+        for i in range(3):
+            item, offset = _decode(data, offset)
+            items.append(item)
+        return Features._make(items), offset
+    elif tag == _TUPLE or tag == _LIST:
+        count = _UINT32.unpack_from(data, offset)[0]
+        offset += _UINT32.size
+        items = []
+        for i in range(count):
+            item, offset = _decode(data, offset)
+            items.append(item)
+        return tuple(items) if tag == _TUPLE else items, offset
+    raise ValueError("Unknown value tag %d" % tag)
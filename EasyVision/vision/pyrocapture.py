@@ -5,6 +5,7 @@
 
 from EasyVision.base import lru_cache
 from .base import *
+from . import codec
 import Pyro4
 import socket
 from EasyVision.server import Command
@@ -77,7 +78,7 @@ class PyroCapture(VisionBase):
             size = int(Pyro4.socketutil.receiveData(self._sock, 16).decode())
             data = Pyro4.socketutil.receiveData(self._sock, size)
             assert(size == len(data))
-            result = pickle.loads(data)
+            result = Frame.frombytes(bytearray(data)) if codec.is_encoded(data) else pickle.loads(data)
             if isinstance(result, Frame):
                 result = result._replace(images=tuple(i._replace(source=self) for i in result.images))
             return result
@@ -370,11 +370,11 @@ def assert_stereo_camera(camera):
     assert(isinstance(camera.Q, np.ndarray))
 
 
-def common_test_match_images(feature_type, display=False, mp=False):
+def common_test_match_images(feature_type, display=False, mp=False, batched=False, parallel=False):
     vision = ImagesReader(images_obj)
     _extractor = FeatureExtraction(vision, feature_type, display_results=display)
     extractor = MultiProcessing(_extractor, freerun=False, display_results=display, debug=display) if mp else _extractor
-    with ObjectRecognitionEngine(extractor, feature_type, display_results=display) as engine:
+    with ObjectRecognitionEngine(extractor, feature_type, display_results=display, batched=batched, parallel=parallel) as engine:
         frame_count = 0
 
         assert(engine.enroll("obj1", ImagesReader.load_image(image_obj1, image_obj1_mask), add=True, display_results=display) is not None)
@@ -402,6 +402,9 @@ def common_test_match_images(feature_type, display=False, mp=False):
             cv2.waitKey(0)
 
         assert(frame_count == len(images_obj))
+        if batched:
+            # per view indexes are not built in batched mode
+            assert(len(engine._indexes) == len(engine._global_indexes))
 
 
 def common_test_visual_odometry_kitti(feature_type, mp=False, ocl=True, debug=False, color=cv2.COLOR_BGR2GRAY, odometry_class=VisualOdometry2DEngine,
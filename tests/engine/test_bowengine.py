@@ -25,9 +25,9 @@ images = ['d:/datasets/data_odometry_gray/dataset/sequences/{}/image_0/{}.png'.f
 gt_path = "d:/datasets/data_odometry_gray/dataset/poses/{}.txt".format(pose)
 
 
-def build_vocabulary(path, dbow3, feature_type):
+def build_vocabulary(path, dbow3, feature_type, **kwargs):
     cam = CalibratedCamera(ImageTransform(ImagesReader(images), ocl=False, color=cv2.COLOR_BGR2GRAY, enabled=True), camera, enabled=True)
-    with BOWVocabularyBuilderEngine(cam, clusters=70, feature_type=feature_type, dbow3_trainer=dbow3) as engine:
+    with BOWVocabularyBuilderEngine(cam, clusters=70, feature_type=feature_type, dbow3_trainer=dbow3, **kwargs) as engine:
         for frame in engine:
             pass
         engine.create_vocabulary()
@@ -85,3 +85,175 @@ def test_dbow3_matching():
             database.add(frame.images[0].features.descriptors)
 
 
+@mark.main
+def test_keyframe_database():
+    histograms = np.float32(np.random.uniform(0, 1, (50, 100)) > 0.8) * np.random.uniform(0, 1, (50, 100))
+    idf = KeyframeDatabase.compute_idf(histograms)
+    for scoring in KeyframeDatabase.SCORING:
+        database = KeyframeDatabase(100, idf, scoring)
+        for histogram in histograms:
+            database.add(histogram)
+        assert(len(database) == 50)
+
+        results = database.query(histograms[7], max_results=5)
+        assert(len(results) == 5)
+        assert(results[0][0] == 7)
+        assert(results[0][1] == approx(1.0, abs=1e-5))
+        assert(all(a[1] >= b[1] for a, b in zip(results, results[1:])))
+
+        vectors = [database.transform(h) for h in histograms]
+        dense = np.zeros((50, 100), np.float32)
+        for row, (words, values) in zip(dense, vectors):
+            row[words] = values
+        if scoring == 'L1':
+            expected = np.minimum(dense, dense[7]).sum(axis=1)
+        else:
+            expected = dense.dot(dense[7])
+        assert([score for i, score in results] == approx(sorted(expected, reverse=True)[:5], abs=1e-5))
+
+
+@mark.main
+def test_keyframe_database_save(tmpdir):
+    histograms = np.float32(np.random.uniform(0, 1, (20, 30)) > 0.7)
+    database = KeyframeDatabase(30)
+    for histogram in histograms:
+        database.add(histogram)
+    path = str(tmpdir.join('database.npz'))
+    database.save(path)
+    loaded = KeyframeDatabase.load(path)
+    assert(len(loaded) == 20)
+    assert(loaded.scoring == database.scoring)
+    assert(loaded.query(histograms[3]) == database.query(histograms[3]))
+    assert(loaded.add(histograms[3]) == 20)
+    assert(loaded.query(histograms[3], 2)[1][0] in (3, 20))
+
+
+@mark.main
+def test_bow_matching_mixin_opencv():
+    class Matcher(BOWMatchingMixin):
+        def release(self):
+            pass
+
+    vocabulary = np.float32(np.random.uniform(0, 1, (40, 16)))
+    mixin = Matcher()
+    mixin.initBOW(None, None, vocabulary, 'SIFT')
+    frames = [vocabulary[np.random.randint(0, 40, 30)] + np.float32(np.random.normal(0, 0.01, (30, 16))) for i in range(10)]
+    for descriptors in frames:
+        mixin._add_keyframe(descriptors)
+    results = mixin._query_frame(frames[4], max_results=3)
+    assert(len(results) == 3)
+    assert(results[0][0] == 4)
+
+
+
+@mark.main
+def test_streaming_trainer():
+    random = np.random.RandomState(0)
+    centers = np.float32(random.uniform(0, 1, (20, 32)))
+    trainer = StreamingVocabularyTrainer(20, batch_size=500, reservoir_size=2000, seed=0)
+    for i in range(50):
+        trainer.add(centers[random.randint(0, 20, 200)] + np.float32(random.normal(0, 0.02, (200, 32))))
+    assert(trainer.descriptorsCount() == 10000)
+    assert(len(trainer.reservoir) == 2000)
+    vocabulary = trainer.cluster()
+    assert(vocabulary.shape == (20, 32))
+    distances = np.sqrt(((vocabulary[:, None] - centers[None]) ** 2).sum(axis=2))
+    assert(distances.min(axis=0).max() < 0.05)
+
+
+@mark.main
+def test_streaming_trainer_binary():
+    random = np.random.RandomState(0)
+    centers = np.unpackbits(np.uint8(random.randint(0, 256, (20, 32))), axis=1)
+    trainer = StreamingVocabularyTrainer(20, binary=True, batch_size=500, reservoir_size=2000, seed=0)
+    for i in range(50):
+        bits = centers[random.randint(0, 20, 200)] ^ np.uint8(random.uniform(0, 1, (200, 256)) < 0.05)
+        trainer.add(np.packbits(bits, axis=1))
+    vocabulary = trainer.cluster()
+    assert(vocabulary.shape == (20, 32) and vocabulary.dtype == np.uint8)
+    distances = (np.unpackbits(vocabulary, axis=1)[:, None] != centers[None]).sum(axis=2)
+    assert(distances.min(axis=0).max() == 0)
+
+
+@mark.long
+def test_build_vocabulary_streaming():
+    with BOWVocabularyBuilderEngine(ImagesReader(images), clusters=70, feature_type='ORB', dbow3_trainer=False,
+                                    streaming=True, batch_size=1000, reservoir_size=5000) as engine:
+        for frame in engine:
+            pass
+        engine.create_vocabulary()
+        assert(engine.vocabulary.shape == (70, 32))
+
+
+def hierarchical_words(random, k, L, binary):
+    """Generates k^L words, which form k well separated clusters on every level"""
+    if binary:
+        words = np.unpackbits(np.uint8(random.randint(0, 256, (k, 32))), axis=1)
+        for flip in (0.2, 0.05)[:L - 1]:
+            words = np.repeat(words, k, axis=0) ^ np.uint8(random.uniform(0, 1, (len(words) * k, 256)) < flip)
+        return np.packbits(words, axis=1)
+    words = np.float32(random.uniform(0, 100, (k, 16)))
+    for scale in (10, 1)[:L - 1]:
+        words = np.repeat(words, k, axis=0) + np.float32(random.uniform(0, scale, (len(words) * k, 16)))
+    return words
+
+
+@mark.main
+def test_vocabulary_tree_binary(tmpdir):
+    random = np.random.RandomState(0)
+    words = hierarchical_words(random, 4, 3, True)
+    features = [words[random.randint(0, 64, 100)] for i in range(20)]
+    tree = VocabularyTree(4, 3, binary=True)
+    tree.create(features, seed=0)
+    assert(tree.size == 64)
+    assert(tree.idf.shape == (64, ))
+    assert(len(set(tree.transform(words).tolist())) == 64)
+
+    noisy = np.packbits(np.unpackbits(words, axis=1) ^ np.uint8(random.uniform(0, 1, (64, 256)) < 0.01), axis=1)
+    assert(tree.transform(noisy).tolist() == tree.transform(words).tolist())
+    histogram = tree.histogram(features[0])
+    assert(histogram.sum() == approx(1.0))
+
+    path = str(tmpdir.join('vocabulary.tree'))
+    tree.save(path)
+    loaded = VocabularyTree()
+    loaded.load(path)
+    assert(loaded.k == 4 and loaded.L == 3 and loaded.binary)
+    assert(loaded.transform(noisy).tolist() == tree.transform(noisy).tolist())
+
+
+@mark.main
+def test_vocabulary_tree_float():
+    random = np.random.RandomState(0)
+    words = hierarchical_words(random, 3, 3, False)
+    features = [words[random.randint(0, 27, 100)] + np.float32(random.normal(0, 0.01, (100, 16))) for i in range(10)]
+    tree = VocabularyTree(3, 3)
+    tree.create(features, seed=0)
+    assert(tree.size == 27)
+    assert(len(set(tree.transform(words).tolist())) == 27)
+    assert(tree.transform(features[0]).tolist() == tree.transform(words[np.argmin(((features[0][:, None] - words[None]) ** 2).sum(axis=2), axis=1)]).tolist())
+
+
+@mark.main
+def test_bow_matching_mixin_tree():
+    class Matcher(BOWMatchingMixin):
+        def release(self):
+            pass
+
+    random = np.random.RandomState(0)
+    words = np.uint8(random.randint(0, 256, (100, 32)))
+    frames = [words[random.randint(0, 100, 50)] for i in range(10)]
+    tree = VocabularyTree(5, 3, binary=True)
+    tree.create(frames, seed=0)
+    mixin = Matcher()
+    mixin.initBOW(None, None, tree, 'ORB')
+    for descriptors in frames:
+        mixin._add_keyframe(descriptors)
+    results = mixin._query_frame(frames[6], max_results=3)
+    assert(len(results) == 3)
+    assert(results[0][0] == 6)
+
+
+@mark.long
+def test_build_vocabulary_tree():
+    build_vocabulary("test.tree", False, 'ORB', tree=True)
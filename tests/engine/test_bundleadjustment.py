@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pytest
+from pytest import raises, approx
+from EasyVision.engine import BundleAdjuster
+import threading
+import cv2
+import numpy as np
+
+
+MATRIX = np.float64([[700, 0, 600], [0, 700, 180], [0, 0, 1]])
+
+
+def camera(k):
+    R = cv2.Rodrigues(np.float64([0, .02 * k, 0]))[0]
+    return R, -R.dot([.1 * k, 0, 1. * k])
+
+
+def project(R, t, points):
+    projected = (points.dot(R.T) + t).dot(MATRIX.T)
+    uv = projected[:, :2] / projected[:, 2:]
+    visible = (projected[:, 2] > 0) & (uv[:, 0] > 0) & (uv[:, 0] < 1200) & (uv[:, 1] > 0) & (uv[:, 1] < 360)
+    return uv, visible
+
+
+def add_keyframe(adjuster, k, world, ids, random):
+    """Adds a keyframe with perturbed pose and noisy observations with a few outliers"""
+    R, t = camera(k)
+    noise = (random.normal(0, .002, 3), random.normal(0, .05, 3)) if k else (0, 0)
+    i = adjuster.add_keyframe(cv2.Rodrigues(cv2.Rodrigues(R)[0].ravel() + noise[0])[0], t + noise[1])
+    uv, visible = project(R, t, world)
+    uv = uv[visible] + random.normal(0, .5, (np.count_nonzero(visible), 2))
+    uv[::20] += random.uniform(-50, 50, (len(uv[::20]), 2))
+    adjuster.add_observations(i, ids[visible], uv)
+    return i
+
+
+def translation_errors(adjuster, count):
+    return np.float64([np.linalg.norm(adjuster.keyframe(k)[1] - camera(k)[1]) for k in range(count)])
+
+
+def scene(random, count=500):
+    world = np.column_stack((random.uniform(-20, 20, count), random.uniform(-3, 3, count), random.uniform(5, 60, count)))
+    return world, world + random.normal(0, .05, world.shape)
+
+
+@pytest.mark.main
+def test_bundle_adjuster():
+    random = np.random.RandomState(0)
+    world, initial = scene(random)
+    adjuster = BundleAdjuster(MATRIX, window=4, background=False)
+    ids = adjuster.add_landmarks(initial)
+    assert(adjuster.landmark_count == 500 and np.array_equal(ids, np.arange(500)))
+
+    before = []
+    for k in range(6):
+        add_keyframe(adjuster, k, world, ids, random)
+        before.append(translation_errors(adjuster, k + 1)[-1])
+        adjuster.request()
+    after = translation_errors(adjuster, 6)
+
+    assert(len(adjuster) == 6 and adjuster.version == 5)
+    assert(after[0] == 0)
+    assert(after.max() < max(before) / 5)
+    landmarks = adjuster.landmarks(ids)
+    assert(np.median(np.linalg.norm(landmarks - world, axis=1)) < np.median(np.linalg.norm(initial - world, axis=1)))
+
+    with raises(ValueError):
+        adjuster.add_observations(6, ids, world[:, :2])
+    with raises(ValueError):
+        adjuster.add_observations(0, [500], [[0, 0]])
+    with raises(ValueError):
+        BundleAdjuster(MATRIX, window=1)
+
+
+@pytest.mark.main
+def test_bundle_adjuster_background(mocker):
+    random = np.random.RandomState(0)
+    world, initial = scene(random)
+    started, proceed = threading.Event(), threading.Event()
+    optimize = BundleAdjuster._optimize
+
+    def _optimize(*args):
+        started.set()
+        proceed.wait()
+        return optimize(*args)
+    mocker.patch.object(BundleAdjuster, '_optimize', staticmethod(_optimize))
+
+    with BundleAdjuster(MATRIX, window=4) as adjuster:
+        ids = adjuster.add_landmarks(initial)
+        for k in range(4):
+            add_keyframe(adjuster, k, world, ids, random)
+        before = translation_errors(adjuster, 4)
+        adjuster.request()
+        assert(started.wait(10))
+
+        # keyframes and landmarks added while optimizing are moved together with the last optimized keyframe
+        R, t = adjuster.keyframe(3)
+        i = adjuster.add_keyframe(R, t)
+        new = adjuster.add_landmarks(world[:1] + [0, 0, 1])
+        proceed.set()
+        assert(adjuster.wait(30))
+        assert(adjuster.version == 1)
+
+        assert(translation_errors(adjuster, 4).max() < before.max() / 3)
+        R3, t3 = adjuster.keyframe(3)
+        Ri, ti = adjuster.keyframe(i)
+        assert(np.allclose(R3, Ri) and np.allclose(t3, ti))
+        point = adjuster.landmarks(new)[0]
+        assert(np.allclose(R3.dot(point) + t3, R.dot(world[0] + [0, 0, 1]) + t))
+
+
+@pytest.mark.main
+def test_bundle_adjuster_history():
+    random = np.random.RandomState(0)
+    adjuster = BundleAdjuster(MATRIX, window=2, background=False)
+    assert(adjuster.history == 4)
+
+    def observe(i, k, world, ids):
+        uv, visible = project(camera(k)[0], camera(k)[1], world)
+        adjuster.add_observations(i, ids[visible], uv[visible] + random.normal(0, .5, (np.count_nonzero(visible), 2)))
+
+    for k in range(12):
+        i = adjuster.add_keyframe(*camera(k))
+        if k:
+            # landmarks of the previous keyframe are observed once more
+            observe(i, k, world, ids)
+        world = np.column_stack((random.uniform(-20, 20, 50), random.uniform(-3, 3, 50), random.uniform(5, 60, 50)))
+        world += camera(k)[0].T.dot(-camera(k)[1])
+        ids = adjuster.add_landmarks(world)
+        observe(i, k, world, ids)
+        adjuster.request()
+
+        # landmarks added since the oldest kept keyframe and landmarks it observes are kept
+        assert(len(adjuster._rotations) <= 4 and adjuster._size <= 5 * 50)
+
+    assert(len(adjuster) == 12 and adjuster.landmark_count == 12 * 50 and adjuster.version == 11)
+    R, t = adjuster.keyframe(11)
+    assert(np.linalg.norm(t - camera(11)[1]) < .5)
+    assert(adjuster.landmarks(ids).shape == (50, 3))
+
+    # forgotten keyframes and landmarks do not exist anymore
+    with raises(ValueError):
+        adjuster.keyframe(7)
+    with raises(ValueError):
+        adjuster.landmarks([0])
+    with raises(ValueError):
+        adjuster.add_observations(0, [], np.zeros((0, 2)))
+    with raises(ValueError):
+        BundleAdjuster(MATRIX, window=4, history=7)
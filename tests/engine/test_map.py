@@ -4,7 +4,9 @@
 import pytest
 from pytest import raises, approx
 from EasyVision.engine.base import EngineBase, MapBase, Pose
-from EasyVision.engine import OccupancyGridMap
+from EasyVision.engine import OccupancyGridMap, TiledGrid, GridPlanner, DStarLitePlanner
+from EasyVision.processors import Features
+import numpy as np
 import cv2
 
 
@@ -32,3 +34,215 @@ def test_map_load_plan():
     assert(tuple(path[-1]) == (325, 5))
     assert(len(path) > 10)
 
+
+
+@pytest.mark.main
+def test_map_update():
+    points3d = np.float32([[0, 0, 40], [20, 0, 20], [-10, 0, 30], [0, 100, 30]])
+    pose = Pose(0, np.eye(3), [[100], [0], [50]], Features(np.zeros((4, 2), np.float32), None, points3d))
+    _map = OccupancyGridMap((200, 200), 1, min_y=-1, max_y=10, max_d=50, alpha=.6, beta=-.4)
+    _map.update(pose)
+    grid = _map.map_raw.reshape(200, 200)
+
+    # obstacles are at the points, free space is between the pose and the points
+    assert(grid[90, 100] > 0)
+    assert(grid[70, 120] > 0)
+    assert(grid[80, 90] > 0)
+    assert(grid[70, 100] == approx(-.4))
+    assert(grid[60, 110] == approx(-.4))
+    assert(grid[65, 95] == approx(-.4))
+    assert(grid[70, 80] == 0)
+    assert(grid[95, 100] == 0)
+    assert(np.count_nonzero(grid > 0) < 40)
+
+
+@pytest.mark.main
+def test_tiled_grid():
+    grid = TiledGrid(16, clamp=(-1, 1))
+    assert(grid.bounds is None)
+    values = np.float32(np.random.uniform(-.5, .5, (20, 30)))
+    grid.add(-10, -5, values)
+    assert(sorted(grid.tiles) == [(-1, -1), (-1, 0), (0, -1), (0, 0), (1, -1), (1, 0)])
+    assert(grid.bounds == (-16, -16, 32, 16))
+    assert(np.array_equal(grid.window(-10, -5, 20, 15), values))
+    grid.add(-10, -5, values * 4)
+    assert(np.array_equal(grid.window(-10, -5, 20, 15), np.clip(values * 5, -1, 1)))
+    grid.add(100, 100, np.zeros((5, 5), np.float32))
+    assert(len(grid.tiles) == 6)
+    dense, origin = grid.todense()
+    assert(origin == (-16, -16) and dense.shape == (32, 48))
+
+
+@pytest.mark.main
+def test_map_update_tiled():
+    points3d = np.float32(np.random.uniform(-20, 20, (500, 3)))
+    points3d[:, 1] = 0
+    pose = Pose(0, np.eye(3), [[10], [0], [5]], Features(np.zeros((500, 2), np.float32), None, points3d))
+    dense = OccupancyGridMap((200, 200), 1, min_y=-1, max_y=10)
+    tiled = OccupancyGridMap(None, 1, min_y=-1, max_y=10, tile_size=32)
+    dense.update(pose)
+    tiled.update(pose)
+    assert(tiled.tiled and not dense.tiled)
+    ox, oy = tiled.origin
+    assert(ox < 0 and oy < 0)
+    raw = tiled.map_raw
+    expected = np.zeros(raw.shape, np.float32)
+    expected[-oy:, -ox:] = dense.map_raw.reshape(200, 200)[:raw.shape[0] + oy, :raw.shape[1] + ox]
+    assert(np.allclose(raw[-oy:, -ox:], expected[-oy:, -ox:]))
+    assert(np.count_nonzero(raw[:-oy]) > 0)
+
+
+def _path_cost(path):
+    steps = np.abs(np.diff(np.int32(path), axis=0))
+    assert(np.all(steps.max(axis=1) == 1))
+    return np.sum(np.where(steps.sum(axis=1) == 2, 2 ** .5, 1.))
+
+
+@pytest.mark.main
+def test_grid_planner():
+    rng = np.random.RandomState(0)
+    for i in range(50):
+        grid = rng.rand(30, 40) > .3
+        free = np.argwhere(grid)
+        (sy, sx), (gy, gx) = free[rng.randint(len(free), size=2)]
+        planner = GridPlanner(grid)
+        path = planner.plan((sx, sy), (gx, gy))
+        jps_path = planner.plan((sx, sy), (gx, gy), jps=True)
+        assert(bool(path) == bool(jps_path))
+        if not path:
+            continue
+        assert(path[0] == jps_path[0] == (sx, sy))
+        assert(path[-1] == jps_path[-1] == (gx, gy))
+        assert(all(grid[y, x] for x, y in jps_path))
+        for (x0, y0), (x1, y1) in zip(jps_path, jps_path[1:]):
+            assert(grid[y0, x1] and grid[y1, x0])
+        assert(_path_cost(path) == approx(_path_cost(jps_path)))
+
+    grid = np.ones((10, 10), np.bool_)
+    grid[:, 5] = False
+    assert(GridPlanner(grid).plan((0, 0), (9, 9)) == [])
+    assert(GridPlanner(grid).plan((0, 0), (5, 5)) == [])
+
+
+@pytest.mark.main
+def test_map_plan_cache():
+    m = cv2.cvtColor(cv2.imread("test_data/gridmap.bmp"), cv2.COLOR_BGR2GRAY)
+
+    start = Pose(0, np.eye(3), [[10], [0], [5]])
+    target = Pose(0, np.eye(3), [[325], [0], [5]])
+
+    _map = OccupancyGridMap(m, scale=1, poses=[start])
+    path = _map.plan(target, 11)
+    planners = dict(_map._planners)
+    jps_path = _map.plan(target, 11, jps=True)
+    assert(_map._planners == planners)
+    assert(tuple(jps_path[0]) == (10, 5) and tuple(jps_path[-1]) == (325, 5))
+    assert(_path_cost(path) == approx(_path_cost(jps_path)))
+
+    points3d = np.float32([[0, 0, 40]])
+    _map.update(Pose(0, np.eye(3), [[100], [0], [50]], Features(np.zeros((1, 2), np.float32), None, points3d)))
+    _map.plan(target, 11)
+    assert(all(a is not b for a, b in zip(_map._planners.values(), planners.values())))
+
+
+@pytest.mark.main
+def test_dstar_lite_planner():
+    rng = np.random.RandomState(1)
+    for i in range(30):
+        grid = rng.rand(30, 40) > .3
+        free = np.argwhere(grid)
+        (sy, sx), (gy, gx) = free[rng.randint(len(free), size=2)]
+        start, goal = (sx, sy), (gx, gy)
+        planner = DStarLitePlanner(grid, goal)
+        for step in range(5):
+            path = planner.replan(start)
+            expected = GridPlanner(grid).plan(start, goal)
+            assert(bool(path) == bool(expected))
+            if path:
+                assert(path[0] == start and path[-1] == goal)
+                assert(all(grid[y, x] for x, y in path))
+                assert(_path_cost(path) == approx(_path_cost(expected)))
+                start = path[min(3, len(path) - 1)]
+            grid = grid.copy()
+            changed = rng.rand(*grid.shape) < .03
+            grid[changed] = ~grid[changed]
+            grid[start[1], start[0]] = grid[goal[1], goal[0]] = True
+            planner.update(grid)
+
+
+@pytest.mark.main
+def test_map_replan():
+    m = cv2.cvtColor(cv2.imread("test_data/gridmap.bmp"), cv2.COLOR_BGR2GRAY)
+
+    start = Pose(0, np.eye(3), [[10], [0], [5]])
+    target = Pose(0, np.eye(3), [[325], [0], [5]])
+
+    _map = OccupancyGridMap(m, scale=1, poses=[start], alpha=3)
+    path = _map.replan(target, 11)
+    assert(tuple(path[0]) == (10, 5) and tuple(path[-1]) == (325, 5))
+    planner = _map._dstar
+
+    # start is closer to the wall than the radius, thus inflation is only relaxed around it
+    clearance = _map._clearance()
+    assert(clearance[5, 10] < 11)
+    assert(all(clearance[y, x] >= 11 or (x - 10) ** 2 + (y - 5) ** 2 <= 11 ** 2 for x, y in np.int32(path)))
+    assert(_path_cost(path) >= _path_cost(_map.plan(target, 11)))
+
+    # search is reused once the robot leaves the inflated zone
+    x, y = path[len(path) // 2]
+    _map._poses.append(Pose(0, np.eye(3), [[x], [0], [y]]))
+    path = _map.replan(target, 11)
+    assert(_map._dstar is planner)
+    assert(tuple(path[0]) == (x, y) and tuple(path[-1]) == (325, 5))
+    assert(_path_cost(path) == approx(_path_cost(_map.plan(target, 11)), rel=1e-5))
+
+    points3d = np.float32([[5, 0, 20]])
+    _map.update(Pose(0, np.eye(3), [[x], [0], [y]], Features(np.zeros((1, 2), np.float32), None, points3d)))
+    path = _map.replan(target, 11)
+    assert(_map._dstar is planner and planner.expanded > 0)
+    assert(tuple(path[-1]) == (325, 5))
+    assert(_path_cost(path) == approx(_path_cost(_map.plan(target, 11)), rel=1e-5))
+
+
+@pytest.mark.main
+def test_topological_map():
+    from EasyVision.engine import TopologicalMap, VocabularyTree
+
+    random = np.random.RandomState(0)
+    places = [np.float32(random.uniform(0, 100, (1, 16)) + random.normal(0, 1, (50, 16))) for i in range(4)]
+    tree = VocabularyTree(4, 2)
+    tree.create(places, seed=0)
+
+    positions = [(0, 0), (100, 0), (100, 100), (0, 100)]
+
+    def pose(place, offset=0):
+        x, z = positions[place]
+        return Pose(0, np.eye(3), [[x + offset], [0], [z + offset]], Features(np.zeros((50, 2), np.float32), places[place]))
+
+    _map = TopologicalMap((200, 200), tree, scale=1, index_cell=16)
+    with _map:
+        # loop around the places and come back to the first one, loop closure is confirmed by the second match
+        for place in (0, 0, 1, 1, 2, 3, 3, 0):
+            _map.update(pose(place, 2))
+        assert(_map.current == 3)
+        _map.update(pose(0, 2))
+        assert(len(_map.graph) == 4)
+        assert(_map.current == 0)
+        assert(sorted(_map.graph[0].links) == [1, 3])
+        assert(sorted(_map.graph[2].links) == [1, 3])
+
+        assert(_map.nearest(pose(2, 10)) == 2)
+        assert(_map.nearest(pose(3, -30)) == 3)
+        assert(_map.shortest_path(0, 2) in ([0, 1, 2], [0, 3, 2]))
+        assert(_map.shortest_path(1, 3) in ([1, 0, 3], [1, 2, 3]))
+
+        path = _map.plan(pose(2, 5), 1)
+        assert(tuple(path[0]) == (2, 2) and tuple(path[-1]) == (105, 105))
+        assert(len(path) == 5)
+
+    # recently added nodes do not close loops
+    with TopologicalMap((200, 200), tree, scale=1, loop_exclude=3) as _map:
+        for place in (0, 1, 2, 0, 0):
+            _map.update(pose(place))
+        assert(len(_map.graph) == 3 and _map.current == 2)
+        assert(_map.graph[0].links == (1, ))
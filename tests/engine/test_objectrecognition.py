@@ -34,3 +34,23 @@ def test_match_images_SURF():
 @mark.long
 def test_match_images_SIFT():
     common_test_match_images('SIFT')
+
+
+@mark.long
+def test_match_images_ORB_batched():
+    common_test_match_images('ORB', batched=True)
+
+
+@mark.long
+def test_match_images_AKAZE_batched():
+    common_test_match_images('AKAZE', batched=True)
+
+
+@mark.long
+def test_match_images_ORB_parallel():
+    common_test_match_images('ORB', parallel=True)
+
+
+@mark.long
+def test_match_images_ORB_batched_parallel():
+    common_test_match_images('ORB', batched=True, parallel=2)
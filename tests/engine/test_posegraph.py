@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pytest
+from pytest import raises, approx
+from EasyVision.engine.base import Pose
+from EasyVision.engine import TopologicalMap, VocabularyTree, PoseGraphOptimizer
+from EasyVision.processors import Features
+import numpy as np
+
+
+def rotation(angle):
+    c, s = np.cos(angle), np.sin(angle)
+    return np.float64([[c, 0, s], [0, 1, 0], [-s, 0, c]])
+
+
+def circle(count, radius=100):
+    angles = np.linspace(0, 2 * np.pi, count, endpoint=False)
+    return [Pose(0, rotation(-a), [[radius * np.cos(a)], [0], [radius * np.sin(a)]]) for a in angles]
+
+
+def drifting_graph(optimizer, poses, random):
+    optimizer.add_node(poses[0].rotation, poses[0].translation)
+    for k in range(1, len(poses)):
+        R, t = PoseGraphOptimizer.relative(poses[k - 1], poses[k])
+        R, t = R.dot(rotation(.01)), t + random.normal(0, .1, 3)
+        last = optimizer.pose(k - 1)
+        optimizer.add_node(np.float64(last.rotation).dot(R), last.translation.ravel() + np.float64(last.rotation).dot(t))
+        optimizer.add_edge(k - 1, k, R, t)
+    optimizer.add_edge(len(poses) - 1, 0, *PoseGraphOptimizer.relative(poses[-1], poses[0]), information=100)
+
+
+def translation_errors(optimizer, poses):
+    return np.float64([np.linalg.norm(optimizer.pose(i).translation.ravel() - poses[i].translation.ravel())
+                       for i in range(len(poses))])
+
+
+@pytest.mark.main
+def test_pose_graph_optimizer():
+    random = np.random.RandomState(0)
+    poses = circle(100)
+    optimizer = PoseGraphOptimizer(background=False)
+    drifting_graph(optimizer, poses, random)
+    assert(len(optimizer) == 100 and len(optimizer.edges) == 100)
+
+    before = translation_errors(optimizer, poses)
+    optimizer.request()
+    after = translation_errors(optimizer, poses)
+    assert(optimizer.version == 1)
+    assert(after.max() < before.max() / 5)
+    assert(np.allclose(optimizer.pose(0).translation, poses[0].translation))
+
+    with raises(ValueError):
+        optimizer.add_edge(0, 100, np.eye(3), np.zeros(3))
+
+
+@pytest.mark.main
+def test_pose_graph_optimizer_background():
+    random = np.random.RandomState(0)
+    poses = circle(100)
+    with PoseGraphOptimizer() as optimizer:
+        drifting_graph(optimizer, poses, random)
+        before = translation_errors(optimizer, poses)
+        optimizer.request()
+        # nodes added while optimizing are moved together with the last optimized node
+        optimizer.add_node(optimizer.pose(99).rotation, optimizer.pose(99).translation)
+        optimizer.add_edge(99, 100, np.eye(3), np.zeros(3))
+        assert(optimizer.wait(10))
+        assert(optimizer.version == 1)
+        assert(translation_errors(optimizer, poses).max() < before.max() / 5)
+        assert(np.allclose(optimizer.pose(100).translation, optimizer.pose(99).translation, atol=1e-3))
+
+
+@pytest.mark.main
+def test_topological_map_optimizer():
+    random = np.random.RandomState(0)
+    places = [np.float32(random.uniform(0, 100, (1, 16)) + random.normal(0, 1, (50, 16))) for i in range(12)]
+    tree = VocabularyTree(4, 2)
+    tree.create(places, seed=0)
+    poses = circle(12)
+
+    with TopologicalMap((400, 400), tree, scale=1, optimizer=PoseGraphOptimizer(background=False)) as _map:
+        corrected = None
+        # place 0 is revisited twice, as loop closure must be matched in consecutive updates
+        route = list(range(12)) + [0, 0]
+        for i, k in enumerate(route):
+            if corrected is None:
+                pose = poses[0]
+            else:
+                # odometry with a rotation bias is composed with the pose returned by the map
+                R, t = PoseGraphOptimizer.relative(poses[route[i - 1]], poses[k])
+                rotation_ = np.float64(corrected.rotation)
+                pose = Pose(0, rotation_.dot(R).dot(rotation(.05)), corrected.translation.ravel() + rotation_.dot(t))
+            corrected = _map.update(pose._replace(features=Features(np.zeros((50, 2), np.float32), places[k])))
+
+        assert(len(_map.graph) == 12 and _map.current == 0)
+        assert(_map._optimizer.version == 1)
+        errors = [np.linalg.norm(node.pose.translation.ravel() - poses[i].translation.ravel()) for i, node in enumerate(_map.graph)]
+        assert(max(errors) < 20)
+        assert(np.allclose(corrected.translation, poses[0].translation))
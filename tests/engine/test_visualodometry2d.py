@@ -77,4 +77,41 @@ def test_visual_odometry_dataset():
             cv2.imshow('Trajectory', traj)
             cv2.waitKey(1)
 
-    cv2.waitKey(0)
\ No newline at end of file
+    cv2.waitKey(0)
+
+@mark.main
+def test_visual_odometry_2d_bundle_adjustment():
+    images_kitti_l = ['test_data/kitti00/image_0/{}.png'.format(str(i).zfill(6)) for i in range(3)]
+
+    cam_left = CalibratedCamera(ImageTransform(ImagesReader(images_kitti_l), ocl=False, color=cv2.COLOR_BGR2GRAY), camera_kitti)
+    adjuster = BundleAdjuster(camera_kitti.matrix, background=False)
+    with VisualOdometry2DEngine(cam_left, feature_type='ORB', bundle_adjuster=adjuster) as engine:
+        poses = [engine.compute()[1] for i in range(3)]
+        assert(poses[-1] is not None)
+        assert(len(adjuster) >= 2 and adjuster.landmark_count > 0)
+        assert(adjuster.version >= 1)
+
+
+@mark.main
+def test_visual_odometry_2d_tracking(mocker):
+    images_kitti_l = ['test_data/kitti00/image_0/{}.png'.format(str(i).zfill(6)) for i in (0, 1, 2, 1, 0)]
+
+    process = mocker.spy(FeatureExtraction, 'process')
+    cam_left = CalibratedCamera(ImageTransform(ImagesReader(images_kitti_l), ocl=False, color=cv2.COLOR_BGR2GRAY), camera_kitti)
+    with VisualOdometry2DEngine(cam_left, feature_type='GFTT') as engine:
+        poses = [engine.compute()[1] for i in range(5)]
+        assert(poses[0] is None and all(pose is not None for pose in poses[1:]))
+        assert(poses[2].translation[2, 0] > 1.5)
+        # camera returns to the first frame
+        assert(np.linalg.norm(poses[4].translation) < .2)
+        # features are tracked and only detected for the first frame
+        assert(process.call_count == 1)
+        assert(len(engine._last_kps) > engine._min_features)
+
+    process.reset_mock()
+    cam_left = CalibratedCamera(ImageTransform(ImagesReader(images_kitti_l[:3]), ocl=False, color=cv2.COLOR_BGR2GRAY), camera_kitti)
+    with VisualOdometry2DEngine(cam_left, feature_type='GFTT', min_features=5000) as engine:
+        poses = [engine.compute()[1] for i in range(3)]
+        assert(poses[2] is not None)
+        # tracked features are complemented with new ones on every frame
+        assert(process.call_count == 3)
@@ -37,3 +37,16 @@ def test_visual_odometry_3d2d_debug_kitti():
 
 if __name__ == "__main__":
     common_test_visual_odometry_kitti('FREAK', mp=False, ocl=True, debug=False, color=cv2.COLOR_BGR2GRAY, odometry_class=VisualOdometry3D2DEngine)
+
+
+@mark.main
+def test_visual_odometry_3d2d_bundle_adjustment():
+    images_kitti_l = ['test_data/kitti00/image_0/{}.png'.format(str(i).zfill(6)) for i in range(3)]
+
+    cam_left = CalibratedCamera(ImageTransform(ImagesReader(images_kitti_l), ocl=False, color=cv2.COLOR_BGR2GRAY), camera_kitti)
+    adjuster = BundleAdjuster(camera_kitti.matrix, background=False)
+    with VisualOdometry3D2DEngine(cam_left, feature_type='ORB', bundle_adjuster=adjuster) as engine:
+        poses = [engine.compute()[1] for i in range(3)]
+        assert(poses[-1] is not None)
+        assert(len(adjuster) >= 2 and adjuster.landmark_count > 0)
+        assert(adjuster.version >= 1)
@@ -89,3 +89,147 @@ def test_visual_odometry_kitti_stereo():
                 break
 
     cv2.waitKey(0)
+
+
+@mark.main
+@pytest.mark.parametrize('exit_strategy', VisualOdometryStereoEngine.EXIT_STRATEGIES)
+def test_visual_odometry_stereo_exit_strategy(exit_strategy):
+    camera = StereoCamera(camera_kitti, camera_kitti_right, R_kitti, T_kitti, None, None, None)
+    FEATURE_TYPE = 'ORB'
+
+    images_kitti_l = ['test_data/kitti00/image_0/{}.png'.format(str(i).zfill(6)) for i in range(3)]
+    images_kitti_r = ['test_data/kitti00/image_1/{}.png'.format(str(i).zfill(6)) for i in range(3)]
+
+    cam_left = CalibratedCamera(ImageTransform(ImagesReader(images_kitti_l), ocl=False, color=cv2.COLOR_BGR2GRAY), None)
+    cam_right = CalibratedCamera(ImageTransform(ImagesReader(images_kitti_r), ocl=False, color=cv2.COLOR_BGR2GRAY), None)
+    cam = CalibratedStereoCamera(
+            FeatureExtraction(cam_left, FEATURE_TYPE),
+            FeatureExtraction(cam_right, FEATURE_TYPE),
+            camera)
+    with VisualOdometryStereoEngine(cam, exit_strategy=exit_strategy, pnp_attempts=3) as engine:
+        poses = [engine.compute()[1] for i in range(3)]
+        assert(poses[0] is None)
+        assert(poses[2] is not None)
+        assert(len(poses[2].features.points3d) <= len(poses[2].features.points))
+        timings = engine.timings
+        assert(timings.total >= timings.capture + timings.triangulation + timings.matching + timings.pose)
+        assert(timings.pose > 0)
+        assert(engine.average_timings.total > 0)
+
+    with raises(ValueError):
+        VisualOdometryStereoEngine(cam, exit_strategy='unknown')
+
+
+@mark.main
+def test_visual_odometry_stereo_many_attempts():
+    camera = StereoCamera(camera_kitti, camera_kitti_right, R_kitti, T_kitti, None, None, None)
+    FEATURE_TYPE = 'ORB'
+
+    images_kitti_l = ['test_data/kitti00/image_0/{}.png'.format(str(i).zfill(6)) for i in range(2)]
+    images_kitti_r = ['test_data/kitti00/image_1/{}.png'.format(str(i).zfill(6)) for i in range(2)]
+
+    cam_left = CalibratedCamera(ImageTransform(ImagesReader(images_kitti_l), ocl=False, color=cv2.COLOR_BGR2GRAY), None)
+    cam_right = CalibratedCamera(ImageTransform(ImagesReader(images_kitti_r), ocl=False, color=cv2.COLOR_BGR2GRAY), None)
+    cam = CalibratedStereoCamera(
+            FeatureExtraction(cam_left, FEATURE_TYPE),
+            FeatureExtraction(cam_right, FEATURE_TYPE),
+            camera)
+    # confidence would drop below zero after ten attempts
+    with VisualOdometryStereoEngine(cam, exit_strategy='best', pnp_attempts=12) as engine:
+        poses = [engine.compute()[1] for i in range(2)]
+        assert(poses[1] is not None)
+
+
+@mark.main
+def test_visual_odometry_stereo_keyframes():
+    camera = StereoCamera(camera_kitti, camera_kitti_right, R_kitti, T_kitti, None, None, None)
+    FEATURE_TYPE = 'ORB'
+
+    # last frame is repeated, i.e. the camera stops
+    images_kitti_l = ['test_data/kitti00/image_0/{}.png'.format(str(i).zfill(6)) for i in (0, 1, 2, 2)]
+    images_kitti_r = ['test_data/kitti00/image_1/{}.png'.format(str(i).zfill(6)) for i in (0, 1, 2, 2)]
+
+    cam_left = CalibratedCamera(ImageTransform(ImagesReader(images_kitti_l), ocl=False, color=cv2.COLOR_BGR2GRAY), None)
+    cam_right = CalibratedCamera(ImageTransform(ImagesReader(images_kitti_r), ocl=False, color=cv2.COLOR_BGR2GRAY), None)
+    cam = CalibratedStereoCamera(
+            FeatureExtraction(cam_left, FEATURE_TYPE),
+            FeatureExtraction(cam_right, FEATURE_TYPE),
+            camera)
+    with VisualOdometryStereoEngine(cam, keyframes=True) as engine:
+        poses = [engine.compute()[1]]
+        assert(poses[0] is None and engine.keyframe_count == 1)
+        poses += [engine.compute()[1] for i in range(3)]
+        assert(all(pose is not None for pose in poses[1:]))
+        assert(len(poses[1].features.points3d) <= len(poses[1].features.points))
+
+        # no keyframe is inserted and nothing is triangulated while the camera does not move
+        keyframes, landmarks = engine.keyframe_count, len(engine.landmarks)
+        assert(engine.timings.triangulation == 0)
+        assert(keyframes == 2 and landmarks > 0)
+        assert(np.linalg.norm(poses[3].translation - poses[2].translation) < 50)
+        assert(poses[2].translation[2, 0] > 1000)
+
+
+@mark.main
+@mark.parametrize('keyframes', [False, True])
+def test_visual_odometry_stereo_bundle_adjustment(keyframes):
+    camera = StereoCamera(camera_kitti, camera_kitti_right, R_kitti, T_kitti, None, None, None)
+    FEATURE_TYPE = 'ORB'
+
+    images_kitti_l = ['test_data/kitti00/image_0/{}.png'.format(str(i).zfill(6)) for i in range(3)]
+    images_kitti_r = ['test_data/kitti00/image_1/{}.png'.format(str(i).zfill(6)) for i in range(3)]
+
+    cam_left = CalibratedCamera(ImageTransform(ImagesReader(images_kitti_l), ocl=False, color=cv2.COLOR_BGR2GRAY), None)
+    cam_right = CalibratedCamera(ImageTransform(ImagesReader(images_kitti_r), ocl=False, color=cv2.COLOR_BGR2GRAY), None)
+    cam = CalibratedStereoCamera(
+            FeatureExtraction(cam_left, FEATURE_TYPE),
+            FeatureExtraction(cam_right, FEATURE_TYPE),
+            camera)
+    adjuster = BundleAdjuster(camera_kitti.matrix, background=False)
+    with VisualOdometryStereoEngine(cam, keyframes=keyframes, bundle_adjuster=adjuster) as engine:
+        poses = [engine.compute()[1] for i in range(3)]
+        assert(all(pose is not None for pose in poses[1:]))
+        assert(len(adjuster) >= 2 and adjuster.landmark_count > 0)
+        assert(adjuster.version >= 1)
+        assert(poses[2].translation[2, 0] > 1000)
+
+    with raises(TypeError):
+        VisualOdometryStereoEngine(cam, bundle_adjuster=object())
+    if keyframes:
+        with raises(ValueError):
+            VisualOdometryStereoEngine(cam, keyframes=True, local_keyframes=11, bundle_adjuster=adjuster)
+
+
+@mark.main
+def test_visual_odometry_stereo_keyframes_no_triangulation(mocker):
+    camera = StereoCamera(camera_kitti, camera_kitti_right, R_kitti, T_kitti, None, None, None)
+    FEATURE_TYPE = 'ORB'
+
+    images_kitti_l = ['test_data/kitti00/image_0/{}.png'.format(str(i).zfill(6)) for i in (0, 0, 1, 2)]
+    images_kitti_r = ['test_data/kitti00/image_1/{}.png'.format(str(i).zfill(6)) for i in (0, 0, 1, 2)]
+
+    cam_left = CalibratedCamera(ImageTransform(ImagesReader(images_kitti_l), ocl=False, color=cv2.COLOR_BGR2GRAY), None)
+    cam_right = CalibratedCamera(ImageTransform(ImagesReader(images_kitti_r), ocl=False, color=cv2.COLOR_BGR2GRAY), None)
+    cam = CalibratedStereoCamera(
+            FeatureExtraction(cam_left, FEATURE_TYPE),
+            FeatureExtraction(cam_right, FEATURE_TYPE),
+            camera)
+    with VisualOdometryStereoEngine(cam, keyframes=True) as engine:
+        calculate_3d = engine._calculate_3d
+        results = [None]
+        mocker.patch.object(engine, '_calculate_3d',
+                            side_effect=lambda *args: results.pop() if results else calculate_3d(*args))
+
+        # first frame is not triangulated, so local map is started with the next frame
+        assert(engine.compute()[1] is None)
+        assert(engine.keyframe_count == 0 and engine.landmarks is None)
+        assert(engine.compute()[1] is None)
+        assert(engine.keyframe_count == 1 and len(engine.landmarks) > 0)
+        poses = [engine.compute()[1] for i in range(2)]
+        assert(all(pose is not None for pose in poses))
+        assert(poses[1].translation[2, 0] > 1000)
+
+        # local map is cleared if it can not be restarted after tracking is lost
+        mocker.patch.object(engine, '_calculate_3d', return_value=None)
+        assert(not engine._insert_keyframe(engine._last_frame, *engine._world_pose))
+        assert(engine.landmarks is None and engine._world_pose is not None)
@@ -4,6 +4,9 @@
 import pytest
 from pytest import raises, approx
 from EasyVision.models.base import *
+from EasyVision.models import ObjectModel
+import numpy as np
+import cv2
 
 
 class Subclass(ModelBase):
@@ -60,3 +63,12 @@ def test_add_model():
     model2 = Subclass('new model', [ModelView('image1', 'outline1', 'features1', 'feature type')])
     model.update(model2)
     assert(len(model) == 2)
+
+
+@pytest.mark.main
+def test_points_in_polygon():
+    polygon = np.float32([(10, 10), (90, 20), (80, 90), (50, 60), (15, 85)])
+    points = np.float32(np.random.uniform(0, 100, (500, 2)))
+    inside = ObjectModel._points_in_polygon(points, polygon)
+    expected = [cv2.pointPolygonTest(polygon.reshape((-1, 1, 2)), tuple(map(float, pt)), False) > 0 for pt in points]
+    assert(inside.tolist() == expected)
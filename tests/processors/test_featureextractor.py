@@ -48,3 +48,177 @@ def test_load_and_display_images():
             cv2.waitKey(0)
 
         assert(frame_count == 3)
+
+
+@mark.main
+def test_features_keypoints():
+    import numpy as np
+    import pickle
+    keypoints = [cv2.KeyPoint(i, i * 2, 3.0, i * .5, .1, i % 3, -1) for i in range(10)]
+    descriptors = np.random.randint(0, 255, (10, 32), dtype=np.uint8)
+    features = Features(keypoints, descriptors)
+
+    assert(features.has_keypoints)
+    assert(isinstance(features.points, np.recarray))
+    assert(features.points.dtype == KeyPoint.dtype)
+    assert(features.pt.shape == (10, 2))
+    assert(np.array_equal(features.pt[[1, 3]], [[1, 2], [3, 6]]))
+    assert(features.points[3].pt[1] == 6)
+    assert(features.points['octave'][5] == 2)
+
+    restored = features.keypoints
+    assert(all(a.pt == b.pt and a.octave == b.octave for a, b in zip(restored, keypoints)))
+
+    assert(np.array_equal(Features(features.points[2:], descriptors[2:]).pt, features.pt[2:]))
+    assert(np.array_equal(pickle.loads(pickle.dumps(features)).points, features.points))
+    assert(np.array_equal(Features.fromdict(features.todict()).points, features.points))
+
+    features = Features([[1, 2], [3, 4]], descriptors[:2])
+    assert(not features.has_keypoints)
+    assert(features.pt is features.points)
+
+
+class MatcherBase(object):
+    def setup(self):
+        pass
+
+
+class Matcher(FeatureMatchingMixin, MatcherBase):
+    pass
+
+
+@mark.main
+def test_match_indices():
+    import numpy as np
+    rng = np.random.RandomState(0)
+    matcher = Matcher()
+    matcher.setup()
+
+    descriptorsB = rng.rand(200, 8).astype(np.float32)
+    order = rng.permutation(200)
+    descriptorsA = descriptorsB[order] + rng.rand(200, 8).astype(np.float32) * .001
+
+    matches = matcher._match_indices(descriptorsA, descriptorsB, 'SIFT', distance_thresh=1)
+    assert(matches.dtype.names == ('query', 'train', 'distance'))
+    assert(len(matches) > 150)
+    assert(np.array_equal(order[matches.query], matches.train))
+    assert((matches.distance < .01).all())
+
+    dmatches = matcher._match_features(descriptorsA, descriptorsB, 'SIFT', distance_thresh=1)
+    assert(len(dmatches) == len(matches))
+    assert(all(m.queryIdx == q and m.trainIdx == t for m, q, t in zip(dmatches, matches.query, matches.train)))
+
+    assert(matcher._match_indices(descriptorsA, descriptorsB, 'SIFT', distance_thresh=1e-6) is None)
+    assert(matcher._match_indices(descriptorsA[:0], descriptorsB, 'SIFT') is None)
+
+    binary = rng.randint(0, 255, (300, 32)).astype(np.uint8)
+    matches = matcher._match_indices(binary[::-1].copy(), binary, 'ORB')
+    assert(len(matches) > 250)
+    assert(np.array_equal(299 - matches.query, matches.train))
+    assert((matches.distance == 0).all())
+
+
+@mark.main
+def test_match_guided():
+    import numpy as np
+    rng = np.random.RandomState(0)
+    matcher = Matcher()
+    matcher.setup()
+
+    pointsB = rng.uniform(0, 1000, (3000, 2)).astype(np.float32)
+    order = rng.permutation(3000)[:2000]
+    pointsA = pointsB[order] + rng.uniform(-5, 5, (2000, 2)).astype(np.float32)
+
+    binary = rng.randint(0, 255, (3000, 32)).astype(np.uint8)
+    matches = matcher._match_guided(pointsA, binary[order], pointsB, binary, 'ORB', radius=10)
+    assert(len(matches) == 2000)
+    assert(np.array_equal(order[matches.query], matches.train))
+    assert((matches.distance == 0).all())
+
+    # descriptors of odd length(e.g. AKAZE)
+    matches = matcher._match_guided(pointsA, binary[order, :31], pointsB, binary[:, :31], 'AKAZE', radius=10)
+    assert(np.array_equal(order[matches.query], matches.train))
+
+    # train points outside of search window are never matched
+    assert(matcher._match_guided(pointsA + 50, binary[order], pointsB, binary, 'ORB', radius=10, min_matches=1) is None)
+
+    descriptors = rng.rand(3000, 8).astype(np.float32)
+    matches = matcher._match_guided(pointsA, descriptors[order] + .001, pointsB, descriptors, 'SIFT', radius=10, distance_thresh=.1)
+    assert(len(matches) == 2000)
+    assert(np.array_equal(order[matches.query], matches.train))
+    assert((matches.distance < .01).all())
+
+
+@mark.main
+def test_match_cached_index(mocker):
+    import numpy as np
+    rng = np.random.RandomState(0)
+    matcher = Matcher()
+    matcher.setup()
+    build = mocker.spy(matcher, '_build_index')
+
+    views = [rng.randint(0, 255, (300, 32)).astype(np.uint8) for i in range(3)]
+    for view in views:
+        matcher._train_index(view, 'ORB')
+        matcher._train_index(view, 'ORB')
+    assert(build.call_count == 3)
+
+    for i in range(5):
+        for view in views:
+            matches = matcher._match_indices(view[::-1].copy(), view, 'ORB')
+            assert(np.array_equal(299 - matches.query, matches.train))
+    assert(build.call_count == 3)
+
+    # descriptors that were not trained are indexed on every call
+    matcher._match_indices(views[0], views[0].copy(), 'ORB')
+    assert(build.call_count == 4)
+
+    matcher._prune_indexes(views[1:])
+    matcher._match_indices(views[0], views[0], 'ORB')
+    matcher._match_indices(views[0], views[1], 'ORB')
+    assert(build.call_count == 5)
+
+
+@mark.main
+def test_grid_feature_extraction():
+    import numpy as np
+    image = ImagesReader.load_image('test_data/kitti00/image_0/000000.png')
+    image = image._replace(image=cv2.cvtColor(image.image, cv2.COLOR_BGR2GRAY))
+    height, width = image.image.shape[:2]
+
+    def cell_counts(features):
+        pt = features.pt
+        cells = (pt[:, 1] * 4 // height).astype(int) * 8 + (pt[:, 0] * 8 // width).astype(int)
+        return np.bincount(cells, minlength=32)
+
+    with FeatureExtraction(None, 'ORB', nfeatures=1600) as vision:
+        plain = vision.process(image).features
+    with FeatureExtraction(None, 'ORB', nfeatures=1600, grid=(4, 8)) as vision:
+        result = vision.process(image)
+        bucketed = result.features
+        assert(result.feature_type == 'ORB' and vision.grid == (4, 8))
+    assert(len(bucketed.points) == len(bucketed.descriptors))
+    assert(len(bucketed.points) > 1400)
+
+    # every cell contributes at most its share, including low textured cells
+    counts = cell_counts(bucketed)
+    assert(counts.max() <= 50 and counts.min() > 0)
+    assert(counts.max() < cell_counts(plain).max())
+
+    # thread pool of the processor is used to redetect cells
+    with FeatureExtraction(None, 'ORB', nfeatures=1600, grid=(4, 8), parallel=4) as vision:
+        assert(vision._pool is not None)
+        parallel = vision.process(image).features
+        umat = vision.process(image._replace(image=cv2.UMat(image.image))).features
+        assert(np.array_equal(umat.pt, parallel.pt))
+    assert(np.array_equal(parallel.pt, bucketed.pt))
+    assert(np.array_equal(parallel.descriptors, bucketed.descriptors))
+
+    with FeatureExtraction(None, 'FAST', extract=False, grid=(4, 8), grid_features=320) as vision:
+        counts = cell_counts(vision.process(image).features)
+        assert(counts.max() <= 10 and counts.min() > 0)
+
+    with raises(ValueError):
+        FeatureExtraction(None, 'FAST', extract=False, grid=(4, 8))
+    with raises(ValueError):
+        FeatureExtraction(None, 'ORB', grid=(4, 0))
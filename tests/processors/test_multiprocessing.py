@@ -6,10 +6,12 @@ from pytest import raises, approx
 from EasyVision.vision.base import *
 from EasyVision.processors.base import *
 from EasyVision.processors import MultiProcessing
+from EasyVision.processors.mptransform import SharedFrameRing, SharedFrameHeader, pickle
 from EasyVision.vision import *
 from collections import namedtuple
 from tests.common import VisionSubclass, MyException
 from time import sleep
+import numpy as np
 
 Payload = namedtuple('Payload', ('a', 'b'))
 
@@ -205,3 +207,81 @@ def test_mp_properties():
         assert(vision.exposure is None)
         assert(vision.focus is None)
         assert(vision.whitebalance is None)
+
+
+class ArrayVision(VisionSubclass):
+    def capture(self):
+        from datetime import datetime
+        self._frame += 1
+        image = np.full((480, 640, 3), self._frame % 256, dtype=np.uint8)
+        features = Features(np.float32([[1, 2], [3, 4]]), np.uint8([[1] * 32, [2] * 32]))
+        return Frame(datetime.now(), self._frame - 1, (Image(self, image, features=features, feature_type='ORB'),))
+
+
+@pytest.mark.main
+def test_shared_frame_ring():
+    from datetime import datetime
+    ring = SharedFrameRing(2)
+    vision = ArrayVision(0)
+    try:
+        frame = vision.capture()
+        header = ring.write(frame)
+        assert(isinstance(header, SharedFrameHeader))
+        assert(len(pickle.dumps(header, protocol=-1)) < 1024)
+
+        result = ring.read(header)
+        assert(result.index == frame.index)
+        assert(result.timestamp == frame.timestamp)
+        assert(not result.images[0].image.flags.owndata)
+        assert((result.images[0].image == frame.images[0].image).all())
+        assert((result.images[0].features.points == frame.images[0].features.points).all())
+        assert((result.images[0].features.descriptors == frame.images[0].features.descriptors).all())
+        assert(result.images[0].features.points3d is None)
+        assert(result.images[0].feature_type == 'ORB')
+
+        header2 = ring.write(Frame(datetime.now(), 1, (Image(None, 'not an array'),)))
+        assert(header2.slot != header.slot)
+        assert(ring.read(header2).images[0].image == 'not an array')
+        del result
+    finally:
+        ring.close()
+
+
+@pytest.mark.main
+def test_shared_frame_ring_grow():
+    from datetime import datetime
+    from EasyVision.processors.mptransform import shared_memory
+    ring = SharedFrameRing(2)
+    names = []
+    try:
+        for index, size in enumerate((16, 16, 1024, 1024)):
+            header = ring.write(Frame(datetime.now(), index, (Image(None, np.zeros((size, size), np.uint8)),)))
+            result = ring.read(header)
+            assert(result.images[0].image.shape == (size, size))
+            names.append(header.name)
+            del result
+        assert(names[2] != names[0] and names[3] != names[1])
+        for name in names[:2]:
+            with raises(FileNotFoundError):
+                shared_memory.SharedMemory(name=name)
+    finally:
+        ring.close()
+    for name in names:
+        with raises(FileNotFoundError):
+            shared_memory.SharedMemory(name=name)
+
+
+@pytest.mark.main
+def test_capture_mp_shared_memory():
+    vision = ArrayVision(0)
+    with MultiProcessing(vision, shared_memory=True, num_slots=3) as mp:
+        for index, frame in enumerate(mp):
+            assert(isinstance(frame, Frame))
+            image = frame.images[0].image
+            assert(image.shape == (480, 640, 3))
+            assert((image == (frame.index + 1) % 256).all())
+            assert(frame.images[0].features.descriptors.shape == (2, 32))
+            assert(frame.images[0].source is mp)
+            if index > 5:
+                break
+        del image, frame
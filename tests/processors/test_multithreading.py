@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pytest
+from pytest import raises
+from EasyVision.vision.base import *
+from EasyVision.processors import MultiThreading
+from tests.common import VisionSubclass
+from time import sleep
+
+
+class FiniteVision(VisionSubclass):
+
+    def capture(self):
+        if self._frame >= self._frames:
+            return None
+        return super(FiniteVision, self).capture()
+
+
+def wait_finished(mt):
+    while mt._exit_event.wait(.01) is False:
+        pass
+
+
+@pytest.mark.main
+def test_capture_mt_block():
+    with MultiThreading(FiniteVision(0), queue_size=3, policy='block') as mt:
+        indices = [frame.index for frame in mt]
+        assert(indices == list(range(10)))
+        assert(mt.frames_delivered == 10)
+        assert(mt.frames_dropped == 0)
+        assert(mt.queue_occupancy == 0)
+
+
+@pytest.mark.main
+def test_capture_mt_drop_oldest():
+    with MultiThreading(FiniteVision(0), queue_size=2, policy='drop_oldest') as mt:
+        wait_finished(mt)
+        assert(mt.queue_occupancy == 2)
+        indices = [frame.index for frame in mt]
+        assert(indices == [8, 9])
+        assert(mt.frames_delivered == 2)
+        assert(mt.frames_dropped == 8)
+
+
+@pytest.mark.main
+def test_capture_mt_drop_newest():
+    with MultiThreading(FiniteVision(0), queue_size=2, policy='drop_newest') as mt:
+        wait_finished(mt)
+        indices = [frame.index for frame in mt]
+        assert(indices == [0, 1])
+        assert(mt.frames_dropped == 8)
+
+
+@pytest.mark.main
+def test_capture_mt_release_blocked():
+    with MultiThreading(VisionSubclass(0), queue_size=1, policy='block') as mt:
+        assert(mt.capture().index == 0)
+        sleep(.05)
+        assert(mt.queue_occupancy == 1)
+
+
+@pytest.mark.main
+def test_capture_mt_invalid():
+    with raises(ValueError):
+        MultiThreading(VisionSubclass(0), queue_size=0)
+    with raises(ValueError):
+        MultiThreading(VisionSubclass(0), policy='random')
@@ -194,3 +194,24 @@ def test_processor_properties():
         assert(vision.exposure == 5)
         assert(vision.focus == 6)
         assert(vision.whitebalance == 7)
+
+
+@pytest.mark.main
+def test_capture_parallel():
+    vision = VisionSubclass(0, num_images=4, processor_mask="1101")
+
+    with ProcessorA(vision, parallel=True) as processor:
+        img = processor.capture()
+        assert(isinstance(img, Frame))
+        assert(tuple(i.image for i in img.images) == ("AN IMAGE", "AN IMAGE1", "an image2", "AN IMAGE3"))
+        assert(img.images[0].source is processor)
+        assert(img.images[2].source is vision)
+
+
+@pytest.mark.main
+def test_capture_parallel_append():
+    vision = VisionSubclass(0, num_images=3)
+
+    with ProcessorA(vision, append=True, parallel=2) as processor:
+        img = processor.capture()
+        assert(tuple(i.image for i in img.images) == ("an image", "an image1", "an image2", "AN IMAGE", "AN IMAGE1", "AN IMAGE2"))
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pytest
+from pytest import raises
+from EasyVision.vision.base import *
+from EasyVision.processors import ProcessPool
+from EasyVision.processorstackbuilder import Builder, Args
+from tests.common import VisionSubclass, ProcessorA, ProcessorB
+
+
+class FailingProcessor(ProcessorA):
+
+    def process(self, image):
+        raise ValueError("processing failed")
+
+
+@pytest.mark.main
+def test_processpool_round_robin():
+    vision = VisionSubclass(0)
+    stack = Builder(ProcessorA, Args(), ProcessorB, Args())
+    with ProcessPool(vision, stack, num_workers=3) as pool:
+        indices = []
+        for frame in pool:
+            assert(isinstance(frame, Frame))
+            assert(frame.images[0].image == "An Image")
+            assert(frame.images[0].source is pool)
+            indices.append(frame.index)
+            if frame.index >= 10:
+                break
+        assert(indices == list(range(11)))
+
+
+@pytest.mark.main
+def test_processpool_least_loaded():
+    vision = VisionSubclass(0, num_images=2)
+    stack = Builder(ProcessorA, Args())
+    with ProcessPool(vision, stack, num_workers=2, dispatch='least_loaded', max_pending=3) as pool:
+        indices = [pool.capture().index for _ in range(10)]
+        assert(indices == list(range(10)))
+        assert(max(pool.loads) <= 3)
+
+
+@pytest.mark.main
+def test_processpool_process():
+    vision = VisionSubclass(0)
+    with ProcessPool(vision, Builder(ProcessorA, Args()), num_workers=2) as pool:
+        assert(pool.capture().index == 0)
+        assert(pool.process(Image(None, 'testing')).image == 'TESTING')
+        assert(pool.capture().index == 1)
+
+
+@pytest.mark.main
+def test_processpool_exception():
+    vision = VisionSubclass(0)
+    with ProcessPool(vision, Builder(FailingProcessor, Args()), num_workers=2) as pool:
+        with raises(ValueError):
+            pool.capture()
+
+
+@pytest.mark.main
+def test_processpool_invalid():
+    vision = VisionSubclass(0)
+    with raises(TypeError):
+        ProcessPool(vision, ProcessorA, num_workers=2)
+    with raises(ValueError):
+        ProcessPool(vision, Builder(ProcessorA, Args()), dispatch='random')
@@ -105,6 +105,11 @@ def test_import_featureextractor():
     from EasyVision.processors import CalibratedCamera
 
 
-@pytest.mark.xfail
+@pytest.mark.main
 def test_import_bowvocabulary():
     from EasyVision.engine import BOWVocabularyBuilderEngine
+
+
+@pytest.mark.main
+def test_import_processpool():
+    from EasyVision.processors import ProcessPool
@@ -423,3 +423,40 @@ def test_psb_Builder_Builder_fromdict():
     with processor as vision:
         for frame in vision:
             break
+
+
+@mark.main
+def test_psb_Builder_pipeline():
+    builder = Builder(
+        VisionSubclass, Args("path/to/images"),
+        ProcessorA, Args(color='color'),
+        ProcessorB, Args(camera='camera'),
+        pipeline=2
+    )
+
+    d = builder.todict()
+    assert(d['pipeline'] == 2)
+    assert(Builder.fromdict(d, (ProcessorA, ProcessorB, VisionSubclass)).pipeline == 2)
+
+    processor = builder.build()
+
+    assert(isinstance(processor, MultiThreading))
+    assert(isinstance(processor.source, ProcessorB))
+    assert(isinstance(processor.source.source, MultiThreading))
+    assert(isinstance(processor.source.source.source, ProcessorA))
+    assert(isinstance(processor.get_source('VisionSubclass'), VisionSubclass))
+    assert(processor.queue_size == 2 and processor.policy == 'block')
+
+    with processor as vision:
+        for index, frame in enumerate(vision):
+            assert(frame.index == index)
+            assert(frame.images[0].image == 'An Image')
+            if index >= 9:
+                break
+
+        stats = Builder.pipeline_stats(vision)
+        assert(len(stats) == 3)
+        assert([s.name for s in stats] == ['ProcessorB', 'ProcessorA', 'VisionSubclass'])
+        assert(stats[0].delivered == 10)
+        assert(all(s.captured >= 10 for s in stats))
+        assert(all(s.dropped == 0 for s in stats))
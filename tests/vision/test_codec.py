@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pytest
+from pytest import raises, approx, mark
+from EasyVision.vision import *
+from EasyVision.vision import codec
+from EasyVision.processors.base import Features, KeyPoint
+from datetime import datetime
+from io import BytesIO
+import cv2
+import numpy as np
+
+
+def make_frame():
+    image = np.random.randint(0, 255, (48, 64, 3), dtype=np.uint8)
+    mask = np.ones((48, 64), dtype=np.uint8)
+    keypoints = [cv2.KeyPoint(i, i * 2, 3.0, i * .5, .1, i % 3, -1)
+                 for i in range(10)]
+    descriptors = np.random.randint(0, 255, (10, 32), dtype=np.uint8)
+    features = Features(keypoints, descriptors)
+    images = (
+        Image(None, image, mask=mask, features=features, feature_type='ORB'),
+        Image(None, cv2.UMat(image), features=(True, np.float32([[1, 2]])), feature_type='corners'),
+    )
+    return Frame(datetime.now(), 42, images, '10')
+
+
+@mark.main
+def test_codec_frame():
+    frame = make_frame()
+    data = frame.tobytes()
+    assert(codec.is_encoded(data))
+
+    new_frame = Frame.frombytes(data)
+    assert(new_frame.timestamp == frame.timestamp)
+    assert(new_frame.index == 42)
+    assert(new_frame.processor_mask == '10')
+    assert(len(new_frame.images) == 2)
+
+    img = new_frame.images[0]
+    assert(img.source is None)
+    assert(np.array_equal(img.image, frame.images[0].image))
+    assert(np.array_equal(img.mask, frame.images[0].mask))
+    assert(img.feature_type == 'ORB')
+    assert(isinstance(img.features, Features))
+    assert(np.array_equal(img.features.points, frame.images[0].features.points))
+    assert(img.features.points.dtype == KeyPoint.dtype)
+    assert(np.array_equal(img.features.descriptors, frame.images[0].features.descriptors))
+    assert(img.features.points3d is None)
+
+    img = new_frame.images[1]
+    assert(isinstance(img.image, np.ndarray))
+    assert(np.array_equal(img.image, frame.images[0].image))
+    assert(img.features[0] is True)
+    assert(np.array_equal(img.features[1], [[1, 2]]))
+
+
+@mark.main
+def test_codec_no_copy():
+    frame = make_frame()
+    data = bytearray(frame.tobytes())
+    new_frame = Frame.frombytes(data)
+
+    image = new_frame.images[0].image
+    image[0, 0, 0] = 255 - image[0, 0, 0]
+    assert(Frame.frombytes(data).images[0].image[0, 0, 0] == image[0, 0, 0])
+
+    # arrays decoded from bytes are read only views
+    assert(not Frame.frombytes(bytes(data)).images[0].image.flags.writeable)
+
+
+@mark.main
+def test_codec_buffer():
+    frame = make_frame()
+    buf = BytesIO()
+    frame.tobuffer(buf)
+    frame.images[0].tobuffer(buf)
+    frame.images[0].features.tobuffer(buf)
+    buf.seek(0)
+
+    assert(Frame.frombuffer(buf).index == 42)
+    assert(np.array_equal(Image.frombuffer(buf).image, frame.images[0].image))
+    features = Features.frombuffer(buf)
+    assert(np.array_equal(features.points, frame.images[0].features.points))
+    assert(np.array_equal(features.pt, frame.images[0].features.pt))
+
+
+@mark.main
+def test_codec_invalid():
+    with raises(TypeError):
+        codec.encode(object())
+    with raises(ValueError):
+        codec.decode(b'garbage data')
+    with raises(ValueError):
+        codec.decode(make_frame().tobytes()[:-10])
+
+
+@mark.main
+def test_codec_aware_datetime():
+    from datetime import timedelta, tzinfo
+
+    class Offset(tzinfo):
+        def utcoffset(self, dt):
+            return timedelta(hours=3)
+
+        def dst(self, dt):
+            return timedelta(0)
+
+    value = datetime(2020, 5, 17, 12, 30, 15, 250, tzinfo=Offset())
+    decoded = codec.decode(codec.encode(value))
+    assert(decoded.tzinfo is None)
+    assert(decoded == datetime(2020, 5, 17, 9, 30, 15, 250))
+    assert(codec.decode(codec.encode([value]))[0] == decoded)